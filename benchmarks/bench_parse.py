@@ -0,0 +1,43 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares the per-response parse time of the syntax tree with the compiled matcher.
+#
+# Usage: python -m benchmarks.bench_parse
+
+import timeit
+
+from mks647c.message import GrammarGeneralResponse, GrammarIntegerResponse
+
+RESPONSES = ["500\r\n", "1 2\r\n", "E 4\r\n", "\r\n"]
+NUMBER = 20000
+
+
+def bench(cls, compiled):
+    grammar = cls(compiled=compiled)
+    seconds = min(timeit.repeat(lambda: [grammar.parse(r) for r in RESPONSES], number=NUMBER, repeat=3))
+    return seconds / (NUMBER * len(RESPONSES)) * 1e6
+
+
+def main():
+    for cls in [GrammarGeneralResponse, GrammarIntegerResponse]:
+        tree = bench(cls, False)
+        compiled = bench(cls, True)
+        print("{:<24} tree: {:6.2f} us  compiled: {:6.2f} us  speedup: {:4.1f}x".format(
+            cls.__name__, tree, compiled, tree / compiled))
+
+
+if __name__ == '__main__':
+    main()
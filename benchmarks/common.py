@@ -0,0 +1,55 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+
+def percentile(sorted_values, p):
+    # nearest rank
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def measure(fn, iterations, warmup=None):
+    """
+    Calls fn iterations times and returns throughput and latency percentiles (in microseconds).
+    """
+    if warmup is None:
+        warmup = max(1, iterations // 10)
+
+    for _ in range(warmup):
+        fn()
+
+    latencies = []
+    clock = time.perf_counter_ns
+    start = clock()
+    for _ in range(iterations):
+        t = clock()
+        fn()
+        latencies.append(clock() - t)
+    total = clock() - start
+
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'throughput': iterations / (total / 1e9),
+        'mean_us': sum(latencies) / len(latencies) / 1e3,
+        'p50_us': percentile(latencies, 50) / 1e3,
+        'p95_us': percentile(latencies, 95) / 1e3,
+        'p99_us': percentile(latencies, 99) / 1e3,
+        'max_us': latencies[-1] / 1e3,
+    }
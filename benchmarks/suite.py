@@ -0,0 +1,194 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark suite: micro benchmarks of the grammar, per-command driver benchmarks and full scans over all
+# channels. The driver runs against the simulator, either in memory or on a pseudo terminal (requires the serial
+# transport). Results are written as JSON, so that releases can be compared.
+#
+# Usage: python -m benchmarks.suite [--transport memory|pty] [--iterations N] [--output FILE] [--only GROUP]
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from benchmarks.common import measure
+from mks647c.capture import Capture, replay
+from mks647c.driver import MKS647CDriver
+from mks647c.message import GrammarChannelMessage, DataChannelMessage, GrammarGeneralResponse, \
+    GrammarIntegerResponse, FrameCache
+from mks647c.pool import MKS647CPool
+from mks647c.protocol import MKS647CProtocol
+from mks647c.simulator import MKS647CSimulator, SimulatorTransport, PtySimulator
+
+CHANNELS = list(range(MKS647CDriver.CHANNEL_MIN, MKS647CDriver.CHANNEL_MAX + 1))
+
+
+def micro_benchmarks(iterations):
+    msg = GrammarChannelMessage()
+    data = DataChannelMessage()
+    data.set_command(MKS647CDriver.CMD_SETPOINT)
+    data.set_channel(1)
+    data.set_write()
+    data.set_parameter_1(500)
+    kwargs = data.get_data()
+    syntax = msg.get_syntax()
+
+    uncached = GrammarChannelMessage()
+    uncached.set_frame_cache(FrameCache(maxsize=0))
+    uncached.set_data(data)
+    cached = GrammarChannelMessage()
+    cached.set_data(data)
+
+    general = GrammarGeneralResponse()
+    integer = GrammarIntegerResponse()
+    protocol = MKS647CProtocol()
+
+    return {
+        'ConcatSyntax.generate': measure(lambda: syntax.generate(**kwargs), iterations),
+        'GrammarChannelMessage.generate (uncached)': measure(uncached.generate, iterations),
+        'GrammarChannelMessage.generate (cached)': measure(cached.generate, iterations),
+        'GrammarGeneralResponse.parse': measure(lambda: general.parse("500\r\n"), iterations),
+        'GrammarIntegerResponse.parse': measure(lambda: integer.parse("500\r\n"), iterations),
+        'GrammarIntegerResponse.parse_bytes': measure(
+            lambda: GrammarIntegerResponse.parse_bytes(b"500\r\n"), iterations),
+        'MKS647CProtocol.parse_response': measure(
+            lambda: protocol.parse_response(b"500\r\n", GrammarIntegerResponse), iterations),
+    }
+
+
+def create_driver(transport):
+    simulator = MKS647CSimulator()
+    if transport == 'memory':
+        return MKS647CDriver(SimulatorTransport(simulator)), None
+
+    from mks647c.factory import MKS647CFactory
+    pty = PtySimulator(simulator)
+    port = pty.start()
+    return MKS647CFactory().create_device(device=port), pty
+
+
+def driver_benchmarks(driver, iterations):
+    driver.set_setpoint(1, 0.5)
+    driver.open(1)
+
+    return {
+        'get_flow': measure(lambda: driver.get_flow(1), iterations),
+        'get_setpoint': measure(lambda: driver.get_setpoint(1), iterations),
+        'set_setpoint': measure(lambda: driver.set_setpoint(1, 0.5), iterations),
+        'get_pressure': measure(driver.get_pressure, iterations),
+        'get_status_all': measure(lambda: driver.get_status_all(1), iterations),
+        'get_range': measure(lambda: driver.get_range(1), iterations),
+    }
+
+
+def scan_benchmarks(driver, iterations):
+    def sequential():
+        return [driver.get_flow(channel) for channel in CHANNELS]
+
+    def full():
+        return driver.get_raw_many(
+            [(MKS647CDriver.CMD_PRESSURE, None, False)] +
+            [(MKS647CDriver.CMD_FLOW, channel, False) for channel in CHANNELS] +
+            [(MKS647CDriver.CMD_STATUS, channel, False) for channel in CHANNELS])
+
+    return {
+        'flows sequential (8x get_flow)': measure(sequential, iterations),
+        'flows batched (get_flows)': measure(lambda: driver.get_flows(CHANNELS), iterations),
+        'full scan batched (pressure, flow, status)': measure(full, iterations),
+    }
+
+
+def pool_benchmarks(iterations, controllers=3):
+    # controllers on separate simulated lines with different latencies, the pool should take as long as the
+    # slowest one
+    drivers = [MKS647CDriver(SimulatorTransport(latency=0.001 * (i + 1), realtime=True)) for i in range(controllers)]
+
+    def sequential():
+        return [driver.get_flows(CHANNELS) for driver in drivers]
+
+    with MKS647CPool(drivers) as pool:
+        return {
+            'flows of {} controllers sequential'.format(controllers): measure(sequential, iterations),
+            'flows of {} controllers pool'.format(controllers): measure(lambda: pool.get_flows(CHANNELS), iterations),
+        }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL) \
+            .decode('ascii').strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MKS 647C benchmark suite")
+    parser.add_argument('--transport', choices=['memory', 'pty'], default='memory')
+    parser.add_argument('--iterations', type=int, default=None,
+                        help="iterations per benchmark (default: 20000 for micro, 2000 memory, 50 pty)")
+    parser.add_argument('--only', choices=['micro', 'driver', 'scan', 'pool'], action='append',
+                        help="groups to run (default: micro, driver, scan; pool runs on simulated 9600 baud lines)")
+    parser.add_argument('--capture', default=None, help="also replay this capture at maximum speed")
+    parser.add_argument('--output', default=None, help="write JSON to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    groups = args.only or ['micro', 'driver', 'scan']
+    io_iterations = args.iterations or (2000 if args.transport == 'memory' else 50)
+
+    report = {
+        'meta': {
+            'timestamp': time.time(),
+            'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'revision': git_revision(),
+            'transport': args.transport,
+            'unit': 'latency in microseconds, throughput in operations per second',
+        },
+    }
+
+    if 'micro' in groups:
+        report['micro'] = micro_benchmarks(args.iterations or 20000)
+
+    if 'driver' in groups or 'scan' in groups:
+        driver, pty = create_driver(args.transport)
+        try:
+            if 'driver' in groups:
+                report['driver'] = driver_benchmarks(driver, io_iterations)
+            if 'scan' in groups:
+                report['scan'] = scan_benchmarks(driver, io_iterations)
+        finally:
+            if pty is not None:
+                pty.stop()
+
+    if 'pool' in groups:
+        report['pool'] = pool_benchmarks(args.iterations or 20)
+
+    if args.capture is not None:
+        report['replay'] = replay(Capture(args.capture))
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,479 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import time
+import weakref
+from contextlib import asynccontextmanager
+
+from mks647c.driver import MKS647CDriver
+from mks647c.message import AbstractMessage, GrammarChannelMessage
+from mks647c.protocol import MKS647CProtocol, ResponseTimeoutError
+from mks647c.timing import AdaptiveTiming
+
+
+class AsyncStreamTransport(object):
+    """
+    Transport on top of an asyncio stream pair, e.g. from serial_asyncio.open_serial_connection.
+    read_until strips the terminator, like the serial transport does.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+
+    async def write(self, data: bytes):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    async def read_until(self, terminator: bytes):
+        try:
+            data = await self._reader.readuntil(terminator)
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+        return data[:-len(terminator)]
+
+    async def discard(self, quiet_time=0.01):
+        # drops everything that arrives until the line is quiet for quiet_time
+        try:
+            while True:
+                data = await asyncio.wait_for(self._reader.read(1024), quiet_time)
+                if not data:
+                    return
+        except asyncio.TimeoutError:
+            return
+
+    def close(self):
+        self._writer.close()
+
+
+class AsyncTransportSession(object):
+    """
+    Holds the lock of a transport for a block of calls of the task which entered it, see MKS647CProtocol.session.
+    Sessions are re-entrant. Calls of other tasks wait until the block is left, also calls of tasks started
+    within the block, so do not wait for such tasks inside the block.
+    """
+
+    def __init__(self, protocol, transport, max_hold=None):
+        self._protocol = protocol
+        self._transport = transport
+        self._max_hold = max_hold
+        self._task = None
+        self._held = False
+        self._joined = False
+        self._since = None
+        self._yields = 0
+
+    def get_max_hold(self):
+        return self._max_hold
+
+    def get_yields(self):
+        return self._yields
+
+    def is_owner(self):
+        return self._task is asyncio.current_task()
+
+    async def _acquire(self):
+        await self._protocol._get_lock(self._transport).acquire()
+        self._held = True
+        self._since = time.monotonic()
+
+    def _release(self):
+        if self._held:
+            self._held = False
+            self._protocol._get_lock(self._transport).release()
+
+    async def checkpoint(self):
+        # called before each command, lets other tasks in if the lock was held longer than max_hold
+        if self._max_hold is not None and time.monotonic() - self._since > self._max_hold:
+            self._yields = self._yields + 1
+            self._release()
+            await asyncio.sleep(0)
+        if not self._held:
+            await self._acquire()
+
+    async def __aenter__(self):
+        outer = self._protocol._sessions.get(self._transport)
+        if outer is not None and outer.is_owner():
+            self._joined = True
+            return outer
+
+        await self._acquire()
+        self._task = asyncio.current_task()
+        self._protocol._sessions[self._transport] = self
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._joined:
+            return
+        self._protocol._sessions.pop(self._transport, None)
+        self._task = None
+        self._release()
+
+
+class AsyncMKS647CProtocol(MKS647CProtocol):
+    """
+    asyncio variant of the protocol. Each exchange is bounded by a timeout: the learned timeout of the command
+    if adaptive timing is enabled, otherwise the given one. If an exchange times out or is cancelled after its
+    frame was written, a late response might still arrive. Such responses are read and dropped before the next
+    command is sent, waiting at most one timeout for them. A frame is always written completely, also if the call
+    is cancelled meanwhile.
+
+    Only the adaptive timing is applied: the retry policy, metrics and tracing of MKS647CProtocol are not
+    supported, nor is the inter process lock of the transport.
+    """
+
+    def __init__(self, logger=None, timeout=0.3):
+        super(AsyncMKS647CProtocol, self).__init__(logger)
+        self._timeout = timeout
+        self._timing = AdaptiveTiming(default=timeout)
+        self._locks = weakref.WeakKeyDictionary()
+        self._pending = weakref.WeakKeyDictionary()  # written frames whose response was not read, by transport
+        self._writes = weakref.WeakKeyDictionary()  # the last write, by transport
+        self._sessions = weakref.WeakKeyDictionary()
+
+    def set_timeout(self, timeout):
+        self._timeout = timeout
+
+    def get_timeout(self):
+        return self._timeout
+
+    def _get_lock(self, transport) -> asyncio.Lock:
+        lock = self._locks.get(transport)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[transport] = lock
+        return lock
+
+    def session(self, transport, max_hold=None):
+        """
+        Holds the transport lock until the block is left, for the calls of the current task:
+
+            async with protocol.session(transport):
+                ...
+
+        :param max_hold: see TransportSession, defaults to the session max hold of the protocol
+        """
+        return AsyncTransportSession(self, transport, self._session_max_hold if max_hold is None else max_hold)
+
+    @asynccontextmanager
+    async def _hold(self, transport):
+        session = self._sessions.get(transport)
+        if session is not None and session.is_owner():
+            await session.checkpoint()
+            yield
+        else:
+            async with self._get_lock(transport):
+                yield
+
+    async def clear(self, transport):
+        async with self._hold(transport):
+            await self._wait_written(transport)
+            await transport.discard()
+            self._pending[transport] = 0
+
+    async def _wait_written(self, transport):
+        # a write of a cancelled call might still be running
+        write = self._writes.get(transport)
+        if write is not None and not write.done():
+            await asyncio.shield(write)
+
+    async def _write_frame(self, transport, raw_msg):
+        await transport.write(raw_msg)
+        self._pending[transport] = self._pending.get(transport, 0) + 1
+
+    async def _drop_pending(self, transport):
+        terminator = bytes(GrammarChannelMessage.TOKEN_NL, 'ascii')
+        try:
+            while self._pending.get(transport, 0) > 0:
+                response = await asyncio.wait_for(transport.read_until(terminator), self._timeout)
+                self._logger.debug('Dropped late response: %s', repr(response))
+                self._pending[transport] = self._pending[transport] - 1
+        except asyncio.TimeoutError:
+            # the responses got lost
+            await transport.discard()
+            self._pending[transport] = 0
+
+    async def read_response(self, transport, msg: AbstractMessage):
+        response = await transport.read_until(bytes(GrammarChannelMessage.TOKEN_NL, 'ascii'))
+        self._pending[transport] = self._pending[transport] - 1
+        return self.handle_response(response, msg)
+
+    async def _exchange(self, transport, msg: AbstractMessage, timeout):
+        await self._wait_written(transport)
+        if self._pending.get(transport, 0) > 0:
+            await self._drop_pending(transport)
+
+        command = msg.get_command()
+        if timeout is None:
+            timeout = self._timeout if self._timing is None else self._timing.get_timeout(command)
+
+        try:
+            raw_msg = msg.encode()
+            self._logger.debug('Query: %s', repr(raw_msg))
+            write = asyncio.ensure_future(self._write_frame(transport, raw_msg))
+            self._writes[transport] = write
+            await asyncio.shield(write)
+            written = time.perf_counter()
+            response = await asyncio.wait_for(self.read_response(transport, msg), timeout)
+            if self._timing is not None:
+                self._timing.observe(command, time.perf_counter() - written)
+            return response
+        except asyncio.TimeoutError:
+            # the frame stays pending, its response is dropped before the next command
+            if self._timing is not None:
+                self._timing.timeout(command)
+            raise ResponseTimeoutError("No response within {} s".format(timeout))
+
+    async def query(self, transport, msg: AbstractMessage, timeout=None):
+        async with self._hold(transport):
+            return await self._exchange(transport, msg, timeout)
+
+    async def write(self, transport, msg: AbstractMessage, timeout=None):
+        async with self._hold(transport):
+            return await self._exchange(transport, msg, timeout)
+
+    async def query_many(self, transport, msgs, timeout=None):
+        # Exchanges are not pipelined: asyncio already lets other coroutines run while waiting for a response.
+        results = []
+        async with self._hold(transport):
+            for msg in msgs:
+                try:
+                    results.append(await self._exchange(transport, msg, timeout))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    results.append(e)
+        return results
+
+
+class AsyncMKS647CDriver(MKS647CDriver):
+    """
+    Mirrors every method of MKS647CDriver as coroutine. Use asyncio.wait_for to bound a single call,
+    cancelling a call is safe.
+
+    The public methods await the methods of MKS647CDriver, which must return the result of _get_value,
+    _set_cmd, _send_msg or _get_cmd_many unchanged: these are coroutines here. A method of MKS647CDriver which
+    converts such a result has to be overridden. Retries, metrics and tracing are not supported, see
+    AsyncMKS647CProtocol.
+    """
+
+    def __init__(self, transport: AsyncStreamTransport, protocol: AsyncMKS647CProtocol = None):
+        if protocol is None:
+            protocol = AsyncMKS647CProtocol()
+
+        super(AsyncMKS647CDriver, self).__init__(transport, protocol)
+
+    async def _write_message(self, syntax):
+        return await self._protocol.write(self._transport, syntax)
+
+    async def _query_message(self, syntax):
+        return await self._protocol.query(self._transport, syntax)
+
+    async def _get_cmd(self, cmd, channel=None, enable_query_token=None):
+        response = await self._query_message(self._get_msg(cmd, channel, enable_query_token))
+        self._check_data_existing(response)
+        return response
+
+    async def _get_value(self, cmd, channel=None, convert=int, enable_query_token=None, both=False):
+        if self._cache is None or cmd not in self.CACHED_COMMANDS:
+            return self._convert_response(await self._get_cmd(cmd, channel, enable_query_token), convert, both)
+
+        hit, value = self._cache.get((cmd, channel))
+        if not hit:
+            value = self._convert_response(await self._get_cmd(cmd, channel, enable_query_token), convert, both)
+            self._cache.put((cmd, channel), value)
+        return value
+
+    async def _send_msg(self, msg):
+        response = await self._write_message(msg)
+        self._update_cache(msg)
+        return response
+
+    async def _set_cmd(self, cmd, channel=None, p1=None, p2=None, setpoint_percentage=None,
+                       channel_all_allowed=False):
+        return await self._send_msg(self._set_msg(cmd, channel, p1, p2, setpoint_percentage, channel_all_allowed))
+
+    def session(self, max_hold=None):
+        """
+        Holds the transport lock for a block of calls of the current task:
+
+            async with driver.session():
+                await driver.set_range(1, 7)
+                await driver.set_setpoint(1, 0.5)
+
+        :param max_hold: see AsyncTransportSession
+        """
+        return self._protocol.session(self._transport, max_hold)
+
+    async def apply(self, recipe, dry_run=False):
+        # like MKS647CDriver.apply
+        plan = self._recipe_plan(recipe)
+        async with self.session():
+            responses = await self._protocol.query_many(self._transport, self._recipe_reads(plan))
+            report, writes = self._recipe_diff(plan, responses)
+            if dry_run:
+                report['changed'] = {key: (current, wanted) for key, _, current, wanted in writes}
+                return report
+            responses = await self._protocol.query_many(self._transport, [msg for _, msg, _, _ in writes]) \
+                if writes else []
+        return self._recipe_result(report, writes, responses)
+
+    async def refresh(self):
+        for getter, args in self._refresh_calls():
+            await getter(*args)
+
+    async def get_raw_many(self, requests):
+        requests = list(requests)
+        responses = await self._protocol.query_many(self._transport, self._raw_msgs(requests))
+        return self._raw_result(requests, responses)
+
+    async def set_raw_many(self, requests):
+        requests = list(requests)
+        msgs = self._set_raw_msgs(requests)
+        return self._set_result(requests, msgs, await self._protocol.query_many(self._transport, msgs))
+
+    async def _get_cmd_many(self, cmd, channels, convert, enable_query_token=None):
+        requests = self._channel_requests(cmd, channels, enable_query_token)
+        return self._by_channel(requests, await self.get_raw_many(requests), convert)
+
+    async def set_gas_menu(self, gas_menu):
+        return await super(AsyncMKS647CDriver, self).set_gas_menu(gas_menu)
+
+    async def get_gas_menu(self):
+        return await super(AsyncMKS647CDriver, self).get_gas_menu()
+
+    async def set_setpoint(self, channel, setpoint_percentage):
+        return await super(AsyncMKS647CDriver, self).set_setpoint(channel, setpoint_percentage)
+
+    async def get_setpoint(self, channel):
+        return await super(AsyncMKS647CDriver, self).get_setpoint(channel)
+
+    async def get_flow(self, channel):
+        return await super(AsyncMKS647CDriver, self).get_flow(channel)
+
+    async def get_flows(self, channels=None):
+        return await super(AsyncMKS647CDriver, self).get_flows(channels)
+
+    async def get_setpoints(self, channels=None):
+        return await super(AsyncMKS647CDriver, self).get_setpoints(channels)
+
+    async def set_pressure(self, setpoint_percentage):
+        return await super(AsyncMKS647CDriver, self).set_pressure(setpoint_percentage)
+
+    async def get_pressure_setpoint(self):
+        return await super(AsyncMKS647CDriver, self).get_pressure_setpoint()
+
+    async def get_pressure(self):
+        return await super(AsyncMKS647CDriver, self).get_pressure()
+
+    async def get_pressure_control_signal(self):
+        return await super(AsyncMKS647CDriver, self).get_pressure_control_signal()
+
+    async def set_pressure_mode(self, mode):
+        return await super(AsyncMKS647CDriver, self).set_pressure_mode(mode)
+
+    async def get_pressure_mode(self):
+        return await super(AsyncMKS647CDriver, self).get_pressure_mode()
+
+    async def set_range(self, channel, range_code):
+        return await super(AsyncMKS647CDriver, self).set_range(channel, range_code)
+
+    async def get_range(self, channel):
+        return await super(AsyncMKS647CDriver, self).get_range(channel)
+
+    async def set_gas_correction_factor(self, channel, factor_percentage):
+        return await super(AsyncMKS647CDriver, self).set_gas_correction_factor(channel, factor_percentage)
+
+    async def get_gas_correction_factor(self, channel):
+        return await super(AsyncMKS647CDriver, self).get_gas_correction_factor(channel)
+
+    async def set_mode(self, channel, mode, master=None):
+        return await super(AsyncMKS647CDriver, self).set_mode(channel, mode, master)
+
+    async def get_mode(self, channel):
+        return await super(AsyncMKS647CDriver, self).get_mode(channel)
+
+    async def zero_adjust(self, channel):
+        return await super(AsyncMKS647CDriver, self).zero_adjust(channel)
+
+    async def set_high_limit(self, channel, high_limit):
+        return await super(AsyncMKS647CDriver, self).set_high_limit(channel, high_limit)
+
+    async def get_high_limit(self, channel):
+        return await super(AsyncMKS647CDriver, self).get_high_limit(channel)
+
+    async def set_low_limit(self, channel, low_limit):
+        return await super(AsyncMKS647CDriver, self).set_low_limit(channel, low_limit)
+
+    async def get_low_limit(self, channel):
+        return await super(AsyncMKS647CDriver, self).get_low_limit(channel)
+
+    async def set_trip_limits_mode(self, channel, mode):
+        return await super(AsyncMKS647CDriver, self).set_trip_limits_mode(channel, mode)
+
+    async def get_trip_limits_mode(self, channel):
+        return await super(AsyncMKS647CDriver, self).get_trip_limits_mode(channel)
+
+    async def set_gas_set(self, channel, gas_set, setpoint):
+        return await super(AsyncMKS647CDriver, self).set_gas_set(channel, gas_set, setpoint)
+
+    async def zero_adjust_pressure(self):
+        return await super(AsyncMKS647CDriver, self).zero_adjust_pressure()
+
+    async def set_pressure_controller(self, controller):
+        return await super(AsyncMKS647CDriver, self).set_pressure_controller(controller)
+
+    async def get_pressure_controller(self):
+        return await super(AsyncMKS647CDriver, self).get_pressure_controller()
+
+    async def get_pressure_unit(self):
+        return await super(AsyncMKS647CDriver, self).get_pressure_unit()
+
+    async def open(self, channel):
+        return await super(AsyncMKS647CDriver, self).open(channel)
+
+    async def close(self, channel):
+        return await super(AsyncMKS647CDriver, self).close(channel)
+
+    async def get_status_bit(self, channel, bit):
+        return await super(AsyncMKS647CDriver, self).get_status_bit(channel, bit)
+
+    async def get_status_all(self, channel):
+        return await super(AsyncMKS647CDriver, self).get_status_all(channel)
+
+    async def get_status_many(self, channels=None):
+        return await super(AsyncMKS647CDriver, self).get_status_many(channels)
+
+    async def get_status(self, channel):
+        return await super(AsyncMKS647CDriver, self).get_status(channel)
+
+    async def get_status_flags(self, channels=None):
+        return await super(AsyncMKS647CDriver, self).get_status_flags(channels)
+
+    async def keyboard_disable(self):
+        return await super(AsyncMKS647CDriver, self).keyboard_disable()
+
+    async def keyboard_enable(self):
+        return await super(AsyncMKS647CDriver, self).keyboard_enable()
+
+    async def parameter_default(self):
+        return await super(AsyncMKS647CDriver, self).parameter_default()
+
+    async def hardware_reset(self):
+        return await super(AsyncMKS647CDriver, self).hardware_reset()
+
+    async def identification(self):
+        return await super(AsyncMKS647CDriver, self).identification()
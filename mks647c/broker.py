@@ -0,0 +1,380 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Broker daemon which owns the driver and serves many local clients over a Unix socket. Requests and responses
+# are JSON objects, one per line:
+#
+#   {"id": 1, "method": "get_flow", "args": [3]}
+#   {"id": 1, "result": 12.5}  or  {"id": 1, "error": {"type": "ResponseError", "message": "...", "code": 4}}
+#
+# Usage: python -m mks647c.broker [--device PORT] [--socket PATH] [--freshness SECONDS] [--mode OCTAL]
+
+import argparse
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+from mks647c.driver import MKS647CDriver, BatchResult, InvalidArgumentError
+from mks647c.message import DataGeneralResponse
+from mks647c.protocol import ResponseError
+
+DEFAULT_SOCKET = '/tmp/mks647c.sock'
+
+# driver methods which can be called through the broker, reads of the same method and arguments may be served by
+# the same serial transaction. All other methods, e.g. get_transport or session, are local to the broker.
+READ_METHODS = ('get_raw_many', 'get_gas_menu', 'get_setpoint', 'get_flow', 'get_flows', 'get_setpoints',
+                'get_pressure_setpoint', 'get_pressure', 'get_pressure_control_signal', 'get_pressure_mode',
+                'get_range', 'get_gas_correction_factor', 'get_mode', 'get_high_limit', 'get_low_limit',
+                'get_trip_limits_mode', 'get_pressure_controller', 'get_pressure_unit', 'get_status_bit',
+                'get_status_all', 'get_status_many', 'get_status', 'get_status_flags', 'identification')
+WRITE_METHODS = ('refresh', 'set_raw_many', 'apply', 'set_gas_menu', 'set_setpoint', 'set_pressure',
+                 'set_pressure_mode', 'set_range', 'set_gas_correction_factor', 'set_mode', 'zero_adjust',
+                 'set_high_limit', 'set_low_limit', 'set_trip_limits_mode', 'set_gas_set', 'zero_adjust_pressure',
+                 'set_pressure_controller', 'open', 'close', 'keyboard_disable', 'keyboard_enable',
+                 'parameter_default', 'hardware_reset')
+
+
+class BrokerError(RuntimeError):
+    pass
+
+
+def _subclasses(cls):
+    return [cls] + [subclass for direct in cls.__subclasses__() for subclass in _subclasses(direct)]
+
+
+# exceptions which are raised again by the client: all protocol errors and a few others. Unknown errors with a
+# device error code are raised as ResponseError, all others as RuntimeError.
+EXCEPTIONS = {cls.__name__: cls for cls in _subclasses(ResponseError) + [InvalidArgumentError, BrokerError,
+                                                                          RuntimeError, ValueError, TypeError]}
+
+
+def is_read(method):
+    return method in READ_METHODS
+
+
+def is_remote(method):
+    return method in READ_METHODS or method in WRITE_METHODS
+
+
+def encode_value(value):
+    # JSON has neither tuples nor non-string keys, they are tagged
+    if isinstance(value, BatchResult):
+        return {'__batch__': [[encode_value(k), encode_value(v)] for k, v in value.items()],
+                'errors': [[encode_value(k), encode_error(e)] for k, e in value.get_errors().items()]}
+    if isinstance(value, dict):
+        return {'__dict__': [[encode_value(k), encode_value(v)] for k, v in value.items()]}
+    if isinstance(value, tuple):
+        return {'__tuple__': [encode_value(v) for v in value]}
+    if isinstance(value, DataGeneralResponse):
+        # responses with errors are raised, not returned
+        return {'__response__': [value.get_value_1(), value.get_value_2()]}
+    if isinstance(value, list):
+        return [encode_value(v) for v in value]
+    if isinstance(value, Exception):
+        # e.g. the failed writes in the report of apply
+        return {'__error__': encode_error(value)}
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, list):
+        return [decode_value(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if '__tuple__' in value:
+        return tuple(decode_value(v) for v in value['__tuple__'])
+    if '__error__' in value:
+        return decode_error(value['__error__'])
+    if '__response__' in value:
+        return DataGeneralResponse.create(*value['__response__'])
+    if '__dict__' in value:
+        return {decode_value(k): decode_value(v) for k, v in value['__dict__']}
+    if '__batch__' in value:
+        result = BatchResult()
+        result.update((decode_value(k), decode_value(v)) for k, v in value['__batch__'])
+        for k, e in value['errors']:
+            result.set_error(decode_value(k), decode_error(e))
+        return result
+    raise BrokerError("Unknown value: {}".format(value))
+
+
+def encode_error(error):
+    return {'type': type(error).__name__, 'message': str(error), 'code': getattr(error, 'code', None)}
+
+
+def decode_error(error):
+    cls = EXCEPTIONS.get(error['type'])
+    if cls is None:
+        message = "{}: {}".format(error['type'], error['message'])
+        return RuntimeError(message) if error.get('code') is None else ResponseError(message, error['code'])
+    if issubclass(cls, ResponseError):
+        return cls(error['message'], error['code'])
+    return cls(error['message'])
+
+
+class _Call(object):
+    __slots__ = ('method', 'args', 'kwargs', 'done', 'result', 'error', 'finished')
+
+    def __init__(self, method, args, kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished = None  # monotonic time the call finished
+
+
+class MKS647CBroker(object):
+    """
+    Serves the driver to many clients. All device calls are executed by a single worker thread in arrival order.
+
+    Only the methods in READ_METHODS and WRITE_METHODS can be called. The socket is created with the given file
+    mode, by default only the owner may connect.
+
+    A read (READ_METHODS) joins an identical read which is queued or running, or returns its result if it
+    finished less than freshness seconds ago. Writes are never coalesced and invalidate all read results, so
+    a read arriving after a write always sees its effect.
+    """
+
+    def __init__(self, driver: MKS647CDriver, path=DEFAULT_SOCKET, freshness=0.05, logger=None, mode=0o600):
+        if logger is None:
+            logger = logging.getLogger(__name__)
+            logger.addHandler(logging.NullHandler())
+
+        self._driver = driver
+        self._path = path
+        self._freshness = freshness
+        self._mode = mode
+        self._logger = logger
+        self._queue = queue.Queue()
+        self._reads = {}  # (method, args) -> _Call, queued, running or fresh
+        self._lock = threading.Lock()
+        self._server = None
+        self._threads = []
+        self._calls = 0
+        self._coalesced = 0
+
+    def get_path(self):
+        return self._path
+
+    def get_info(self):
+        return {'calls': self._calls, 'coalesced': self._coalesced, 'freshness': self._freshness}
+
+    def call(self, method, args, kwargs=None):
+        """
+        Executes a driver call through the queue, coalescing reads.
+        """
+        kwargs = kwargs or {}
+        if not is_remote(method):
+            raise BrokerError("Unknown method: {}".format(method))
+
+        if not is_read(method):
+            call = _Call(method, args, kwargs)
+            with self._lock:
+                self._reads.clear()
+                self._queue.put(call)
+            return self._wait(call)
+
+        key = (method, json.dumps([args, kwargs], sort_keys=True))
+        with self._lock:
+            call = self._reads.get(key)
+            if call is not None and (call.finished is None or time.monotonic() - call.finished < self._freshness):
+                self._coalesced = self._coalesced + 1
+            else:
+                call = _Call(method, args, kwargs)
+                self._reads[key] = call
+                self._queue.put(call)
+        return self._wait(call)
+
+    @staticmethod
+    def _wait(call):
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _work(self):
+        while True:
+            call = self._queue.get()
+            if call is None:
+                return
+            try:
+                call.result = getattr(self._driver, call.method)(*call.args, **call.kwargs)
+            except Exception as e:
+                # the error is raised in the client
+                call.error = e
+            self._calls = self._calls + 1
+            call.finished = time.monotonic()
+            call.done.set()
+            if call.error is not None:
+                with self._lock:
+                    for key in [k for k, v in self._reads.items() if v is call]:
+                        del self._reads[key]
+
+    def _handle(self, request):
+        try:
+            result = self.call(request['method'], [decode_value(a) for a in request.get('args', [])],
+                               {k: decode_value(v) for k, v in request.get('kwargs', {}).items()})
+        except Exception as e:
+            return {'id': request.get('id'), 'error': encode_error(e)}
+        return {'id': request.get('id'), 'result': encode_value(result)}
+
+    def _respond(self, line):
+        response = self._handle(json.loads(line.decode('utf-8')))
+        try:
+            return json.dumps(response).encode('utf-8') + b'\n'
+        except (TypeError, ValueError) as e:
+            # the client gets an error instead of losing the connection
+            error = BrokerError("Result of {} cannot be sent: {}".format(response.get('id'), e))
+            return json.dumps({'id': response.get('id'), 'error': encode_error(error)}).encode('utf-8') + b'\n'
+
+    def start(self):
+        broker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    self.wfile.write(broker._respond(line))
+
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+        # the mode is set before the socket listens, no client can connect in between
+        self._server = socketserver.ThreadingUnixStreamServer(self._path, Handler, bind_and_activate=False)
+        try:
+            self._server.server_bind()
+            os.chmod(self._path, self._mode)
+            self._server.server_activate()
+        except Exception:
+            self._server.server_close()
+            self._server = None
+            raise
+        self._server.daemon_threads = True
+        self._threads = [threading.Thread(target=self._work, name='MKS647CBrokerWorker', daemon=True),
+                         threading.Thread(target=self._server.serve_forever, name='MKS647CBroker', daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        self._logger.info('Broker listening on %s', self._path)
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._server, self._threads = None, []
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+        finally:
+            self.stop()
+
+
+class MKS647CBrokerClient(object):
+    """
+    Proxy with the API of MKS647CDriver which forwards every call to the broker. Thread safe, calls of one
+    client are sent one after the other.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, timeout=None):
+        self._path = path
+        self._timeout = timeout
+        self._socket = None
+        self._file = None
+        self._lock = threading.Lock()
+        self._id = 0
+
+    def _connect(self):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(self._timeout)
+        self._socket.connect(self._path)
+        self._file = self._socket.makefile('rwb')
+
+    def close(self):
+        with self._lock:
+            if self._socket is not None:
+                self._file.close()
+                self._socket.close()
+                self._socket, self._file = None, None
+
+    def call(self, method, *args, **kwargs):
+        with self._lock:
+            if self._socket is None:
+                self._connect()
+
+            self._id = self._id + 1
+            request = {'id': self._id, 'method': method, 'args': [encode_value(a) for a in args],
+                       'kwargs': {k: encode_value(v) for k, v in kwargs.items()}}
+            self._file.write(json.dumps(request).encode('utf-8') + b'\n')
+            self._file.flush()
+            line = self._file.readline()
+
+        if not line:
+            self.close()
+            raise BrokerError("Connection to the broker closed")
+
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise decode_error(response['error'])
+        return decode_value(response['result'])
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attribute = getattr(MKS647CDriver, name)  # raises the AttributeError for unknown names
+        if not callable(attribute):
+            return attribute  # constants
+        if not is_remote(name):
+            raise AttributeError("{} cannot be called through the broker".format(name))
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def main(argv=None):
+    from mks647c.factory import MKS647CFactory
+
+    parser = argparse.ArgumentParser(description="MKS 647C broker")
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
+    parser.add_argument('--freshness', type=float, default=0.05, help="seconds a read result is shared")
+    parser.add_argument('--mode', type=lambda value: int(value, 8), default=0o600,
+                        help="file mode of the socket, e.g. 660 to let the group connect")
+    args = parser.parse_args(argv)
+
+    factory = MKS647CFactory()
+    driver = factory.create_device(device=args.device)
+    MKS647CBroker(driver, args.socket, args.freshness, factory.get_logger(), args.mode).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+
+class ConfigCache(object):
+    """
+    Cache of slowly changing device parameters. Entries expire after ttl seconds, since another process might
+    change the configuration of the device. A ttl of None keeps entries until they are invalidated.
+    """
+
+    def __init__(self, ttl=60.0, clock=time.monotonic):
+        self._ttl = ttl
+        self._clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get_ttl(self):
+        return self._ttl
+
+    def get(self, key):
+        """
+        :return: tuple (hit, value)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or self._clock() < expires:
+                    self._hits = self._hits + 1
+                    return True, value
+                del self._entries[key]
+
+            self._misses = self._misses + 1
+            return False, None
+
+    def put(self, key, value):
+        with self._lock:
+            expires = None if self._ttl is None else self._clock() + self._ttl
+            self._entries[key] = (value, expires)
+
+    def invalidate(self, key=None):
+        # invalidates the given entry, or all entries if no key is given
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def get_info(self):
+        return {'hits': self._hits, 'misses': self._misses, 'size': len(self._entries), 'ttl': self._ttl}
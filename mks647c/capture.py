@@ -0,0 +1,474 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Capture of the traffic on a transport, for replaying real sessions without hardware. The file consists of a
+# header and one record per event:
+#
+#   kind     uint8    WRITE, READ, READ_UNTIL or TIMEOUT
+#   delta    uint32   microseconds since the previous event (saturates after 71 minutes)
+#   length   uint16   number of data bytes
+#   data              written or received bytes, READ_UNTIL without the terminator
+#
+# Files ending in .gz are compressed.
+#
+# Usage: python -m mks647c.capture FILE [--speed FACTOR|max]
+
+import argparse
+import gzip
+import json
+import struct
+import threading
+import time
+from collections import deque, namedtuple
+
+from mks647c.driver import MKS647CDriver
+from mks647c.message import AbstractMessage, GrammarGeneralResponse, GrammarIntegerResponse
+from mks647c.protocol import MKS647CProtocol, ResponseTimeoutError
+
+MAGIC = b'MKS647CR'
+VERSION = 1
+
+# magic, version, wall clock time of the first event
+HEADER = struct.Struct('<8sHxxxxxxd')
+EVENT = struct.Struct('<BIH')
+
+WRITE = 1
+READ = 2
+READ_UNTIL = 3
+TIMEOUT = 4
+
+MAX_DELTA = 0xFFFFFFFF
+MAX_LENGTH = 0xFFFF
+
+TERMINATOR = b'\n'
+
+# a command of the session: the written frame, the received response (None if it got lost), the seconds
+# between both and the batch it was written in (commands written before a response was read)
+Exchange = namedtuple('Exchange', ['time', 'frame', 'response', 'latency', 'batch'])
+
+
+class CaptureError(RuntimeError):
+    pass
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+class CaptureWriter(object):
+    def __init__(self, path, clock=time.perf_counter):
+        self._clock = clock
+        self._file = _open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, time.time()))
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def event(self, kind, data=b''):
+        with self._lock:
+            if self._file is None:
+                return
+            now = self._clock()
+            delta = min(MAX_DELTA, int(round((now - self._last) * 1e6)))
+            self._last = now
+            for start in range(0, max(1, len(data)), MAX_LENGTH):
+                chunk = data[start:start + MAX_LENGTH]
+                self._file.write(EVENT.pack(kind, delta, len(chunk)))
+                self._file.write(chunk)
+                delta = 0
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class RecordingTransport(object):
+    """
+    Wraps a transport and records all writes and reads with their time into a capture file. in_waiting, the
+    timeout and all other attributes are passed through, so that the protocol treats the wrapper like the wrapped
+    transport. close() closes the capture file and the wrapped transport.
+    """
+
+    def __init__(self, transport, path):
+        self._transport = transport
+        self._writer = CaptureWriter(path)
+
+    def get_transport(self):
+        return self._transport
+
+    @property
+    def in_waiting(self):
+        return self._transport.in_waiting
+
+    @property
+    def timeout(self):
+        return self._transport.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self._transport.timeout = timeout
+
+    def write(self, data):
+        self._transport.write(data)
+        self._writer.event(WRITE, data.encode('ascii') if isinstance(data, str) else bytes(data))
+
+    def read_bytes(self, count):
+        try:
+            data = self._transport.read_bytes(count)
+        except Exception:
+            self._writer.event(TIMEOUT)
+            raise
+        self._writer.event(READ if data else TIMEOUT, bytes(data))
+        return data
+
+    def read_until(self, terminator=TERMINATOR):
+        data = self._transport.read_until(terminator)
+        self._writer.event(READ_UNTIL if data else TIMEOUT, bytes(data))
+        return data
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        try:
+            self._writer.close()
+        finally:
+            # the simulator and replay transports have nothing to close
+            if hasattr(self._transport, 'close'):
+                self._transport.close()
+
+    def __getattr__(self, name):
+        # only called for attributes which are not defined here, e.g. the port of a serial transport
+        if name.startswith('__') or name == '_transport':
+            raise AttributeError(name)
+        return getattr(self._transport, name)
+
+
+class Capture(object):
+    """
+    A loaded capture. The received byte stream is split into frames, which are assigned to the written frames
+    in order, like the device answers them. A timeout marks the response to the oldest unanswered command as
+    lost, frames without a pending command (e.g. late responses) are dropped.
+    """
+
+    def __init__(self, path):
+        self._events = []
+        with _open(path, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise CaptureError("File too short for a header")
+            magic, version, self._epoch = HEADER.unpack(header)
+            if magic != MAGIC:
+                raise CaptureError("Not a capture")
+            if version != VERSION:
+                raise CaptureError("Unsupported capture version {}".format(version))
+
+            data = f.read()
+
+        now, offset = 0.0, 0
+        while offset + EVENT.size <= len(data):
+            kind, delta, length = EVENT.unpack_from(data, offset)
+            offset = offset + EVENT.size
+            now = now + delta / 1e6
+            self._events.append((now, kind, data[offset:offset + length]))
+            offset = offset + length
+
+        self._exchanges = self._assign()
+
+    def _assign(self):
+        exchanges = []
+        pending = deque()
+        stream = bytearray()
+        batch, read = 0, True
+
+        for now, kind, data in self._events:
+            if kind == WRITE:
+                if read:
+                    batch, read = batch + 1, False
+                for frame in data.split(TERMINATOR)[:-1]:
+                    pending.append(len(exchanges))
+                    exchanges.append(Exchange(now, frame + TERMINATOR, None, None, batch))
+                continue
+
+            read = True
+            if kind == TIMEOUT:
+                if pending and not stream:
+                    pending.popleft()
+                continue
+
+            stream.extend(data)
+            if kind == READ_UNTIL:
+                stream.extend(TERMINATOR)
+            pos = stream.find(TERMINATOR)
+            while pos >= 0:
+                frame = bytes(stream[:pos + 1])
+                del stream[:pos + 1]
+                if pending:
+                    index = pending.popleft()
+                    exchanges[index] = exchanges[index]._replace(response=frame, latency=now - exchanges[index].time)
+                pos = stream.find(TERMINATOR)
+        return exchanges
+
+    def get_epoch(self):
+        # wall clock time of the first event
+        return self._epoch
+
+    def get_duration(self):
+        return self._events[-1][0] if self._events else 0.0
+
+    def events(self):
+        # (seconds since the start, kind, data)
+        return self._events
+
+    def exchanges(self):
+        return self._exchanges
+
+    def batches(self):
+        # the exchanges grouped by batch, in order
+        batches = []
+        for exchange in self._exchanges:
+            if batches and batches[-1][0].batch == exchange.batch:
+                batches[-1].append(exchange)
+            else:
+                batches.append([exchange])
+        return batches
+
+
+class ReplayTransport(object):
+    """
+    Plays the device of a capture. Each written frame is answered with the response recorded for it, after the
+    recorded latency divided by speed, or immediately if speed is None. Lost responses are lost again.
+
+    Frames are matched to the capture in order. If the client skips commands (e.g. because of a cache), the
+    capture is searched ahead for the frame; frames which are not found get the last response recorded for
+    them, frames which were never recorded are not answered.
+    """
+
+    def __init__(self, capture: Capture, speed=1.0, lookahead=64, timeout=0.3, clock=time.perf_counter):
+        self._exchanges = capture.exchanges()
+        self._speed = speed
+        self._lookahead = lookahead
+        self.timeout = timeout
+        self._clock = clock
+        self._position = 0
+        self._responses = {}  # frame -> (response, latency) of the latest exchange
+        for exchange in reversed(self._exchanges):
+            self._responses.setdefault(exchange.frame, (exchange.response, exchange.latency))
+
+        self._queue = deque()  # (time at which the bytes arrive, bytes)
+        self._buffer = bytearray()
+        self._input = b''
+        self._stats = {'matched': 0, 'skipped': 0, 'unmatched': 0, 'unknown': 0}
+
+    def get_stats(self):
+        # matched: frames found in order, skipped: recorded frames which were not sent, unmatched: frames
+        # answered out of order, unknown: frames which are not in the capture
+        return dict(self._stats)
+
+    def get_position(self):
+        return self._position
+
+    def is_finished(self):
+        return self._position >= len(self._exchanges)
+
+    def _find(self, frame):
+        stop = min(len(self._exchanges), self._position + self._lookahead + 1)
+        for index in range(self._position, stop):
+            if self._exchanges[index].frame == frame:
+                self._stats['matched'] = self._stats['matched'] + 1
+                self._stats['skipped'] = self._stats['skipped'] + index - self._position
+                self._position = index + 1
+                exchange = self._exchanges[index]
+                self._responses[frame] = (exchange.response, exchange.latency)
+                return exchange.response, exchange.latency
+
+        if frame in self._responses:
+            self._stats['unmatched'] = self._stats['unmatched'] + 1
+            return self._responses[frame]
+        self._stats['unknown'] = self._stats['unknown'] + 1
+        return None, None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('ascii')
+
+        self._input = self._input + data
+        now = self._clock()
+        while TERMINATOR in self._input:
+            frame, self._input = self._input.split(TERMINATOR, 1)
+            response, latency = self._find(frame + TERMINATOR)
+            if response is None:
+                continue
+            due = now if self._speed is None else now + latency / self._speed
+            if self._queue:
+                # the device answers in order
+                due = max(due, self._queue[-1][0])
+            self._queue.append((due, response))
+
+    def _receive(self, wait):
+        # moves the arrived responses into the buffer, waiting at most wait seconds for the next one
+        now = self._clock()
+        if not self._buffer and self._queue and wait > 0 and self._queue[0][0] - now <= wait:
+            time.sleep(max(0.0, self._queue[0][0] - now))
+            now = self._clock()
+        while self._queue and self._queue[0][0] <= now:
+            self._buffer.extend(self._queue.popleft()[1])
+
+    @property
+    def in_waiting(self):
+        self._receive(0)
+        return len(self._buffer)
+
+    def read_bytes(self, count):
+        self._receive(self.timeout)
+        if not self._buffer:
+            raise TimeoutError("No data available")
+        data = bytes(self._buffer[:count])
+        del self._buffer[:count]
+        return data
+
+    def read_until(self, terminator=TERMINATOR):
+        self._receive(self.timeout)
+        pos = self._buffer.find(terminator)
+        if pos < 0:
+            data = bytes(self._buffer)
+            del self._buffer[:]
+            return data
+        data = bytes(self._buffer[:pos])
+        del self._buffer[:pos + len(terminator)]
+        return data
+
+
+class RecordedMessage(AbstractMessage):
+    """
+    A recorded frame, sent as it is. Queries are told apart by their query token or by the command.
+    """
+
+    # commands which are queries without the query token, and commands without parameters which are writes
+    READ_COMMANDS = (MKS647CDriver.CMD_FLOW, MKS647CDriver.CMD_STATUS)
+    ACTIONS = (MKS647CDriver.CMD_OPEN, MKS647CDriver.CMD_CLOSE, MKS647CDriver.CMD_KEYBOARD_DISABLE,
+               MKS647CDriver.CMD_KEYBOARD_ENABLE, MKS647CDriver.CMD_ALL_DEFAULT, MKS647CDriver.CMD_HARDWARE_RESET,
+               MKS647CDriver.CMD_ZERO_ADJUST, MKS647CDriver.CMD_ZERO_ADJUST_PRESSURE)
+
+    def __init__(self, frame: bytes):
+        self._frame = frame
+        self._command = frame[:2].decode('ascii', 'replace')
+        rest = frame[2:].strip()
+        self._query = self._command not in self.ACTIONS and (not rest or rest.endswith(b'R') or
+                                                             self._command in self.READ_COMMANDS)
+
+    def generate(self):
+        return self._frame.decode('ascii')
+
+    def encode(self):
+        return self._frame
+
+    def get_command(self):
+        return self._command
+
+    def is_query(self):
+        return self._query
+
+    def get_response_class(self):
+        if self._command in MKS647CDriver.TEXT_COMMANDS or not self._query:
+            return GrammarGeneralResponse
+        return GrammarIntegerResponse
+
+
+def replay(capture: Capture, speed=None, protocol: MKS647CProtocol = None, transport=None):
+    """
+    Sends the commands of a capture through the protocol again, batches as batches. At a speed the commands are
+    sent at their recorded time divided by speed, otherwise as fast as possible.
+    :param transport: the transport to send to, a ReplayTransport of the capture by default
+    :return: dict with the number of commands, errors and mismatches, the elapsed time and the latency per
+    command in microseconds
+    """
+    if protocol is None:
+        # a retry would send frames which are not in the capture
+        protocol = MKS647CProtocol()
+        protocol.set_retry_policy(None)
+        protocol.set_circuit_breaker(None)
+        if speed is None:
+            # the replayed device answers at once, pacing would only add sleeps
+            protocol.set_timing(None)
+    if transport is None:
+        # at full speed nothing is in flight, a lost response needs no wait for the line to become quiet
+        transport = ReplayTransport(capture, speed, timeout=0.3 if speed is not None else 0.0)
+
+    report = {'commands': 0, 'errors': 0, 'mismatches': 0}
+    latencies = []
+
+    start = time.perf_counter()
+    for batch in capture.batches():
+        if speed is not None:
+            wait = start + batch[0].time / speed - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+
+        msgs = [RecordedMessage(exchange.frame) for exchange in batch]
+        sent = time.perf_counter()
+        if len(msgs) > 1 and all(exchange.response is not None for exchange in batch):
+            results = protocol.query_many(transport, msgs)
+        else:
+            # the recorded batch was interrupted by a lost response and its rest was sent again, which is in the
+            # capture as well
+            results = []
+            for msg in msgs:
+                try:
+                    results.append(protocol.query(transport, msg))
+                except Exception as e:
+                    results.append(e)
+        latencies.append((time.perf_counter() - sent) / len(msgs))
+
+        for exchange, result in zip(batch, results):
+            report['commands'] = report['commands'] + 1
+            if isinstance(result, Exception):
+                report['errors'] = report['errors'] + 1
+                if exchange.response is not None and not isinstance(result, ResponseTimeoutError):
+                    report['mismatches'] = report['mismatches'] + 1
+            elif exchange.response is None:
+                report['mismatches'] = report['mismatches'] + 1
+
+    report['elapsed'] = time.perf_counter() - start
+    report['recorded'] = capture.get_duration()
+    latencies.sort()
+    if latencies:
+        report['p50_us'] = latencies[len(latencies) // 2] * 1e6
+        report['p99_us'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e6
+    if isinstance(transport, ReplayTransport):
+        report.update(transport.get_stats())
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replays a capture of a MKS 647C session")
+    parser.add_argument('capture')
+    parser.add_argument('--speed', default='max', help="factor of the recorded speed, or max")
+    args = parser.parse_args(argv)
+
+    speed = None if args.speed == 'max' else float(args.speed)
+    print(json.dumps(replay(Capture(args.capture), speed), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
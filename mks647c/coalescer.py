@@ -0,0 +1,178 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+
+from mks647c.driver import MKS647CDriver
+from mks647c.protocol import ResponseError, CircuitOpenError, is_transient
+
+
+class CoalescingWriter(object):
+    """
+    Collects setpoint and trip limit writes (FS, PS, HL, LL) and sends them at most rate times per second.
+
+    Only the newest value per (command, channel) is kept, values equal to the last value acknowledged by the
+    device are not sent again. The setters return immediately after validating the value. A write which failed
+    transiently (see is_transient) is kept and sent again with the next flush, unless a newer value was put
+    meanwhile. A value rejected by the device is dropped, its error is kept in get_errors(). Writes made directly through the
+    driver are not seen; call invalidate() after them.
+    """
+
+    def __init__(self, driver: MKS647CDriver, rate=10.0, logger=None):
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+
+        if logger is None:
+            logger = logging.getLogger(__name__)
+            logger.addHandler(logging.NullHandler())
+
+        self._driver = driver
+        self._period = 1.0 / float(rate)
+        self._logger = logger
+        self._pending = {}  # (cmd, channel) -> raw value
+        self._acknowledged = {}  # (cmd, channel) -> raw value
+        self._errors = {}  # (cmd, channel) -> exception of the last failed write
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._written = 0
+        self._superseded = 0
+        self._skipped = 0
+        self._retried = 0
+
+    def _put(self, cmd, channel, setpoint_percentage):
+        raw = self._driver.to_raw_setpoint(setpoint_percentage, channel)
+        with self._lock:
+            if (cmd, channel) in self._pending:
+                self._superseded = self._superseded + 1
+            self._pending[(cmd, channel)] = raw
+        self._wakeup.set()
+
+    def set_setpoint(self, channel, setpoint_percentage):
+        self._put(MKS647CDriver.CMD_SETPOINT, channel, setpoint_percentage)
+
+    def set_pressure(self, setpoint_percentage):
+        self._put(MKS647CDriver.CMD_PRESSURE, None, setpoint_percentage)
+
+    def set_high_limit(self, channel, limit_percentage):
+        self._put(MKS647CDriver.CMD_HIGH_LIMIT, channel, limit_percentage)
+
+    def set_low_limit(self, channel, limit_percentage):
+        self._put(MKS647CDriver.CMD_LOW_LIMIT, channel, limit_percentage)
+
+    def invalidate(self):
+        # forgets the acknowledged values, the next value of each channel is sent in any case
+        with self._lock:
+            self._acknowledged = {}
+
+    def get_errors(self):
+        with self._lock:
+            return dict(self._errors)
+
+    def get_info(self):
+        with self._lock:
+            return {'written': self._written, 'superseded': self._superseded, 'skipped': self._skipped,
+                    'retried': self._retried, 'pending': len(self._pending)}
+
+    def flush(self):
+        """
+        Sends all pending values in one transaction, blocking.
+        :return: number of values sent
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                requests = []
+                for key, raw in pending.items():
+                    if self._acknowledged.get(key) == raw:
+                        self._skipped = self._skipped + 1
+                    else:
+                        requests.append(key + (raw,))
+
+            if not requests:
+                return 0
+
+            try:
+                result = self._driver.set_raw_many(requests)
+                errors = result.get_errors()
+            except Exception as e:
+                self._logger.warning("Flush failed: %s", repr(e))
+                errors = {request: e for request in requests}
+
+            with self._lock:
+                for request in requests:
+                    key = request[:2]
+                    if request in errors:
+                        self._acknowledged.pop(key, None)
+                        self._errors[key] = errors[request]
+                        # sent again with the next flush, unless a newer value was put meanwhile
+                        if self._is_retryable(errors[request]) and key not in self._pending:
+                            self._pending[key] = request[2]
+                            self._retried = self._retried + 1
+                    else:
+                        self._acknowledged[key] = request[2]
+                        self._errors.pop(key, None)
+                        self._written = self._written + 1
+            return len(requests)
+
+    @staticmethod
+    def _is_retryable(error):
+        # the device rejecting the value is permanent, the circuit breaker and other failures pass by
+        return not isinstance(error, ResponseError) or isinstance(error, CircuitOpenError) or is_transient(error)
+
+    def start(self):
+        if self.is_running():
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='CoalescingWriter', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        # pending values are sent before the thread ends
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            start = time.monotonic()
+            stopping = self._stop.is_set()  # values put during the last flush still have to be sent
+            self.flush()
+            if stopping:
+                return
+            with self._lock:
+                if self._pending:
+                    self._wakeup.set()  # failed writes are retried after the period
+            # bounds the rate, values arriving meanwhile are coalesced
+            self._stop.wait(self._period - (time.monotonic() - start))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
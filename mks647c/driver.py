@@ -13,16 +13,51 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from mks647c.protocol import MKS647CProtocol
-from mks647c.message import GrammarChannelMessage, DataChannelMessage, GrammarIntegerResponse, DataGeneralResponse
+import threading
+from enum import IntFlag
 
-from e21_util.pvd.transport import Serial
+from mks647c.cache import ConfigCache
+from mks647c.protocol import MKS647CProtocol
+from mks647c.tracing import Tracer, traced
+from mks647c.message import GrammarChannelMessage, DataChannelMessage, GrammarIntegerResponse, DataGeneralResponse, \
+    GrammarGeneralResponse
 
 
 class InvalidArgumentError(RuntimeError):
     pass
 
 
+class ChannelStatus(IntFlag):
+    # status word of a channel (ST command), the bits of MKS647CDriver.STATUS_BITS
+    ON = 1 << 0
+    TRIP_LIMIT_LOW = 1 << 4
+    TRIP_LIMIT_HIGH = 1 << 5
+    OVERFLOW_IN = 1 << 6
+    UNDERFLOW_IN = 1 << 7
+    OVERFLOW_OUT = 1 << 8
+    UNDERFLOW_OUT = 1 << 9
+
+
+class BatchResult(dict):
+    """
+    Result of a batched read: maps each channel to its value. Channels which failed are not contained,
+    their exception is available from get_errors().
+    """
+
+    def __init__(self):
+        super(BatchResult, self).__init__()
+        self._errors = {}
+
+    def set_error(self, channel, error: Exception):
+        self._errors[channel] = error
+
+    def get_errors(self):
+        return self._errors
+
+    def has_errors(self):
+        return len(self._errors) > 0
+
+
 class MKS647CDriver:
     # TODO: ALEX: Folgende cmds folgenden nicht der grammatik:
     # TODO: ALEX: Bislang sollten alle CMDs funktionieren bis auf GP c s R, wo man beiden Parameter und R hat
@@ -176,14 +211,171 @@ class MKS647CDriver:
     CONTROLLER_CODES = [CONTROLLER_STD, CONTROLLER_250, CONTROLLER_152, CONTROLLER_153, CONTROLLER_652,
                         CONTROLLER_146]
 
-    def __init__(self, transport: Serial, protocol: MKS647CProtocol = None):
+    # queries answered with text instead of an integer
+    TEXT_COMMANDS = [CMD_IDENTIFICATION]
+
+    # slowly changing parameters which are cached if the cache is enabled, with their getters
+    CACHED_COMMANDS = {
+        CMD_RANGE: 'get_range',
+        CMD_GAS_CORRECTION_FACTOR: 'get_gas_correction_factor',
+        CMD_MODE: 'get_mode',
+        CMD_HIGH_LIMIT: 'get_high_limit',
+        CMD_LOW_LIMIT: 'get_low_limit',
+        CMD_TRIPLE_LIMIT: 'get_trip_limits_mode',
+        CMD_PRESSURE_UNIT: 'get_pressure_unit',
+        CMD_PRESSURE_COMTROLLER: 'get_pressure_controller',
+    }
+
+    # fields of a channel in a recipe, in the order they are applied: (field, command, message builder). A slave
+    # channel names its master in the additional field 'master'.
+    RECIPE_FIELDS = (
+        ('range', CMD_RANGE, '_range_msg'),
+        ('gas_correction_factor', CMD_GAS_CORRECTION_FACTOR, '_gas_correction_factor_msg'),
+        ('mode', CMD_MODE, '_mode_msg'),
+        ('trip_limits_mode', CMD_TRIPLE_LIMIT, '_trip_limits_mode_msg'),
+        ('high_limit', CMD_HIGH_LIMIT, '_high_limit_msg'),
+        ('low_limit', CMD_LOW_LIMIT, '_low_limit_msg'),
+        ('setpoint', CMD_SETPOINT, '_setpoint_msg'),
+    )
+
+    # methods which are not traced, besides the private ones
+    UNTRACED = ('enable_tracing', 'disable_tracing', 'get_tracer', 'get_transport', 'is_open', 'enable_cache',
+                'disable_cache', 'get_cache', 'session')
+
+    def __init__(self, transport=None, protocol: MKS647CProtocol = None, opener=None):
+        """
+        :param transport: the serial transport, or None if it is opened on first use
+        :param opener: callable which opens the transport, called on first use if no transport was given
+        """
+        if transport is None and opener is None:
+            raise RuntimeError("Either a transport or an opener is needed")
 
         self._transport = transport
+        self._opener = opener
+        self._open_lock = threading.Lock()
 
         if protocol is None:
             protocol = MKS647CProtocol()
 
         self._protocol = protocol
+        self._cache = None
+        self._tracer = None
+
+    def get_transport(self):
+        # opens the transport on first use
+        if self._transport is None:
+            with self._open_lock:
+                if self._transport is None:
+                    self._transport = self._opener()
+        return self._transport
+
+    def is_open(self):
+        return self._transport is not None
+
+    def enable_tracing(self, tracer: Tracer = None):
+        """
+        Records a span for every public method and for building the messages, and sets the tracer of the protocol,
+        which adds the lock, generate, write, read and parse stages. The methods are wrapped per instance, so
+        there is no overhead once tracing is disabled again.
+        :return: the tracer
+        """
+        if tracer is None:
+            tracer = Tracer()
+        self.disable_tracing()
+
+        for name in dir(type(self)):
+            if (name.startswith('_') and name != '_build_msg') or name in self.UNTRACED:
+                continue
+            method = getattr(self, name)
+            if callable(method):
+                setattr(self, name, traced(tracer, name, method))
+
+        self._tracer = tracer
+        self._protocol.set_tracer(tracer)
+        return tracer
+
+    def disable_tracing(self):
+        if self._tracer is None:
+            return
+        for name in [name for name in vars(self) if not name.startswith('_') or name == '_build_msg']:
+            delattr(self, name)
+        self._tracer = None
+        self._protocol.set_tracer(None)
+
+    def get_tracer(self) -> Tracer:
+        return self._tracer
+
+    def enable_cache(self, ttl=60.0):
+        """
+        Caches the parameters in CACHED_COMMANDS. Writes update the cache, parameter_default() and
+        hardware_reset() flush it. Entries expire after ttl seconds.
+        """
+        self._cache = ConfigCache(ttl)
+
+    def disable_cache(self):
+        self._cache = None
+
+    def get_cache(self):
+        return self._cache
+
+    def session(self, max_hold=None):
+        """
+        Holds the transport lock for a block of calls, so that they are not interleaved with the traffic of other
+        processes and do not lock the transport again:
+
+            with driver.session():
+                driver.set_range(1, 7)
+                driver.set_setpoint(1, 0.5)
+                driver.open(1)
+
+        :param max_hold: maximal time in seconds the lock is held at once, see TransportSession
+        """
+        return self._protocol.session(self.get_transport(), max_hold)
+
+    def _refresh_calls(self):
+        # invalidates the cache and returns the getter calls to re-read the cached entries
+        if self._cache is None:
+            return []
+
+        keys = self._cache.keys()
+        self._cache.invalidate()
+        calls = []
+        for cmd, channel in keys:
+            getter = getattr(self, self.CACHED_COMMANDS[cmd])
+            calls.append((getter, () if channel is None else (channel,)))
+        return calls
+
+    def refresh(self):
+        # forces re-reading all cached parameters from the device
+        for getter, args in self._refresh_calls():
+            getter(*args)
+
+    def _written_value(self, cmd, p1):
+        # the value the getter returns after a write of p1, None if it is not known
+        if cmd in (self.CMD_RANGE, self.CMD_TRIPLE_LIMIT, self.CMD_PRESSURE_COMTROLLER):
+            return int(p1)
+        if cmd == self.CMD_GAS_CORRECTION_FACTOR:
+            return self._from_raw_correction_factor(p1)
+        if cmd in (self.CMD_HIGH_LIMIT, self.CMD_LOW_LIMIT):
+            return self._from_raw_setpoint(p1)
+        return None
+
+    def _update_cache(self, msg: GrammarChannelMessage):
+        # called after a successful write
+        if self._cache is None:
+            return
+
+        data = msg.get_data()
+        cmd = data.get_command()
+        if cmd in (self.CMD_ALL_DEFAULT, self.CMD_HARDWARE_RESET):
+            self._cache.invalidate()
+        elif cmd in self.CACHED_COMMANDS:
+            key = (cmd, data.get_channel())
+            value = None if data.get_parameter_1() is None else self._written_value(cmd, data.get_parameter_1())
+            if value is None:
+                self._cache.invalidate(key)
+            else:
+                self._cache.put(key, value)
 
     def _build_msg(self, cmd, channel=None, p1=None, p2=None, p3=None, is_query=True, enable_query_token=None):
         # Works also for cmds that do not need any channel
@@ -217,10 +409,10 @@ class MKS647CDriver:
         return msg
 
     def _write_message(self, syntax):
-        return self._protocol.write(self._transport, syntax)
+        return self._protocol.write(self.get_transport(), syntax)
 
     def _query_message(self, syntax):
-        return self._protocol.query(self._transport, syntax)
+        return self._protocol.query(self.get_transport(), syntax)
 
     def _check_data_existing(self, data: DataGeneralResponse):
         if not data.has_data():
@@ -241,17 +433,80 @@ class MKS647CDriver:
                 raise RuntimeError("Given channel %s invalid." % str(channel))
 
 
-    def _get_cmd(self, cmd, channel=None, enable_query_token=None):
+    def _get_msg(self, cmd, channel=None, enable_query_token=None):
         # works only for cmds for reading but without extra parameters p1..p3
-
         self._check(channel=channel)
         msg = self._build_msg(cmd, channel=channel, is_query=True, enable_query_token=enable_query_token)
-        msg.set_response_class(GrammarIntegerResponse)
-        response = self._query_message(msg)
+        msg.set_response_class(GrammarGeneralResponse if cmd in self.TEXT_COMMANDS else GrammarIntegerResponse)
+        return msg
+
+    def _get_cmd(self, cmd, channel=None, enable_query_token=None):
+        response = self._query_message(self._get_msg(cmd, channel, enable_query_token))
         self._check_data_existing(response)
         return response
 
-    def _set_cmd(self, cmd, channel=None, p1=None, p2=None, setpoint_percentage=None, channel_all_allowed=False):
+    def _get_value(self, cmd, channel=None, convert=int, enable_query_token=None, both=False):
+        # converts the first value (and the second one, if both is True) of the response
+        if self._cache is None or cmd not in self.CACHED_COMMANDS:
+            return self._convert_response(self._get_cmd(cmd, channel, enable_query_token), convert, both)
+
+        hit, value = self._cache.get((cmd, channel))
+        if not hit:
+            value = self._convert_response(self._get_cmd(cmd, channel, enable_query_token), convert, both)
+            self._cache.put((cmd, channel), value)
+        return value
+
+    @staticmethod
+    def _convert_response(response: DataGeneralResponse, convert, both=False):
+        if both:
+            return convert(response.get_value_1()), convert(response.get_value_2())
+        return convert(response.get_value_1())
+
+    def _raw_msgs(self, requests):
+        return [self._get_msg(cmd, channel, enable_query_token) for cmd, channel, enable_query_token in requests]
+
+    def _raw_result(self, requests, responses):
+        result = BatchResult()
+        for request, response in zip(requests, responses):
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                self._check_data_existing(response)
+                result[request] = int(response.get_value_1())
+            except Exception as e:
+                result.set_error(request, e)
+        return result
+
+    def get_raw_many(self, requests):
+        """
+        Reads many values in one transaction. Each request is a tuple (cmd, channel, enable_query_token),
+        channel and enable_query_token may be None.
+        :return: BatchResult mapping each request to the raw integer value
+        """
+        requests = list(requests)
+        return self._raw_result(requests, self._protocol.query_many(self.get_transport(), self._raw_msgs(requests)))
+
+    def _channel_requests(self, cmd, channels, enable_query_token=None):
+        if channels is None:
+            channels = range(self.CHANNEL_MIN, self.CHANNEL_MAX + 1)
+        return [(cmd, channel, enable_query_token) for channel in channels]
+
+    @staticmethod
+    def _by_channel(requests, raw: BatchResult, convert):
+        result = BatchResult()
+        for request in requests:
+            if request in raw:
+                result[request[1]] = convert(raw[request])
+            else:
+                result.set_error(request[1], raw.get_errors()[request])
+        return result
+
+    def _get_cmd_many(self, cmd, channels, convert, enable_query_token=None):
+        # reads the same cmd for many channels in one transaction
+        requests = self._channel_requests(cmd, channels, enable_query_token)
+        return self._by_channel(requests, self.get_raw_many(requests), convert)
+
+    def _set_msg(self, cmd, channel=None, p1=None, p2=None, setpoint_percentage=None, channel_all_allowed=False):
         # Practically no p3 will be transferred according to the manual
         if setpoint_percentage is not None:
             raw_setpoint = self._to_raw_setpoint(setpoint_percentage)
@@ -261,8 +516,155 @@ class MKS647CDriver:
             else:
                 p1 = raw_setpoint
         self._check(channel=channel, channel_all_allowed=channel_all_allowed)
-        msg = self._build_msg(cmd, channel=channel, p1=p1, p2=p2, is_query=False)
-        return self._write_message(msg)
+        return self._build_msg(cmd, channel=channel, p1=p1, p2=p2, is_query=False)
+
+    def _set_raw_msgs(self, requests):
+        msgs = []
+        for cmd, channel, p1 in requests:
+            if cmd in (self.CMD_SETPOINT, self.CMD_PRESSURE):
+                self._check(raw_setpoint=p1)
+            msgs.append(self._set_msg(cmd, channel, p1))
+        return msgs
+
+    def _set_result(self, requests, msgs, responses):
+        result = BatchResult()
+        for request, msg, response in zip(requests, msgs, responses):
+            if isinstance(response, Exception):
+                result.set_error(request, response)
+            else:
+                result[request] = response
+                self._update_cache(msg)
+        return result
+
+    def set_raw_many(self, requests):
+        """
+        Writes many raw values in one transaction. Each request is a tuple (cmd, channel, p1), channel may be None.
+        All messages are validated before the first one is sent.
+        :return: BatchResult mapping each request to its response
+        """
+        requests = list(requests)
+        msgs = self._set_raw_msgs(requests)
+        return self._set_result(requests, msgs, self._protocol.query_many(self.get_transport(), msgs))
+
+    def to_raw_setpoint(self, setpoint_percentage, channel=None):
+        """
+        Converts a setpoint or trip limit to the raw value sent to the device, checks the value and the channel.
+        :return: raw value as used by set_raw_many
+        """
+        raw_setpoint = self._to_raw_setpoint(setpoint_percentage)
+        self._check(channel=channel, raw_setpoint=raw_setpoint)
+        return raw_setpoint
+
+    def _recipe_plan(self, recipe):
+        # validates the whole recipe, returns the write message of each field as (channel, field, msg)
+        known = set(field for field, _, _ in self.RECIPE_FIELDS) | {'master'}
+        plan = []
+        for channel, fields in sorted(recipe.items()):
+            self._check(channel=channel)
+            unknown = set(fields) - known
+            if unknown:
+                raise RuntimeError("Unknown recipe fields {} for channel {}".format(sorted(unknown), channel))
+            if 'master' in fields and 'mode' not in fields:
+                raise RuntimeError("Recipe of channel {} gives a master without a mode".format(channel))
+
+            for field, cmd, builder in self.RECIPE_FIELDS:
+                if field in fields:
+                    args = (fields[field], fields.get('master')) if cmd == self.CMD_MODE else (fields[field],)
+                    plan.append((channel, field, getattr(self, builder)(channel, *args)))
+        return plan
+
+    def _recipe_reads(self, plan):
+        return [self._get_msg(msg.get_data().get_command(), channel) for channel, _, msg in plan]
+
+    @staticmethod
+    def _recipe_raw(response, slave):
+        # the raw state of a field, None if it could not be read
+        if isinstance(response, Exception) or not response.has_data():
+            return None
+        try:
+            value_2 = response.get_value_2() if slave else None
+            return int(response.get_value_1()), None if value_2 is None else int(value_2)
+        except (TypeError, ValueError):
+            return None
+
+    def _recipe_value(self, cmd, raw):
+        # converts a raw state into the units of the recipe
+        if raw is None:
+            return None
+        if cmd in (self.CMD_SETPOINT, self.CMD_HIGH_LIMIT, self.CMD_LOW_LIMIT):
+            return self._from_raw_setpoint(raw[0])
+        if cmd == self.CMD_GAS_CORRECTION_FACTOR:
+            return self._from_raw_correction_factor(raw[0])
+        return raw[0] if raw[1] is None else raw
+
+    def _recipe_diff(self, plan, responses):
+        """
+        Compares the recipe with the state read from the device.
+        :return: (report, writes), the writes as (key, msg, current value, wanted value)
+        """
+        report = {'changed': {}, 'unchanged': {}, 'errors': {}, 'unreadable': []}
+        writes = []
+        for (channel, field, msg), response in zip(plan, responses):
+            data = msg.get_data()
+            cmd, p2 = data.get_command(), data.get_parameter_2()
+            wanted = (int(data.get_parameter_1()), None if p2 is None else int(p2))
+            current = self._recipe_raw(response, p2 is not None)
+            key = (channel, field)
+            if current == wanted:
+                report['unchanged'][key] = self._recipe_value(cmd, wanted)
+                continue
+            if current is None:
+                report['unreadable'].append(key)
+            writes.append((key, msg, self._recipe_value(cmd, current), self._recipe_value(cmd, wanted)))
+        return report, writes
+
+    def _recipe_result(self, report, writes, responses):
+        for (key, msg, current, wanted), response in zip(writes, responses):
+            if isinstance(response, Exception):
+                report['errors'][key] = response
+            else:
+                report['changed'][key] = (current, wanted)
+                self._update_cache(msg)
+        return report
+
+    def apply(self, recipe, dry_run=False):
+        """
+        Brings the channels into the state of a recipe, e.g.
+
+            driver.apply({1: {'range': 7, 'gas_correction_factor': 1.0, 'mode': 0, 'setpoint': 0.5},
+                          2: {'mode': MKS647CDriver.CHANNEL_MODE_SLAVE, 'master': 1, 'high_limit': 1.0}})
+
+        The fields are listed in RECIPE_FIELDS and take the values of the setters. The whole recipe is validated
+        before anything is sent. The current state is read in one transaction, then only the differing values
+        are written in a second one, both within a session. Fields which could not be read are written.
+
+        :param dry_run: only compare, do not write
+        :return: dict with 'changed' mapping (channel, field) to (previous value, new value), 'unchanged' mapping
+        (channel, field) to the value, 'errors' mapping (channel, field) to the exception of a failed write and
+        'unreadable' listing the fields whose state could not be read. A dry run lists the pending changes
+        under 'changed'.
+        """
+        plan = self._recipe_plan(recipe)
+        reads = self._recipe_reads(plan)
+        with self.session():
+            report, writes = self._recipe_diff(plan, self._protocol.query_many(self.get_transport(), reads))
+            if dry_run or not writes:
+                responses = [None] * len(writes)
+            else:
+                responses = self._protocol.query_many(self.get_transport(), [msg for _, msg, _, _ in writes])
+
+        if dry_run:
+            report['changed'] = {key: (current, wanted) for key, _, current, wanted in writes}
+            return report
+        return self._recipe_result(report, writes, responses)
+
+    def _send_msg(self, msg):
+        response = self._write_message(msg)
+        self._update_cache(msg)
+        return response
+
+    def _set_cmd(self, cmd, channel=None, p1=None, p2=None, setpoint_percentage=None, channel_all_allowed=False):
+        return self._send_msg(self._set_msg(cmd, channel, p1, p2, setpoint_percentage, channel_all_allowed))
 
     @staticmethod
     def _to_raw_setpoint(setpoint_percentage):
@@ -283,59 +685,74 @@ class MKS647CDriver:
     def set_gas_menu(self, gas_menu):
         if gas_menu not in self.GAS_MENUS:
             raise InvalidArgumentError("Invalid gas menu given")
-        self._set_cmd(self.CMD_GAS_MENU, p1=gas_menu)
+        return self._set_cmd(self.CMD_GAS_MENU, p1=gas_menu)
 
     def get_gas_menu(self):
-        return int(self._get_cmd(self.CMD_GAS_MENU).get_value_1())
+        return self._get_value(self.CMD_GAS_MENU)
+
+    def _setpoint_msg(self, channel, setpoint_percentage):
+        return self._set_msg(self.CMD_SETPOINT, channel, setpoint_percentage=setpoint_percentage)
 
     def set_setpoint(self, channel, setpoint_percentage):
-        self._set_cmd(self.CMD_SETPOINT, channel, setpoint_percentage=setpoint_percentage)
+        return self._send_msg(self._setpoint_msg(channel, setpoint_percentage))
 
     def get_setpoint(self, channel):
-        return self._from_raw_setpoint(self._get_cmd(self.CMD_SETPOINT, channel).get_value_1())
+        return self._get_value(self.CMD_SETPOINT, channel, self._from_raw_setpoint)
 
     def get_flow(self, channel):
-        return self._from_raw_setpoint(self._get_cmd(self.CMD_FLOW, channel, enable_query_token=False).get_value_1())
+        return self._get_value(self.CMD_FLOW, channel, self._from_raw_setpoint, enable_query_token=False)
+
+    def get_flows(self, channels=None):
+        return self._get_cmd_many(self.CMD_FLOW, channels, self._from_raw_setpoint, enable_query_token=False)
+
+    def get_setpoints(self, channels=None):
+        return self._get_cmd_many(self.CMD_SETPOINT, channels, self._from_raw_setpoint)
 
     def set_pressure(self, setpoint_percentage):
-        self._set_cmd(self.CMD_PRESSURE, setpoint_percentage=setpoint_percentage)
+        return self._set_cmd(self.CMD_PRESSURE, setpoint_percentage=setpoint_percentage)
 
     def get_pressure_setpoint(self):
-        return self._from_raw_setpoint(self._get_cmd(self.CMD_PRESSURE).get_value_1())
+        return self._get_value(self.CMD_PRESSURE, convert=self._from_raw_setpoint)
 
     def get_pressure(self):
-        return self._from_raw_setpoint(self._get_cmd(self.CMD_PRESSURE, enable_query_token=False).get_value_1())
+        return self._get_value(self.CMD_PRESSURE, convert=self._from_raw_setpoint, enable_query_token=False)
 
     def get_pressure_control_signal(self):
-        return self._from_raw_setpoint(self._get_cmd(self.CMD_PRESSURE_SIGNAL, enable_query_token=False).get_value_1())
+        return self._get_value(self.CMD_PRESSURE_SIGNAL, convert=self._from_raw_setpoint, enable_query_token=False)
 
     def set_pressure_mode(self, mode):
         if mode not in self.PRESSURE_MODES:
             raise RuntimeError("Given pressure mode '{}' is invalid".format(mode))
-        self._set_cmd(self.CMD_PRESSURE_MODE, p1=mode)
+        return self._set_cmd(self.CMD_PRESSURE_MODE, p1=mode)
 
     def get_pressure_mode(self):
-        return int(self._get_cmd(self.CMD_PRESSURE_MODE).get_value_1())
+        return self._get_value(self.CMD_PRESSURE_MODE)
 
-    def set_range(self, channel, range_code):
+    def _range_msg(self, channel, range_code):
         if range_code not in range(0, self.MAX_GAS_RANGE_ID + 1):
             raise RuntimeError("Given range code is invalid")
-        self._set_cmd(self.CMD_RANGE, channel=channel, p1=range_code)
+        return self._set_msg(self.CMD_RANGE, channel=channel, p1=range_code)
+
+    def set_range(self, channel, range_code):
+        return self._send_msg(self._range_msg(channel, range_code))
 
     def get_range(self, channel):
-        return int(self._get_cmd(self.CMD_RANGE, channel=channel).get_value_1())
+        return self._get_value(self.CMD_RANGE, channel)
 
-    def set_gas_correction_factor(self, channel, factor_percentage):
+    def _gas_correction_factor_msg(self, channel, factor_percentage):
         if not (0.1 <= factor_percentage <= 1.8):
             raise RuntimeError("Given gas correction factor '{}' must be in range [0.1, 1.8]".format(factor_percentage))
 
-        self._set_cmd(self.CMD_GAS_CORRECTION_FACTOR, channel=channel,
-                      p1=self._to_raw_correction_factor(factor_percentage))
+        return self._set_msg(self.CMD_GAS_CORRECTION_FACTOR, channel=channel,
+                             p1=self._to_raw_correction_factor(factor_percentage))
+
+    def set_gas_correction_factor(self, channel, factor_percentage):
+        return self._send_msg(self._gas_correction_factor_msg(channel, factor_percentage))
 
     def get_gas_correction_factor(self, channel):
-        return self._from_raw_correction_factor(self._get_cmd(self.CMD_GAS_CORRECTION_FACTOR, channel).get_value_1())
+        return self._get_value(self.CMD_GAS_CORRECTION_FACTOR, channel, self._from_raw_correction_factor)
 
-    def set_mode(self, channel, mode, master=None):
+    def _mode_msg(self, channel, mode, master=None):
         if mode == self.CHANNEL_MODE_SLAVE:
             # master has to be given only if mode is 1
             if master in range(self.CHANNEL_MIN, self.CHANNEL_MAX + 1):
@@ -352,43 +769,53 @@ class MKS647CDriver:
         else:
             raise RuntimeError("Given mode {} is unknown".format(mode))
 
-        self._set_cmd(self.CMD_MODE, channel=channel, p1=mode, p2=p2)
+        return self._set_msg(self.CMD_MODE, channel=channel, p1=mode, p2=p2)
+
+    def set_mode(self, channel, mode, master=None):
+        return self._send_msg(self._mode_msg(channel, mode, master))
 
     def get_mode(self, channel):
-        response = self._get_cmd(self.CMD_MODE, channel)
-        return int(response.get_value_1()), int(response.get_value_2())
+        return self._get_value(self.CMD_MODE, channel, both=True)
 
     def zero_adjust(self, channel):
         # returns the voltage offset: -500 mV to 500 mV
 
         # actually this should be a "set" command, but it works easier with a "get" cmd due to grammar
-        response = self._get_cmd(self.CMD_ZERO_ADJUST, channel=channel, enable_query_token=False)
-        return int(response.get_value_1())
+        return self._get_value(self.CMD_ZERO_ADJUST, channel, enable_query_token=False)
+
+    def _high_limit_msg(self, channel, high_limit):
+        return self._set_msg(self.CMD_HIGH_LIMIT, channel=channel, setpoint_percentage=high_limit)
 
     def set_high_limit(self, channel, high_limit):
-        self._set_cmd(self.CMD_HIGH_LIMIT, channel=channel, setpoint_percentage=high_limit)
+        return self._send_msg(self._high_limit_msg(channel, high_limit))
 
     def get_high_limit(self, channel):
-        return self._from_raw_setpoint(self._get_cmd(self.CMD_HIGH_LIMIT, channel=channel).get_value_1())
+        return self._get_value(self.CMD_HIGH_LIMIT, channel, self._from_raw_setpoint)
+
+    def _low_limit_msg(self, channel, low_limit):
+        return self._set_msg(self.CMD_LOW_LIMIT, channel=channel, setpoint_percentage=low_limit)
 
     def set_low_limit(self, channel, low_limit):
-        self._set_cmd(self.CMD_LOW_LIMIT, channel=channel, setpoint_percentage=low_limit)
+        return self._send_msg(self._low_limit_msg(channel, low_limit))
 
     def get_low_limit(self, channel):
-        return self._from_raw_setpoint(self._get_cmd(self.CMD_LOW_LIMIT, channel=channel).get_value_1())
+        return self._get_value(self.CMD_LOW_LIMIT, channel, self._from_raw_setpoint)
 
-    def set_trip_limits_mode(self, channel, mode):
+    def _trip_limits_mode_msg(self, channel, mode):
         if mode not in self.TRIP_LIMIT_MODES:
             raise RuntimeError("Given mode {} invalid".format(mode))
-        self._set_cmd(self.CMD_TRIPLE_LIMIT, channel=channel, p1=mode)
+        return self._set_msg(self.CMD_TRIPLE_LIMIT, channel=channel, p1=mode)
+
+    def set_trip_limits_mode(self, channel, mode):
+        return self._send_msg(self._trip_limits_mode_msg(channel, mode))
 
     def get_trip_limits_mode(self, channel):
-        return int(self._get_cmd(self.CMD_TRIPLE_LIMIT, channel=channel).get_value_1())
+        return self._get_value(self.CMD_TRIPLE_LIMIT, channel)
 
     def set_gas_set(self, channel, gas_set, setpoint):
         if gas_set not in self.GAS_MENUS:
             raise RuntimeError("Given gas set {} invalid".format(gas_set))
-        self._set_cmd(self.CMD_GAS_SET, channel=channel, p1=gas_set, setpoint_percentage=setpoint)
+        return self._set_cmd(self.CMD_GAS_SET, channel=channel, p1=gas_set, setpoint_percentage=setpoint)
 
     #
     # def get_gas_set(self, channel, gas_set):
@@ -399,56 +826,69 @@ class MKS647CDriver:
 
     def zero_adjust_pressure(self):
         # actually this should be a "set" command, but it works easier with a "get" cmd
-        response = self._get_cmd(self.CMD_ZERO_ADJUST_PRESSURE, channel=channel, enable_query_token=False)
-        return int(response.get_value_1())
+        return self._get_value(self.CMD_ZERO_ADJUST_PRESSURE, enable_query_token=False)
 
     def set_pressure_controller(self, controller):
         if controller not in self.CONTROLLER_CODES:
             raise RuntimeError("Invalid controller code given")
-        self._set_cmd(self.CMD_PRESSURE_COMTROLLER, p1=controller)
+        return self._set_cmd(self.CMD_PRESSURE_COMTROLLER, p1=controller)
 
     def get_pressure_controller(self):
-        return int(self._get_cmd(self.CMD_PRESSURE_COMTROLLER).get_value_1())
+        return self._get_value(self.CMD_PRESSURE_COMTROLLER)
 
     def get_pressure_unit(self):
-        return int(self._get_cmd(self.CMD_PRESSURE_UNIT).get_value_1())
+        return self._get_value(self.CMD_PRESSURE_UNIT)
 
     def open(self, channel):
-        self._set_cmd(self.CMD_OPEN, channel=channel, channel_all_allowed=True)
+        return self._set_cmd(self.CMD_OPEN, channel=channel, channel_all_allowed=True)
 
     def close(self, channel):
-        self._set_cmd(self.CMD_CLOSE, channel=channel, channel_all_allowed=True)
+        return self._set_cmd(self.CMD_CLOSE, channel=channel, channel_all_allowed=True)
 
 
     # TODO: check these two methods. I dont really know what the controller
     # returns and how to interpret the result...
     def get_status_bit(self, channel, bit):
-        status_decimal = int(self._get_cmd(self.CMD_STATUS, channel=channel, enable_query_token=False).get_value_1())
         if bit not in self.STATUS_BITS:
             raise RuntimeError("Given bit {} invalid".format(bit))
-        return (status_decimal >> bit) & 1
+        return self._get_value(self.CMD_STATUS, channel, lambda status: (int(status) >> bit) & 1,
+                               enable_query_token=False)
 
     def get_status_all(self, channel):
-        status_decimal = int(self._get_cmd(self.CMD_STATUS, channel=channel, enable_query_token=False).get_value_1())
+        return self._get_value(self.CMD_STATUS, channel, self._status_list, enable_query_token=False)
+
+    def _status_list(self, status_decimal):
         status = []
         for bit in self.STATUS_BITS:
-            status.append((status_decimal >> bit) & 1)
+            status.append((int(status_decimal) >> bit) & 1)
         return status
 
+    def get_status_many(self, channels=None):
+        return self._get_cmd_many(self.CMD_STATUS, channels, self._status_list, enable_query_token=False)
+
+    def get_status(self, channel) -> ChannelStatus:
+        return self._get_value(self.CMD_STATUS, channel, lambda status: ChannelStatus(int(status)),
+                               enable_query_token=False)
+
+    def get_status_flags(self, channels=None):
+        # status of all channels from one scan, as ChannelStatus by channel
+        return self._get_cmd_many(self.CMD_STATUS, channels, lambda status: ChannelStatus(int(status)),
+                                  enable_query_token=False)
+
     def keyboard_disable(self):
-        self._set_cmd(self.CMD_KEYBOARD_DISABLE)
+        return self._set_cmd(self.CMD_KEYBOARD_DISABLE)
 
     def keyboard_enable(self):
-        self._set_cmd(self.CMD_KEYBOARD_ENABLE)
+        return self._set_cmd(self.CMD_KEYBOARD_ENABLE)
 
     def parameter_default(self): # set all parameters to default
-        self._set_cmd(self.CMD_ALL_DEFAULT)
+        return self._set_cmd(self.CMD_ALL_DEFAULT)
 
     def hardware_reset(self): # performe a hardware reset, like power up
-        self._set_cmd(self.CMD_HARDWARE_RESET)
+        return self._set_cmd(self.CMD_HARDWARE_RESET)
 
     def identification(self): # check for identification
-        return self._get_cmd(self.CMD_IDENTIFICATION, channel=channel, enable_query_token=False).get_value_1()
+        return self._get_value(self.CMD_IDENTIFICATION, convert=lambda value: value, enable_query_token=False)
 
 # MKS647CDriver.set_gas_range(MKS647CDriver.GAS_RANGE_5_SCCM)
 # gas_range = MKS647CDriver.get_gas_range()
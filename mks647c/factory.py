@@ -13,23 +13,51 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# e21_util is imported when a device is created, so that importing the package stays cheap
+
 from mks647c.protocol import MKS647CProtocol
 from mks647c.driver import MKS647CDriver
-from e21_util.pvd.transport import Serial
-from e21_util.pvd.log import get_pvd_logger
-from e21_util.pvd.ports import Ports
 
 
 class MKS647CFactory:
     def get_logger(self):
+        from e21_util.pvd.log import get_pvd_logger
         return get_pvd_logger('MKS 647C Mass flow controller', 'mks647c.log')
 
-    def create_device(self, device=None, logger=None):
+    @staticmethod
+    def _default_port():
+        from e21_util.pvd.ports import Ports
+        return Ports().get_port(Ports.DEVICE_MKS_GAS_FLOW)
+
+    def create_device(self, device=None, logger=None, timeout=0.3):
+        """
+        Creates the driver without opening the serial port, the port is looked up and opened on first use. The
+        default logger is created then as well, so that creating the driver imports nothing from e21_util.
+        :param timeout: timeout of the serial port, the protocol adapts it per command if the transport allows it
+        """
+        protocol = MKS647CProtocol(logger=logger)
+
+        def opener():
+            from e21_util.pvd.transport import Serial
+            if logger is None:
+                protocol.set_logger(self.get_logger())
+            port = self._default_port() if device is None else device
+            return Serial(port, 9600, 8, 'O', 1, timeout)
+
+        return MKS647CDriver(protocol=protocol, opener=opener)
+
+    async def create_async_device(self, device=None, logger=None, timeout=0.3):
+        # requires pyserial-asyncio
+        import serial_asyncio
+        from mks647c.aio import AsyncMKS647CDriver, AsyncMKS647CProtocol, AsyncStreamTransport
+
         if logger is None:
             logger = self.get_logger()
 
         if device is None:
-            device = Ports().get_port(Ports.DEVICE_MKS_GAS_FLOW)
+            device = self._default_port()
 
-        protocol = MKS647CProtocol(logger=logger)
-        return MKS647CDriver(Serial(device, 9600, 8, 'O', 1, 0.3), protocol)
+        reader, writer = await serial_asyncio.open_serial_connection(url=device, baudrate=9600, bytesize=8,
+                                                                     parity='O', stopbits=1)
+        protocol = AsyncMKS647CProtocol(logger=logger, timeout=timeout)
+        return AsyncMKS647CDriver(AsyncStreamTransport(reader, writer), protocol)
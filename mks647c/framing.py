@@ -0,0 +1,190 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+
+class FrameReader(object):
+    """
+    Buffered framing on top of a transport. Reads all bytes which are available at once, splits them into
+    frames terminated by LF (the device sends CR LF) and keeps partial frames until the rest arrives.
+
+    Bytes which are received before a command was written are stale (e.g. a late response to a command which
+    timed out) and are dropped by sync(), without waiting for the line to become quiet. sync() cannot drop a
+    response which is still in flight, after a lost or garbled response discard_until_quiet() has to be used.
+
+    Bulk reads need the number of waiting bytes from the transport (in_waiting, like pyserial). Transports
+    without it are read frame by frame with read_until. Timeouts per frame need a settable timeout attribute,
+    otherwise the timeout of the transport applies.
+    """
+
+    TERMINATOR = b'\n'
+
+    # interval at which discard_until_quiet() checks for new bytes, in seconds
+    POLL_INTERVAL = 0.001
+
+    def __init__(self, transport, chunk_size=64):
+        self._transport = transport
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._dropped = 0
+        self._skip_partial = False  # the start of the next frame was dropped by sync()
+        self._last_activity = 0.0  # perf_counter time of the last write or received frame
+
+    def get_transport(self):
+        return self._transport
+
+    def get_dropped(self):
+        # number of stale or unsolicited frames dropped so far
+        return self._dropped
+
+    def get_last_activity(self):
+        return self._last_activity
+
+    def touch(self):
+        # called after a write
+        self._last_activity = time.perf_counter()
+
+    def has_timeout(self):
+        # whether the timeout can be set per frame
+        return hasattr(self._transport, 'timeout')
+
+    def _set_timeout(self, timeout):
+        if timeout is not None and self.has_timeout() and self._transport.timeout != timeout:
+            self._transport.timeout = timeout
+
+    def is_buffered(self):
+        return hasattr(self._transport, 'in_waiting')
+
+    def _available(self):
+        return self._transport.in_waiting
+
+    def _read(self, count):
+        # returns an empty string on a timeout
+        try:
+            return self._transport.read_bytes(count)
+        except Exception:
+            # the transports signal a timeout with an exception, which one depends on the transport
+            return b''
+
+    def _pop_frame(self):
+        pos = self._buffer.find(self.TERMINATOR)
+        if pos < 0:
+            return None
+        frame = bytes(self._buffer[:pos + 1])
+        del self._buffer[:pos + 1]
+
+        if self._skip_partial:
+            # rest of a stale frame
+            self._skip_partial = False
+            self._dropped = self._dropped + 1
+            return self._pop_frame()
+        return frame
+
+    def read_frame(self, timeout=None):
+        """
+        Reads the next frame, including its terminator.
+        :param timeout: seconds to wait for the frame, None for the timeout of the transport
+        :return: bytes, an empty string if no complete frame arrived in time
+        """
+        self._set_timeout(timeout)
+        if not self.is_buffered():
+            frame = self._transport.read_until(self.TERMINATOR)
+            if frame:
+                self._last_activity = time.perf_counter()
+                return frame + self.TERMINATOR
+            return frame
+
+        frame = self._pop_frame()
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while frame is None:
+            # blocks for the first byte at most for the transport timeout, the rest is already there
+            data = self._read(max(1, min(self._available(), self._chunk_size)))
+            self._buffer.extend(data)
+            frame = self._pop_frame()
+            if frame is None and (not data or (deadline is not None and time.perf_counter() > deadline)):
+                # keep the partial frame, the rest might still arrive
+                return b''
+        self._last_activity = time.perf_counter()
+        return frame
+
+    def sync(self):
+        """
+        Drops buffered and already received bytes without blocking. Called before a command is written.
+        :return: number of dropped frames
+        """
+        if not self.is_buffered():
+            return 0
+
+        waiting = self._available()
+        while waiting > 0:
+            data = self._read(waiting)
+            if not data:
+                break
+            self._buffer.extend(data)
+            waiting = self._available()
+
+        dropped = self._buffer.count(self.TERMINATOR)
+        if self._buffer:
+            # if a stale frame is still arriving, its rest has to be dropped as well
+            self._skip_partial = not self._buffer.endswith(self.TERMINATOR)
+        del self._buffer[:]
+
+        self._dropped = self._dropped + dropped
+        return dropped
+
+    def discard_until_quiet(self, quiet, limit=None):
+        """
+        Drops all input until no byte arrived for quiet seconds. Unlike sync(), this also drops responses which
+        are still in flight, hence it is used to resynchronize after a lost or garbled response. Blocks for at
+        least quiet seconds.
+        :param limit: seconds after which to give up if bytes keep arriving, None to wait until the line is quiet
+        :return: True if the line became quiet
+        """
+        start = time.perf_counter()
+        if not self.is_buffered():
+            return self._read_until_quiet(quiet, start, limit)
+
+        last = start
+        while True:
+            if self._available() > 0:
+                self.sync()
+                last = time.perf_counter()
+
+            now = time.perf_counter()
+            if now - last >= quiet:
+                break
+            if limit is not None and now - start >= limit:
+                return False
+            time.sleep(min(self.POLL_INTERVAL, quiet - (now - last)))
+
+        # nothing follows on a quiet line, a partial frame will not be completed
+        del self._buffer[:]
+        self._skip_partial = False
+        return True
+
+    def _read_until_quiet(self, quiet, start, limit):
+        # without in_waiting, a read which times out shows that the line is quiet
+        timeout = getattr(self._transport, 'timeout', None)
+        self._set_timeout(quiet)
+        try:
+            while self._read(self._chunk_size):
+                if limit is not None and time.perf_counter() - start >= limit:
+                    return False
+        finally:
+            self._set_timeout(timeout)
+        del self._buffer[:]
+        self._skip_partial = False
+        return True
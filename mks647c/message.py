@@ -14,8 +14,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import re
+import threading
+from collections import OrderedDict
+
 from mks647c.syntax import OptionalSyntax, FixedLengthToken, IntegerToken, ConstantToken, FloatToken, ConcatSyntax, \
-    OrSyntax, WhitespaceToken, UntilToken, ArgumentInvalidError, IntermediateResult
+    OrSyntax, WhitespaceToken, UntilToken, IntermediateResult
 
 
 class AbstractMessage(object):
@@ -24,18 +28,102 @@ class AbstractMessage(object):
     TOKEN_ERROR = 'E'
     TOKEN_QUERY = 'R'  # R = request of the parameters
 
+    # grammars are built once per class (and variant) and shared by all instances
+    _shared_syntax = {}
+    _shared_syntax_lock = threading.Lock()
+
+    def _get_shared_syntax(self, variant=None):
+        key = (self.__class__, variant)
+        syntax = self._shared_syntax.get(key)
+        if syntax is None:
+            with self._shared_syntax_lock:
+                syntax = self._shared_syntax.get(key)
+                if syntax is None:
+                    syntax = self._build_syntax(variant).freeze()
+                    self._shared_syntax[key] = syntax
+        return syntax
+
+    def _build_syntax(self, variant):
+        raise NotImplementedError()
+
     def get_syntax(self):
         raise NotImplementedError()
 
     def generate(self):
         raise NotImplementedError()
 
+    def encode(self):
+        return self.generate().encode('ascii')
+
+    def get_command(self):
+        return 'unknown'
+
+    def is_query(self):
+        # only queries may be sent again after a lost response
+        return False
+
     def get_response_class(self):
         raise NotImplementedError()
 
 
+class FrameCache(object):
+    """
+    LRU cache of generated frames. Each entry holds the frame as string and as ascii encoded bytes.
+    The cache is shared between threads, hence all accesses are locked.
+    """
+
+    def __init__(self, maxsize=128):
+        self._maxsize = int(maxsize)
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is None:
+                self._misses = self._misses + 1
+                return None
+
+            self._frames.move_to_end(key)
+            self._hits = self._hits + 1
+            return frame
+
+    def put(self, key, frame):
+        with self._lock:
+            if self._maxsize <= 0:
+                return
+
+            self._frames[key] = frame
+            self._frames.move_to_end(key)
+            while len(self._frames) > self._maxsize:
+                self._frames.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._hits, self._misses = 0, 0
+
+    def get_hits(self):
+        return self._hits
+
+    def get_misses(self):
+        return self._misses
+
+    def get_size(self):
+        return len(self._frames)
+
+    def get_maxsize(self):
+        return self._maxsize
+
+    def get_info(self):
+        return {'hits': self._hits, 'misses': self._misses, 'size': len(self._frames), 'maxsize': self._maxsize}
+
+
 class GrammarChannelMessage(AbstractMessage):
     KEY_OPT_WHITESPACE = 'Optional:whitespace'
+    KEY_OPT_PARAMETER_1 = 'Optional:p1'
     KEY_OPT_PARAMETER_2 = 'Optional:p2'
     KEY_OPT_PARAMETER_3 = 'Optional:p3'
     KEY_OPT_ADDITIONAL_TERMINATOR = 'Optional:nl'
@@ -54,30 +142,42 @@ class GrammarChannelMessage(AbstractMessage):
     KEY_ADDITIONAL_TERMINATOR = 'NewLine'
     KEY_SYNTAX = 'syntax'
 
+    # shared by all messages, since the driver creates a new message for every command
+    FRAME_CACHE = FrameCache()
+
     def __init__(self):
-        self._syntax = self._setup()
+        self._syntax = self._get_shared_syntax()
         self._data = None
         self._response = GrammarGeneralResponse
+        self._cache = self.FRAME_CACHE
+
+    def _build_syntax(self, variant):
+        return self._setup()
+
+    def _field(self, name, token):
+        # the channel and each parameter are separated by a blank, as in the manual: "FS c R", "MO c m x"
+        return OptionalSyntax(name, ConcatSyntax(token.get_name() + ':field',
+                                                 [WhitespaceToken(self.KEY_WHITESPACE), token]))
 
     def _setup(self):
-        whitespace = OptionalSyntax(self.KEY_OPT_WHITESPACE, WhitespaceToken(self.KEY_WHITESPACE))
         cmd = FixedLengthToken(self.KEY_COMMAND, 2)
-        channel = OptionalSyntax(self.KEY_OPT_CHANNEL, IntegerToken(self.KEY_CHANNEL))
+        channel = self._field(self.KEY_OPT_CHANNEL, IntegerToken(self.KEY_CHANNEL))
 
         # Since the protocol grammar is really fucked up, sometimes we have to submit an 'R' token
         # to read, and sometimes not. Hence this is optional...
-        query = OptionalSyntax(self.KEY_OPT_QUERY, ConstantToken(self.KEY_QUERY, self.TOKEN_QUERY))
+        query = self._field(self.KEY_OPT_QUERY, ConstantToken(self.KEY_QUERY, self.TOKEN_QUERY))
 
-        p1 = FloatToken(self.KEY_PARAMETER_1)
-        p2 = OptionalSyntax(self.KEY_OPT_PARAMETER_2, FloatToken(self.KEY_PARAMETER_2))
-        p3 = OptionalSyntax(self.KEY_OPT_PARAMETER_3, FloatToken(self.KEY_PARAMETER_3))
-        write = ConcatSyntax(self.KEY_WRITE, [p1, whitespace, p2, whitespace, p3])
+        # commands like ON, OF or KD are written without any parameter
+        p1 = self._field(self.KEY_OPT_PARAMETER_1, FloatToken(self.KEY_PARAMETER_1))
+        p2 = self._field(self.KEY_OPT_PARAMETER_2, FloatToken(self.KEY_PARAMETER_2))
+        p3 = self._field(self.KEY_OPT_PARAMETER_3, FloatToken(self.KEY_PARAMETER_3))
+        write = ConcatSyntax(self.KEY_WRITE, [p1, p2, p3])
         query_write = OrSyntax(self.KEY_QUERY_WRITE, [query, write])
         cr = ConstantToken(self.KEY_TERMINATOR, self.TOKEN_CR)
         nl = OptionalSyntax(self.KEY_OPT_ADDITIONAL_TERMINATOR,
                             ConstantToken(self.KEY_ADDITIONAL_TERMINATOR, self.TOKEN_NL))
 
-        return ConcatSyntax(self.KEY_SYNTAX, [cmd, whitespace, channel, query_write, cr, nl])
+        return ConcatSyntax(self.KEY_SYNTAX, [cmd, channel, query_write, cr, nl])
 
     def get_syntax(self):
         return self._syntax
@@ -88,10 +188,40 @@ class GrammarChannelMessage(AbstractMessage):
     def set_data(self, data: 'DataChannelMessage'):
         self._data = data
 
-    def generate(self):
+    def get_data(self):
+        return self._data
+
+    def _get_frame(self):
         if self._data is None:
             raise RuntimeError("No data set before.")
-        return self._syntax.generate(**self._data.get_data())
+
+        key = self._data.get_key()
+        frame = self._cache.get(key)
+        if frame is None:
+            raw = self._syntax.generate(**self._data.get_data())
+            frame = (raw, raw.encode('ascii'))
+            self._cache.put(key, frame)
+        return frame
+
+    def generate(self):
+        return self._get_frame()[0]
+
+    def encode(self):
+        return self._get_frame()[1]
+
+    def get_command(self):
+        if self._data is None or self._data.get_command() is None:
+            return super(GrammarChannelMessage, self).get_command()
+        return self._data.get_command()
+
+    def is_query(self):
+        return self._data is not None and self._data.is_query()
+
+    def set_frame_cache(self, cache: FrameCache):
+        self._cache = cache
+
+    def get_frame_cache(self):
+        return self._cache
 
     def set_response_class(self, resp):
         self._response = resp
@@ -101,6 +231,8 @@ class GrammarChannelMessage(AbstractMessage):
 
 
 class DataChannelMessage:
+    __slots__ = ('_p1', '_p2', '_p3', '_cmd', '_channel', '_query_write', '_opt_query')
+
     def __init__(self):
         self._p1, self._p2, self._p3 = None, None, None
         self._cmd, self._channel, self._query_write = None, None, None
@@ -118,10 +250,10 @@ class DataChannelMessage:
             GrammarChannelMessage.KEY_CHANNEL: self._channel,
             GrammarChannelMessage.KEY_COMMAND: self._cmd,
             GrammarChannelMessage.KEY_QUERY_WRITE: self._query_write,
-            GrammarChannelMessage.KEY_OPT_WHITESPACE: True,
             GrammarChannelMessage.KEY_WHITESPACE: " ",
             GrammarChannelMessage.KEY_OPT_ADDITIONAL_TERMINATOR: True,
 
+            GrammarChannelMessage.KEY_OPT_PARAMETER_1: self._p1 is not None,
             GrammarChannelMessage.KEY_PARAMETER_1: self._p1,
 
             GrammarChannelMessage.KEY_OPT_PARAMETER_2: self._p2 is not None,
@@ -131,6 +263,18 @@ class DataChannelMessage:
             GrammarChannelMessage.KEY_PARAMETER_3: self._p3,
         }
 
+    def get_key(self):
+        """
+        Returns a hashable key which identifies the generated frame. Parameters are keyed by their string
+        representation, since this is what gets transmitted (e.g. 500 and 500.0 are different frames).
+        :return: tuple
+        """
+        query_write = None if self._query_write is None else tuple(self._query_write)
+        return (self._cmd, self._channel, query_write, self._opt_query,
+                None if self._p1 is None else str(self._p1),
+                None if self._p2 is None else str(self._p2),
+                None if self._p3 is None else str(self._p3))
+
     def set_optional_query(self, enable):
         self._opt_query = bool(enable)
 
@@ -141,11 +285,15 @@ class DataChannelMessage:
          self._channel = channel
 
     def set_query(self):
-        self._query_write = {GrammarChannelMessage.KEY_QUERY: True}
+        # the key has to be the name of the alternative in the Or syntax, which is the optional query token
+        self._query_write = {GrammarChannelMessage.KEY_OPT_QUERY: True}
 
     def set_write(self):
         self._query_write = {GrammarChannelMessage.KEY_WRITE: True}
 
+    def is_query(self):
+        return self._query_write is not None and GrammarChannelMessage.KEY_OPT_QUERY in self._query_write
+
     def set_parameter_1(self, param):
         self._p1 = param
 
@@ -187,10 +335,22 @@ class GrammarGeneralResponse(AbstractMessage):
     KEY_OPT_VALUE_ERROR = 'Optional:data'
     KEY_WHITESPACE = 'whitespace'
 
-    def __init__(self):
-        self._syntax = self._setup()
+    # fast paths of parse_bytes() for the frames the device sends. The terminator is CR LF, or CR if the transport
+    # stripped the LF.
+    EMPTY_FRAMES = (b'\r\n', b'\r')
+    ERROR_FRAME = re.compile(rb'E[ \t]*(-?[0-9]+)\r\n?')
+    VALUE_FRAME = re.compile(rb'([^\r]+)\r\n?')
+
+    def __init__(self, compiled=True):
+        self._syntax = self._get_shared_syntax(bool(compiled))
         self._data = None
 
+    def _build_syntax(self, compiled):
+        syntax = self._setup()
+        if compiled:
+            syntax = syntax.compile()
+        return syntax
+
     def _value_1_token(self):
         return UntilToken(self.KEY_VALUE_1, self.TOKEN_CR)
 
@@ -209,16 +369,66 @@ class GrammarGeneralResponse(AbstractMessage):
         terminal = ConstantToken(self.KEY_TERMINATOR, self.TOKEN_CR + self.TOKEN_NL)
         return ConcatSyntax(self.KEY_SYNTAX, [OptionalSyntax(self.KEY_OPT_VALUE_ERROR, value_error), terminal])
 
+    def get_syntax(self):
+        return self._syntax
+
     def parse(self, data):
         return self.get_data_class()(self._syntax.parse(data))
 
     def get_data_class(self):
         return DataGeneralResponse
 
+    @classmethod
+    def parse_bytes(cls, frame):
+        """
+        Parses a frame as bytes or memoryview. Empty responses, values and errors are parsed without decoding the
+        frame, anything else by the grammar.
+        :raises UnicodeDecodeError: if a frame which is not ASCII has to be parsed by the grammar
+        """
+        if frame in cls.EMPTY_FRAMES:
+            return EMPTY_RESPONSE
+
+        m = cls.ERROR_FRAME.fullmatch(frame)
+        if m is not None:
+            return DataGeneralResponse.create(error_code=int(m.group(1)))
+
+        response = cls._parse_value(frame)
+        if response is None:
+            return cls._parse_grammar(frame)
+        return response
+
+    @classmethod
+    def _parse_value(cls, frame):
+        # the value is everything up to the terminator
+        m = cls.VALUE_FRAME.fullmatch(frame)
+        if m is None:
+            return None
+        return DataGeneralResponse.create(m.group(1).decode('ascii'))
+
+    @classmethod
+    def _parse_grammar(cls, frame):
+        data = bytes(frame).decode('ascii')
+        if not data.endswith(cls.TOKEN_NL):
+            data = data + cls.TOKEN_NL
+        return cls().parse(data)
+
 class DataGeneralResponse:
+    __slots__ = ('_has_error', '_has_data', '_error_code', '_v1', '_v2')
+
     def __init__(self, data):
         self._read(data)
 
+    @staticmethod
+    def create(v1=None, v2=None, error_code=None):
+        # response which was not parsed by the grammar
+        response = DataGeneralResponse.__new__(DataGeneralResponse)
+        response._has_error = error_code is not None
+        response._has_data = v1 is not None or error_code is not None
+        response._error_code = error_code
+        response._v1 = v1
+        response._v2 = v2
+        return response
+
     def _read(self, data):
         if data is None:
             self._has_error, self._has_data, self._error_code, self._v1, self._v2 = None, None, None, None, None
@@ -266,5 +476,20 @@ class DataGeneralResponse:
 
 
 class GrammarIntegerResponse(GrammarGeneralResponse):
+    # integer, optionally followed by a second value which is kept as string
+    VALUE_FRAME = re.compile(rb'(-?[0-9]+)([^\r]*)\r\n?')
+
     def _value_1_token(self):
         return IntegerToken(self.KEY_VALUE_1)
+
+    @classmethod
+    def _parse_value(cls, frame):
+        m = cls.VALUE_FRAME.fullmatch(frame)
+        if m is None:
+            return None
+        v2 = m.group(2)
+        return DataGeneralResponse.create(int(m.group(1)), v2.decode('ascii') if v2 else None)
+
+
+# response to writes, shared since responses are immutable
+EMPTY_RESPONSE = DataGeneralResponse.create()
@@ -0,0 +1,211 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from bisect import bisect_left
+
+# upper bounds in seconds, from 50 us up to 10 s. A 9600 baud frame takes about 10 ms on the line.
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """
+    Fixed bucket histogram. Observing a value is a binary search and two additions.
+    """
+    __slots__ = ('_bounds', '_counts', '_sum', '_count')
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self._bounds = tuple(bounds)
+        self._counts = [0] * (len(self._bounds) + 1)  # the last bucket is +Inf
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value):
+        self._counts[bisect_left(self._bounds, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    def get_bounds(self):
+        return self._bounds
+
+    def get_counts(self):
+        return list(self._counts)
+
+    def get_sum(self):
+        return self._sum
+
+    def get_count(self):
+        return self._count
+
+    def quantile(self, q):
+        # estimates the quantile as upper bound of the bucket containing it
+        if self._count == 0:
+            return None
+        rank = q * self._count
+        cumulative = 0
+        for bound, count in zip(self._bounds + (float('inf'),), self._counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def to_dict(self):
+        return {'count': self._count, 'sum': self._sum, 'buckets': list(zip(self._bounds, self._counts)),
+                'inf': self._counts[-1], 'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+
+class CommandMetrics(object):
+    STAGES = ('lock_wait', 'write', 'read', 'parse')
+
+    def __init__(self):
+        self.requests = 0
+        self.timeouts = 0
+        self.errors = {}
+        self.histograms = {stage: Histogram() for stage in self.STAGES}
+
+    def to_dict(self):
+        result = {'requests': self.requests, 'timeouts': self.timeouts, 'errors': dict(self.errors)}
+        for stage, histogram in self.histograms.items():
+            result[stage] = histogram.to_dict()
+        return result
+
+
+class ProtocolMetrics(object):
+    """
+    Collects per command (FL, PR, ST, ...) the time spent waiting for the transport lock, writing the message,
+    reading the response and parsing it, together with error and timeout counts.
+
+    The read time is measured until the complete response arrived; at 9600 baud a short response adds about
+    one millisecond per character to the time to the first byte.
+    """
+
+    def __init__(self):
+        self._commands = {}
+        self._lock = threading.Lock()
+
+    def _get(self, command) -> CommandMetrics:
+        metrics = self._commands.get(command)
+        if metrics is None:
+            with self._lock:
+                metrics = self._commands.setdefault(command, CommandMetrics())
+        return metrics
+
+    def observe(self, command, stage, seconds):
+        metrics = self._get(command)
+        with self._lock:
+            metrics.histograms[stage].observe(seconds)
+
+    def request(self, command):
+        metrics = self._get(command)
+        with self._lock:
+            metrics.requests += 1
+
+    def error(self, command, code):
+        metrics = self._get(command)
+        with self._lock:
+            metrics.errors[code] = metrics.errors.get(code, 0) + 1
+
+    def timeout(self, command):
+        metrics = self._get(command)
+        with self._lock:
+            metrics.timeouts += 1
+
+    def reset(self):
+        with self._lock:
+            self._commands = {}
+
+    def get_metrics(self):
+        with self._lock:
+            return {command: metrics.to_dict() for command, metrics in self._commands.items()}
+
+    def to_prometheus(self, prefix='mks647c'):
+        lines = []
+        with self._lock:
+            commands = sorted(self._commands.items())
+
+            lines.append('# TYPE {}_requests_total counter'.format(prefix))
+            for command, metrics in commands:
+                lines.append('{}_requests_total{{command="{}"}} {}'.format(prefix, command, metrics.requests))
+
+            lines.append('# TYPE {}_timeouts_total counter'.format(prefix))
+            for command, metrics in commands:
+                lines.append('{}_timeouts_total{{command="{}"}} {}'.format(prefix, command, metrics.timeouts))
+
+            lines.append('# TYPE {}_errors_total counter'.format(prefix))
+            for command, metrics in commands:
+                for code, count in sorted(metrics.errors.items(), key=lambda item: str(item[0])):
+                    lines.append('{}_errors_total{{command="{}",code="{}"}} {}'.format(prefix, command, code, count))
+
+            for stage in CommandMetrics.STAGES:
+                name = '{}_{}_seconds'.format(prefix, stage)
+                lines.append('# TYPE {} histogram'.format(name))
+                for command, metrics in commands:
+                    histogram = metrics.histograms[stage]
+                    cumulative = 0
+                    for bound, count in zip(histogram.get_bounds(), histogram.get_counts()):
+                        cumulative += count
+                        lines.append('{}_bucket{{command="{}",le="{}"}} {}'.format(name, command, bound, cumulative))
+                    lines.append('{}_bucket{{command="{}",le="+Inf"}} {}'.format(name, command,
+                                                                                  histogram.get_count()))
+                    lines.append('{}_sum{{command="{}"}} {}'.format(name, command, histogram.get_sum()))
+                    lines.append('{}_count{{command="{}"}} {}'.format(name, command, histogram.get_count()))
+
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer(object):
+    """
+    Serves the metrics in the Prometheus text format on http://host:port/metrics. Binds to localhost by default.
+    """
+
+    def __init__(self, metrics: ProtocolMetrics, port=9647, host='127.0.0.1'):
+        self._metrics = metrics
+        self._address = (host, port)
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        # imported here, http.server is expensive to import and only needed by the server
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self._metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(self._address, Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='MetricsServer', daemon=True)
+        self._thread.start()
+        return self._server.server_address
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server, self._thread = None, None
@@ -0,0 +1,189 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from mks647c.driver import MKS647CDriver
+from mks647c.storage import TimeSeriesWriter, PRESSURE_CHANNEL, INVALID_STATUS
+
+Samples = namedtuple('Samples', ['time', 'flow', 'pressure', 'status'])
+
+
+class MKS647CPoller(object):
+    """
+    Samples flow, pressure and status of the given channels on a background thread and stores the raw integer
+    values in a preallocated ring buffer. Consumers read from the buffer instead of polling the serial line.
+
+    Values which could not be read are stored as INVALID. If a log is given, every sample is appended to it as
+    well, the pressure under PRESSURE_CHANNEL. The log is flushed when the thread ends, closing it is left to the
+    caller.
+    """
+    INVALID = np.iinfo(np.int32).min
+
+    def __init__(self, driver: MKS647CDriver, channels=None, rate=1.0, capacity=3600, logger=None,
+                 log: TimeSeriesWriter = None):
+        if channels is None:
+            channels = range(MKS647CDriver.CHANNEL_MIN, MKS647CDriver.CHANNEL_MAX + 1)
+
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+
+        if logger is None:
+            logger = logging.getLogger(__name__)
+            logger.addHandler(logging.NullHandler())
+
+        self._driver = driver
+        self._channels = list(channels)
+        self._period = 1.0 / float(rate)
+        self._capacity = int(capacity)
+        self._logger = logger
+        self._log = log
+        self._log_channels = [PRESSURE_CHANNEL] + self._channels
+
+        self._time = np.full(self._capacity, np.nan, dtype=np.float64)
+        self._flow = np.full((self._capacity, len(self._channels)), self.INVALID, dtype=np.int32)
+        self._status = np.full((self._capacity, len(self._channels)), self.INVALID, dtype=np.int32)
+        self._pressure = np.full(self._capacity, self.INVALID, dtype=np.int32)
+        self._count = 0
+
+        self._requests = [(MKS647CDriver.CMD_PRESSURE, None, False)]
+        for channel in self._channels:
+            self._requests.append((MKS647CDriver.CMD_FLOW, channel, False))
+            self._requests.append((MKS647CDriver.CMD_STATUS, channel, False))
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get_channels(self):
+        return list(self._channels)
+
+    def get_capacity(self):
+        return self._capacity
+
+    def get_count(self):
+        return self._count
+
+    def start(self):
+        if self.is_running():
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='MKS647CPoller', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        next_tick = time.monotonic()
+        try:
+            while not self._stop.is_set():
+                self.poll()
+
+                # schedule against the monotonic clock, skipping ticks if a scan took longer than the period
+                next_tick = next_tick + self._period
+                now = time.monotonic()
+                if next_tick < now:
+                    next_tick = now + self._period - (now - next_tick) % self._period
+                self._stop.wait(next_tick - now)
+        finally:
+            if self._log is not None:
+                self._log.flush()
+
+    def poll(self):
+        """
+        Reads one sample of all channels in a single transaction and stores it in the buffer.
+        """
+        try:
+            raw = self._driver.get_raw_many(self._requests)
+        except Exception as e:
+            self._logger.warning("Poll failed: %s", repr(e))
+            raw = {}
+        timestamp = time.time()
+        if self._log is not None:
+            log_timestamp = self._log.timestamp()
+
+        with self._lock:
+            row = self._count % self._capacity
+            self._time[row] = timestamp
+            self._pressure[row] = raw.get(self._requests[0], self.INVALID)
+            for i, channel in enumerate(self._channels):
+                self._flow[row, i] = raw.get((MKS647CDriver.CMD_FLOW, channel, False), self.INVALID)
+                self._status[row, i] = raw.get((MKS647CDriver.CMD_STATUS, channel, False), self.INVALID)
+            self._count = self._count + 1
+
+            if self._log is not None:
+                status = np.where(self._status[row] == self.INVALID, INVALID_STATUS, self._status[row])
+                self._log.append_many(self._log_channels, [self._pressure[row]] + self._flow[row].tolist(),
+                                      [0] + status.tolist(), log_timestamp)
+
+    def _rows(self, start, stop):
+        # start and stop are absolute sample numbers. Returns views if the rows are contiguous in the buffer,
+        # otherwise the rows have to be copied.
+        first, last = start % self._capacity, stop % self._capacity
+        if stop - start == 0:
+            index = slice(0, 0)
+        elif first < last or last == 0:
+            index = slice(first, last if last > 0 else self._capacity)
+        else:
+            index = np.r_[first:self._capacity, 0:last]
+
+        return Samples(self._time[index], self._flow[index], self._pressure[index], self._status[index])
+
+    def latest(self):
+        """
+        Returns the newest sample as copy, or None if nothing was sampled yet.
+        """
+        with self._lock:
+            if self._count == 0:
+                return None
+            row = (self._count - 1) % self._capacity
+            return Samples(float(self._time[row]), self._flow[row].copy(), int(self._pressure[row]),
+                           self._status[row].copy())
+
+    def window(self, seconds):
+        """
+        Returns all samples of the last seconds, oldest first. The arrays are views into the buffer if the
+        window does not wrap around, hence they are overwritten once the poller wrapped around the buffer.
+        """
+        with self._lock:
+            stop = self._count
+            start = max(0, stop - self._capacity)
+            if stop == start:
+                return self._rows(start, stop)
+
+            since = self._time[(stop - 1) % self._capacity] - seconds
+            samples = self._rows(start, stop)
+            first = int(np.searchsorted(samples.time, since, side='left'))
+            return self._rows(start + first, stop)
+
+    def views(self):
+        """
+        Returns zero-copy views of the whole ring buffer together with the number of samples written so far.
+        The newest sample is at row (count - 1) % capacity.
+        """
+        return Samples(self._time, self._flow, self._pressure, self._status), self._count
@@ -0,0 +1,229 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from mks647c.driver import MKS647CDriver, BatchResult
+
+
+class PoolResult(BatchResult):
+    """
+    Result of a call on all controllers of a pool. The keys start with the name of the controller, e.g.
+    (controller, channel) for get_flows(). If a whole controller failed, its error is available from
+    get_controller_errors() and the errors of all its keys are set.
+
+    All controllers are started at get_timestamp(). get_times() holds the wall clock time at the middle of the
+    transaction of each controller, get_skew() the spread of these times.
+    """
+
+    def __init__(self, timestamp):
+        super(PoolResult, self).__init__()
+        self._timestamp = timestamp
+        self._times = {}
+        self._controller_errors = {}
+
+    def get_timestamp(self):
+        return self._timestamp
+
+    def get_times(self):
+        return self._times
+
+    def get_skew(self):
+        if not self._times:
+            return 0.0
+        return max(self._times.values()) - min(self._times.values())
+
+    def get_controller_errors(self):
+        return self._controller_errors
+
+
+class MKS647CPool(object):
+    """
+    Manages the drivers of several controllers on separate ports. Calls on the pool are executed on all
+    controllers at once, each controller has its own worker thread, so that calls to one port never wait for
+    another port. A call hence takes as long as the slowest controller, not the sum of all of them.
+
+    Calls on the drivers themselves remain possible, they are serialized by the transport lock as usual.
+    """
+
+    def __init__(self, drivers=None, logger=None):
+        """
+        :param drivers: dict mapping controller names to drivers, or a list of drivers named by their index
+        """
+        if logger is None:
+            logger = logging.getLogger(__name__)
+            logger.addHandler(logging.NullHandler())
+
+        self._logger = logger
+        self._drivers = OrderedDict()
+        self._executors = {}
+        self._lock = threading.Lock()
+
+        if drivers is None:
+            drivers = {}
+        elif not isinstance(drivers, dict):
+            drivers = OrderedDict(enumerate(drivers))
+
+        for name, driver in drivers.items():
+            self.add(name, driver)
+
+    @classmethod
+    def from_ports(cls, ports, logger=None, timeout=0.3):
+        """
+        Creates a driver for each port with MKS647CFactory, named by the port. The ports are opened on first use.
+        """
+        from mks647c.factory import MKS647CFactory
+
+        factory = MKS647CFactory()
+        drivers = OrderedDict((port, factory.create_device(device=port, logger=logger, timeout=timeout))
+                              for port in ports)
+        return cls(drivers, logger=logger)
+
+    def add(self, name, driver: MKS647CDriver):
+        with self._lock:
+            if name in self._drivers:
+                raise RuntimeError("Controller {} already exists".format(name))
+            self._drivers[name] = driver
+            self._executors[name] = ThreadPoolExecutor(max_workers=1,
+                                                       thread_name_prefix='MKS647CPool-{}'.format(name))
+
+    def remove(self, name):
+        with self._lock:
+            self._drivers.pop(name)
+            executor = self._executors.pop(name)
+        executor.shutdown(wait=True)
+
+    def get_driver(self, name) -> MKS647CDriver:
+        return self._drivers[name]
+
+    def get_controllers(self):
+        return list(self._drivers)
+
+    def __len__(self):
+        return len(self._drivers)
+
+    @staticmethod
+    def _timed(fn, driver):
+        start = time.time()
+        result = fn(driver)
+        return result, (start + time.time()) / 2.0
+
+    def map(self, fn):
+        """
+        Calls fn(driver) for every controller at once and waits for all of them.
+        :return: (timestamp, dict controller -> (result, time) or exception), the timestamp at the start of the
+        calls and the wall clock time at the middle of each call
+        """
+        with self._lock:
+            controllers = [(name, self._drivers[name], self._executors[name]) for name in self._drivers]
+
+        timestamp = time.time()
+        futures = [(name, executor.submit(self._timed, fn, driver)) for name, driver, executor in controllers]
+
+        results = OrderedDict()
+        for name, future in futures:
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                self._logger.warning("Controller %s failed: %s", name, repr(e))
+                results[name] = e
+        return timestamp, results
+
+    @staticmethod
+    def _key(name, key):
+        return (name,) + (key if isinstance(key, tuple) else (key,))
+
+    def _collect(self, timestamp, results, keys=None):
+        """
+        :param keys: keys of the batch result of each controller, e.g. the channels. If given, the batch results
+        are merged into one result keyed by (controller,) + key, otherwise the result is keyed by controller.
+        """
+        result = PoolResult(timestamp)
+        for name, outcome in results.items():
+            if isinstance(outcome, Exception):
+                result.get_controller_errors()[name] = outcome
+                if keys is None:
+                    result.set_error(name, outcome)
+                for key in keys or []:
+                    result.set_error(self._key(name, key), outcome)
+                continue
+
+            value, result.get_times()[name] = outcome
+            if keys is None:
+                result[name] = value
+                continue
+            for key, item in value.items():
+                result[self._key(name, key)] = item
+            for key, error in value.get_errors().items():
+                result.set_error(self._key(name, key), error)
+        return result
+
+    def call(self, method, *args, **kwargs):
+        """
+        Calls a method of the driver on all controllers, e.g. call('get_pressure').
+        :return: PoolResult mapping each controller to the return value
+        """
+        timestamp, results = self.map(lambda driver: getattr(driver, method)(*args, **kwargs))
+        return self._collect(timestamp, results)
+
+    def get_raw_many(self, requests):
+        """
+        Reads the same requests (cmd, channel, enable_query_token) from all controllers, each in one transaction.
+        :return: PoolResult mapping (controller, cmd, channel, enable_query_token) to the raw value
+        """
+        requests = [tuple(request) for request in requests]
+        timestamp, results = self.map(lambda driver: driver.get_raw_many(requests))
+        return self._collect(timestamp, results, requests)
+
+    def _get_many(self, method, channels):
+        if channels is None:
+            channels = range(MKS647CDriver.CHANNEL_MIN, MKS647CDriver.CHANNEL_MAX + 1)
+        channels = list(channels)
+        timestamp, results = self.map(lambda driver: getattr(driver, method)(channels))
+        return self._collect(timestamp, results, channels)
+
+    def get_flows(self, channels=None):
+        """
+        Reads the flows of the given channels of all controllers.
+        :return: PoolResult mapping (controller, channel) to the flow
+        """
+        return self._get_many('get_flows', channels)
+
+    def get_setpoints(self, channels=None):
+        return self._get_many('get_setpoints', channels)
+
+    def get_status_flags(self, channels=None):
+        return self._get_many('get_status_flags', channels)
+
+    def get_pressures(self):
+        # maps each controller to its pressure reading
+        return self.call('get_pressure')
+
+    def close(self):
+        # waits for running calls, the drivers are not closed
+        with self._lock:
+            executors = list(self._executors.values())
+        for executor in executors:
+            executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -14,17 +14,154 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import threading
+import time
+import weakref
+from contextlib import contextmanager, nullcontext
 
-import e21_util
-from e21_util.lock import InterProcessTransportLock
-from mks647c.message import AbstractMessage, GrammarChannelMessage, GrammarGeneralResponse
-from mks647c.message import GrammarChannelMessage
+from mks647c.message import AbstractMessage
+from mks647c.framing import FrameReader
+from mks647c.metrics import ProtocolMetrics
+from mks647c.retry import RetryPolicy, CircuitBreaker
+from mks647c.timing import AdaptiveTiming
+from mks647c.tracing import Tracer
+
+
+_lock_class = None
+
+
+def _transport_lock(transport):
+    # the inter process lock of the transport, e21_util is imported on first use
+    global _lock_class
+    if _lock_class is None:
+        from e21_util.lock import InterProcessTransportLock
+        _lock_class = InterProcessTransportLock
+    return _lock_class(transport)
 
 
 class ResponseError(RuntimeError):
+    def __init__(self, message, code=None):
+        super(ResponseError, self).__init__(message)
+        self.code = code  # error code sent by the device, None if the error was not reported by the device
+
+
+class ResponseTimeoutError(ResponseError):
+    pass
+
+
+class CircuitOpenError(ResponseTimeoutError):
+    # the device did not respond to the last commands, the call was not sent
+    pass
+
+
+class ChannelError(ResponseError):
+    pass
+
+
+class UnknownCommandError(ResponseError):
+    pass
+
+
+class CommandSyntaxError(ResponseError):
+    pass
+
+
+class InvalidExpressionError(ResponseError):
+    pass
+
+
+class InvalidValueError(ResponseError):
+    pass
+
+
+class AutozeroError(ResponseError):
     pass
 
+
+ERROR_MESSAGES = {
+    0: "Channel error: No Channel or unknown channel was specified",
+    1: "An unknown command was transmitted",
+    2: "Syntax error, invalid command length",
+    3: "Invalid expression given in message",
+    4: "Invalid value given in message",
+    5: "Autozero error. Channel was not switched off?",
+}
+
+# exception raised for each error code of the device
+ERRORS = {
+    0: ChannelError,
+    1: UnknownCommandError,
+    2: CommandSyntaxError,
+    3: InvalidExpressionError,
+    4: InvalidValueError,
+    5: AutozeroError,
+}
+
+
+def is_transient(error):
+    """
+    Tells whether sending the command again might succeed: the response got lost or garbled, or the device got a
+    garbled command. Errors which the device reported for a valid frame, e.g. an invalid value, are permanent.
+    """
+    if isinstance(error, ResponseTimeoutError):
+        return not isinstance(error, CircuitOpenError)
+    return isinstance(error, ResponseError) and (error.code is None or error.code in AdaptiveTiming.OVERRUN_ERRORS)
+
+
+class TransportSession(object):
+    """
+    Holds the transport lock for a block of commands, see MKS647CProtocol.session().
+
+    If the lock was held longer than max_hold seconds, it is released and acquired again before the next command,
+    so that other processes (e.g. a poller) get the line in between. Commands are only guaranteed not to be
+    interleaved with other traffic within max_hold. A max_hold of None never releases the lock.
+    """
+
+    def __init__(self, transport, max_hold=None):
+        self._transport = transport
+        self._max_hold = max_hold
+        self._lock = None
+        self._since = None
+        self._yields = 0
+
+    def get_max_hold(self):
+        return self._max_hold
+
+    def get_yields(self):
+        # number of times the lock was released because max_hold was exceeded
+        return self._yields
+
+    def acquire(self):
+        self._lock = _transport_lock(self._transport)
+        self._lock.__enter__()
+        self._since = time.monotonic()
+
+    def release(self):
+        lock, self._lock = self._lock, None
+        lock.__exit__(None, None, None)
+
+    def checkpoint(self):
+        # called before each command of the session
+        if self._max_hold is not None and time.monotonic() - self._since > self._max_hold:
+            self.release()
+            time.sleep(0)  # let waiting threads take the lock
+            self.acquire()
+            self._yields = self._yields + 1
+
+
 class MKS647CProtocol:
+    # number of queries written ahead of the response which is currently read in query_many
+    PIPELINE_DEPTH = 8
+
+    # query_many waits once for the lock, the wait is recorded under this command
+    METRICS_BATCH = 'batch'
+
+    # default for the maximal time a session holds the transport lock at once, in seconds
+    SESSION_MAX_HOLD = 1.0
+
+    # longest time to wait for the line to become quiet after a lost or garbled response, in seconds
+    RESYNC_LIMIT = 2.0
+
     def __init__(self, logger=None):
 
         if logger is None:
@@ -32,14 +169,252 @@ class MKS647CProtocol:
             logger.addHandler(logging.NullHandler())
 
         self._logger = logger
+        self._pipeline_depth = self.PIPELINE_DEPTH
+        self._metrics = ProtocolMetrics()
+        self._timing = AdaptiveTiming()
+        self._tracer = None
+        self._retry = RetryPolicy()
+        self._breaker_failures = 5
+        self._breaker_reset = 2.0
+        self._breakers = weakref.WeakKeyDictionary()
+        self._readers = weakref.WeakKeyDictionary()
+        self._session_max_hold = self.SESSION_MAX_HOLD
+        self._local = threading.local()  # sessions of the current thread, by transport
+
+    def get_reader(self, transport) -> FrameReader:
+        # the reader keeps partial frames between calls, hence there is one per transport
+        reader = self._readers.get(transport)
+        if reader is None:
+            reader = FrameReader(transport)
+            self._readers[transport] = reader
+            if self._timing is not None and not reader.has_timeout():
+                self._logger.warning('The transport has no settable timeout, responses are awaited for the timeout '
+                                     'of the transport instead of the learned timeouts')
+        return reader
+
+    def set_session_max_hold(self, seconds):
+        self._session_max_hold = seconds
+
+    def get_session_max_hold(self):
+        return self._session_max_hold
+
+    def _get_sessions(self):
+        sessions = getattr(self._local, 'sessions', None)
+        if sessions is None:
+            sessions = self._local.sessions = {}
+        return sessions
+
+    def get_session(self, transport):
+        # the session of the current thread on the transport, None if there is none
+        return self._get_sessions().get(id(transport))
+
+    @contextmanager
+    def session(self, transport, max_hold=None):
+        """
+        Holds the transport lock until the block is left. Commands of the current thread within the block do
+        not lock the transport again. Sessions are re-entrant, a nested session joins the outer one.
+        :param max_hold: see TransportSession, defaults to the session max hold of the protocol
+        """
+        sessions = self._get_sessions()
+        session = sessions.get(id(transport))
+        if session is not None:
+            yield session
+            return
+
+        session = TransportSession(transport, self._session_max_hold if max_hold is None else max_hold)
+        start = time.perf_counter()
+        session.acquire()
+        self._trace_lock(start)
+        sessions[id(transport)] = session
+        try:
+            yield session
+        finally:
+            del sessions[id(transport)]
+            session.release()
+
+    def _locked(self, transport):
+        # locks the transport, unless the current thread holds it in a session
+        session = self.get_session(transport)
+        if session is None:
+            return _transport_lock(transport)
+        session.checkpoint()
+        return nullcontext()
 
     def clear(self, transport):
-        with InterProcessTransportLock(transport):  # lock and then unlock afterwards
+        with self._locked(transport):  # lock and then unlock afterwards
+            return self._resync(transport)
+
+    def _quiet_time(self, transport, command=None):
+        # no response arrives later than the timeout of its command
+        if self._timing is not None:
+            return self._timing.get_timeout(command)
+        timeout = getattr(transport, 'timeout', None)
+        return AdaptiveTiming.DEFAULT_TIMEOUT if timeout is None else timeout
+
+    def _resync(self, transport, command=None):
+        """
+        Drops all input until the line was quiet for the response time of the command, including responses which
+        are still in flight. Has to be called after a lost or garbled response, before the next command is written.
+        :return: False if bytes still arrived after RESYNC_LIMIT seconds
+        """
+        reader = self.get_reader(transport)
+        dropped = reader.get_dropped()
+        quiet = reader.discard_until_quiet(self._quiet_time(transport, command), self.RESYNC_LIMIT)
+        if reader.get_dropped() > dropped:
+            self._logger.debug('Dropped %d frame(s) to resynchronize', reader.get_dropped() - dropped)
+        if not quiet:
+            self._logger.warning('The line did not become quiet within %.1f s', self.RESYNC_LIMIT)
+        return quiet
+
+    def _sync(self, transport):
+        # drops stale responses before a command is written
+        dropped = self.get_reader(transport).sync()
+        if dropped:
+            self._logger.debug('Dropped %d stale frame(s)', dropped)
+
+    def set_pipeline_depth(self, depth):
+        if int(depth) < 1:
+            raise ValueError("Pipeline depth must be at least 1")
+        self._pipeline_depth = int(depth)
+
+    def get_pipeline_depth(self):
+        return self._pipeline_depth
+
+    def set_metrics(self, metrics: ProtocolMetrics):
+        # None disables the metrics
+        self._metrics = metrics
+
+    def get_metrics(self):
+        if self._metrics is None:
+            return {}
+        return self._metrics.get_metrics()
+
+    def get_metrics_collector(self) -> ProtocolMetrics:
+        return self._metrics
+
+    def set_timing(self, timing: AdaptiveTiming):
+        # None disables adaptive timeouts and pacing, the timeout of the transport is used
+        self._timing = timing
+
+    def get_timing(self) -> AdaptiveTiming:
+        return self._timing
+
+    def set_tracer(self, tracer: Tracer):
+        # None disables tracing
+        self._tracer = tracer
+
+    def get_tracer(self) -> Tracer:
+        return self._tracer
+
+    def _trace_lock(self, start):
+        if self._tracer is not None:
+            self._tracer.record('lock', start, time.perf_counter())
+
+    def set_retry_policy(self, policy: RetryPolicy):
+        # None disables retries
+        self._retry = policy
+
+    def get_retry_policy(self) -> RetryPolicy:
+        return self._retry
+
+    def set_circuit_breaker(self, failures=5, reset_timeout=2.0):
+        # failures None disables the circuit breaker
+        self._breaker_failures = failures
+        self._breaker_reset = reset_timeout
+        self._breakers = weakref.WeakKeyDictionary()
+
+    def get_circuit_breaker(self, transport) -> CircuitBreaker:
+        if self._breaker_failures is None:
+            return None
+        breaker = self._breakers.get(transport)
+        if breaker is None:
+            breaker = CircuitBreaker(self._breaker_failures, self._breaker_reset)
+            self._breakers[transport] = breaker
+        return breaker
+
+    def _check_breaker(self, transport):
+        breaker = self.get_circuit_breaker(transport)
+        if breaker is not None and breaker.is_open():
+            raise CircuitOpenError("The device does not respond, not sending the command")
+        return breaker
+
+    @staticmethod
+    def _record(breaker, error=None):
+        # any response shows that the device is alive, only a missing response or a failing transport count
+        if breaker is None:
+            return
+        if error is None or (isinstance(error, ResponseError) and not isinstance(error, ResponseTimeoutError)):
+            breaker.success()
+        else:
+            breaker.failure()
+
+    @staticmethod
+    def _is_transient(error):
+        return is_transient(error)
+
+    @staticmethod
+    def _is_uncertain(error):
+        # no response or an unknown frame, the responses which follow might belong to an earlier command
+        return not isinstance(error, ResponseError) or (error.code is None and not isinstance(error, CircuitOpenError))
+
+    def _may_retry(self, msg: AbstractMessage, error, attempt, deadline):
+        policy = self._retry
+        return (policy is not None and attempt < policy.get_attempts() and time.perf_counter() < deadline and
+                msg.is_query() and policy.is_idempotent(msg.get_command()) and self._is_transient(error))
+
+    def _deadline(self):
+        if self._retry is None:
+            return None
+        return time.perf_counter() + self._retry.get_deadline()
+
+    def _retry_exchange(self, transport, msg: AbstractMessage, error, attempt, deadline):
+        """
+        Sends an idempotent query again after a transient error, until it succeeds, the attempts are used up or
+        the deadline passed. The line has to be in sync: after a lost or garbled response it is resynchronized
+        before the next attempt, if it does not become quiet the query is not sent again.
+        """
+        breaker = self.get_circuit_breaker(transport)
+        while self._may_retry(msg, error, attempt, deadline) and not (breaker is not None and breaker.is_open()):
+            attempt = attempt + 1
+            self._logger.debug('Retry %d after %s', attempt, repr(error))
             try:
-                while True:
-                    transport.read_bytes(10)
-            except:
-                return
+                response = self._exchange(transport, msg, 'Retry', time.perf_counter(),
+                                          deadline - time.perf_counter())
+            except ResponseError as e:
+                self._record(breaker, e)
+                error = e
+                if self._is_uncertain(e) and not self._resync(transport, msg.get_command()):
+                    break
+                continue
+            self._record(breaker)
+            return response
+        raise error
+
+    def _call(self, transport, msg: AbstractMessage, kind, locked_since):
+        # has to be called with the transport lock held
+        breaker = self._check_breaker(transport)
+        deadline = self._deadline()
+        try:
+            # the first attempt waits for the full timeout, e.g. of a reset
+            response = self._exchange(transport, msg, kind, locked_since)
+        except ResponseError as e:
+            self._record(breaker, e)
+            # a late response would be read by the next command
+            if self._is_uncertain(e) and not self._resync(transport, msg.get_command()):
+                raise
+            if deadline is None:
+                raise
+            return self._retry_exchange(transport, msg, e, 1, deadline)
+        self._record(breaker)
+        return response
+
+    def _pace(self, transport):
+        # waits for the learned gap since the last activity on the line
+        gap = self._timing.get_gap()
+        if gap > 0:
+            wait = self.get_reader(transport).get_last_activity() + gap - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
 
     def create_message(self, msg: AbstractMessage):
         raw_msg = msg.generate()
@@ -49,43 +424,222 @@ class MKS647CProtocol:
         self._logger = logger
 
     def parse_response(self, raw_response, cls):
+        # raw_response is a frame as bytes or memoryview, or a string which is parsed by the grammar
         try:
-            response = cls().parse(raw_response)
-        except:
-            # TODO: ALEX: do not catch all exceptions, only exceptions from parsing.
+            if isinstance(raw_response, str):
+                response = cls().parse(raw_response)
+            else:
+                response = cls.parse_bytes(raw_response)
+        except UnicodeDecodeError:
+            raise ResponseError("Could not parse message")
+
+        if response.has_data() is None:
+            # the grammar did not match
             raise ResponseError("Could not parse message")
 
         if response.has_error():
-            if response.get_error_code() == 0:
-                raise ResponseError("Channel error: No Channel or unknown channel was specified")
-            if response.get_error_code() == 1:
-                raise ResponseError("An unknown command was transmitted")
-            if response.get_error_code() == 2:
-                raise ResponseError("Syntax error, invalid command length")
-            if response.get_error_code() == 3:
-                raise ResponseError("Invalid expression given in message")
-            if response.get_error_code() == 4:
-                raise ResponseError("Invalid value given in message")
-            if response.get_error_code() == 5:
-                raise ResponseError("Autozero error. Channel was not switched off?")
-
-            raise ResponseError("Received an unknown error from the device")
+            code = response.get_error_code()
+            raise ERRORS.get(code, ResponseError)(ERROR_MESSAGES.get(code, "Received an unknown error from the device"),
+                                                   code)
+
+        return response
 
     def read_response(self, transport, msg: AbstractMessage):
-        response = transport.read_until(bytes(GrammarChannelMessage.TOKEN_NL, 'ascii'))
+        return self.handle_response(self.get_reader(transport).read_frame(), msg)
+
+    def handle_response(self, response: bytes, msg: AbstractMessage):
+        # response is a frame with or without the terminating LF
         self._logger.debug('Response: %s', repr(response))
-        return self.parse_response(response.decode('ascii') + "\n", msg.get_response_class())
+        if len(response) == 0:
+            raise ResponseTimeoutError("No response from the device")
+        return self.parse_response(response, msg.get_response_class())
 
-    def query(self, transport, msg: AbstractMessage):
-        with InterProcessTransportLock(transport):
+    def _read_measured(self, transport, msg: AbstractMessage, since, timeout=None):
+        # since: time at which the message was written, timeout: upper bound of the timeout
+        command = msg.get_command()
+        metrics, timing, tracer = self._metrics, self._timing, self._tracer
+        if timing is not None:
+            timeout = timing.get_timeout(command) if timeout is None else min(timeout, timing.get_timeout(command))
+        if tracer is not None:
+            reading = time.perf_counter()
+        response = self.get_reader(transport).read_frame(timeout)
+        received = time.perf_counter()
+        if metrics is not None:
+            metrics.observe(command, 'read', received - since)
+        if tracer is not None:
+            tracer.record('read', reading, received, command=command, bytes=len(response))
+        try:
+            response = self.handle_response(response, msg)
+        except ResponseTimeoutError:
+            if metrics is not None:
+                metrics.timeout(command)
+            if timing is not None:
+                timing.timeout(command)
+            raise
+        except ResponseError as e:
+            if metrics is not None:
+                metrics.error(command, 'parse' if e.code is None else e.code)
+            if timing is not None:
+                timing.error(command, e.code)
+            raise
+        finally:
+            if metrics is not None:
+                metrics.observe(command, 'parse', time.perf_counter() - received)
+            if tracer is not None:
+                tracer.record('parse', received, time.perf_counter(), command=command)
+
+        if timing is not None:
+            timing.observe(command, received - since)
+        return response
+
+    def _write_measured(self, transport, msg: AbstractMessage, raw_msg):
+        command = msg.get_command()
+        metrics = self._metrics
+        if self._timing is not None:
+            self._pace(transport)
+        if metrics is not None:
+            metrics.request(command)
+        start = time.perf_counter()
+        transport.write(raw_msg)
+        written = time.perf_counter()
+        self.get_reader(transport).touch()
+        if metrics is not None:
+            metrics.observe(command, 'write', written - start)
+        if self._tracer is not None:
+            self._tracer.record('write', start, written, command=command, bytes=len(raw_msg))
+        return written
+
+    def _exchange(self, transport, msg: AbstractMessage, kind, locked_since, timeout=None):
+        # has to be called with the transport lock held
+        if self._tracer is None:
             raw_str_msg = self.create_message(msg)
-            self._logger.debug('Query: %s', repr(raw_str_msg))
-            transport.write(raw_str_msg)
-            return self.read_response(transport, msg)
+        else:
+            start = time.perf_counter()
+            raw_str_msg = self.create_message(msg)
+            self._tracer.record('generate', start, time.perf_counter(), command=msg.get_command())
+        self._logger.debug('%s: %s', kind, repr(raw_str_msg))
+        self._sync(transport)
+
+        if self._metrics is not None:
+            self._metrics.observe(msg.get_command(), 'lock_wait', time.perf_counter() - locked_since)
+        written = self._write_measured(transport, msg, raw_str_msg)
+        return self._read_measured(transport, msg, written, timeout)
+
+    def query(self, transport, msg: AbstractMessage):
+        start = time.perf_counter()
+        with self._locked(transport):
+            if self._tracer is not None:
+                self._trace_lock(start)
+            return self._call(transport, msg, 'Query', start)
 
     def write(self, transport, msg: AbstractMessage):
-        with InterProcessTransportLock(transport):
-            raw_str_msg = self.create_message(msg)
-            self._logger.debug('Write: %s', repr(raw_str_msg))
-            transport.write(raw_str_msg)
-            return self.read_response(transport, msg)
+        start = time.perf_counter()
+        with self._locked(transport):
+            if self._tracer is not None:
+                self._trace_lock(start)
+            return self._call(transport, msg, 'Write', start)
+
+    def query_many(self, transport, msgs):
+        """
+        Sends all messages while holding the transport lock once. Up to the pipeline depth, queries are written
+        before the previous responses were read.
+
+        Errors do not abort the batch: the returned list contains either the response or the exception for each
+        message. An error response of the device keeps the responses in order. After a lost or garbled response,
+        the frames still owed are dropped and the line is resynchronized. If fewer frames arrived than were owed,
+        a response got lost earlier, and the responses which were read while the message was in flight are dropped
+        as well, since they may belong to the message before them. Dropped messages fail with a
+        ResponseTimeoutError, the remaining messages are sent one by one.
+
+        Writes are never sent twice. Idempotent queries which failed are retried by the retry policy once the batch
+        is done.
+        :return: list
+        """
+        msgs = list(msgs)
+        start = time.perf_counter()
+        frames = [self.create_message(msg) for msg in msgs]
+        if self._tracer is not None:
+            self._tracer.record('generate', start, time.perf_counter(), count=len(msgs))
+        written_at = [None] * len(msgs)
+        results = [None] * len(msgs)
+        in_flight = [0] * len(msgs)  # number of messages written when the response was read
+        retries = []
+        depth = self._pipeline_depth
+        metrics = self._metrics
+
+        start = time.perf_counter()
+        with self._locked(transport):
+            self._trace_lock(start)
+            if metrics is not None:
+                metrics.observe(self.METRICS_BATCH, 'lock_wait', time.perf_counter() - start)
+            breaker = self._check_breaker(transport)
+            self._sync(transport)
+
+            written = 0
+            last_read = 0.0
+            for i, msg in enumerate(msgs):
+                if results[i] is not None:
+                    # dropped while resynchronizing
+                    continue
+                if breaker is not None and breaker.is_open():
+                    # opened by errors of this batch, nothing is in flight after the resynchronization
+                    results[i] = CircuitOpenError("The device does not respond, not sending the command")
+                    written = i + 1
+                    continue
+
+                while written < min(i + depth, len(frames)):
+                    self._logger.debug('Query: %s', repr(frames[written]))
+                    written_at[written] = self._write_measured(transport, msgs[written], frames[written])
+                    written = written + 1
+
+                in_flight[i] = written
+                try:
+                    # the response time starts when the device could answer: a response waits in the pipeline
+                    # until the previous one was sent
+                    results[i] = self._read_measured(transport, msg, max(written_at[i], last_read))
+                    self._record(breaker)
+                    continue
+                except Exception as e:
+                    self._logger.debug('Batch error: %s', repr(e))
+                    self._record(breaker, e)
+                    results[i] = e
+                finally:
+                    last_read = time.perf_counter()
+
+                if not self._is_uncertain(results[i]):
+                    retries.append(i)
+                    continue
+
+                # the frames still owed are dropped, one more if the response of this message was only late
+                for j in range(i + 1, written):
+                    results[j] = ResponseTimeoutError("Response dropped to resynchronize after a lost response")
+                reader = self.get_reader(transport)
+                dropped = reader.get_dropped()
+                quiet = self._resync(transport, msg.get_command())
+                owed = written - i - (0 if isinstance(results[i], ResponseTimeoutError) else 1)
+                if reader.get_dropped() - dropped != owed:
+                    # a response got lost before, the responses read while this message was in flight may belong
+                    # to the message before them
+                    for j in range(i):
+                        if in_flight[j] > i:
+                            results[j] = ResponseTimeoutError("Response dropped, it might belong to another message")
+                            retries.append(j)
+                retries.extend(range(i, written))
+                depth = 1
+                if not quiet:
+                    # the number of unanswered frames is unknown, the remaining messages are not sent
+                    for j in range(written, len(msgs)):
+                        results[j] = ResponseError("The line did not become quiet, not sending the command")
+                    retries = []
+                    break
+
+            for i in sorted(set(retries)):
+                deadline = self._deadline()
+                if deadline is None or not self._may_retry(msgs[i], results[i], 1, deadline):
+                    continue
+                try:
+                    results[i] = self._retry_exchange(transport, msgs[i], results[i], 1, deadline)
+                except Exception as e:
+                    results[i] = e
+
+        return results
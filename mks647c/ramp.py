@@ -0,0 +1,219 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+
+from mks647c.driver import MKS647CDriver
+
+# target of a ramp which is not a flow channel
+PRESSURE = 'pressure'
+
+
+class LinearProfile(object):
+    def __init__(self, start, stop, duration):
+        if duration <= 0:
+            raise ValueError("Duration must be positive")
+        self._start = float(start)
+        self._stop = float(stop)
+        self._duration = float(duration)
+
+    def get_duration(self):
+        return self._duration
+
+    def values(self, times):
+        # setpoints (0 .. 1.1) at the given times since the start of the ramp
+        fraction = np.clip(np.asarray(times, dtype=np.float64) / self._duration, 0.0, 1.0)
+        return self._start + (self._stop - self._start) * fraction
+
+
+class ExponentialProfile(LinearProfile):
+    """
+    Approaches stop with the time constant tau, scaled such that stop is reached at the end of the ramp.
+    The default tau is a third of the duration.
+    """
+
+    def __init__(self, start, stop, duration, tau=None):
+        super(ExponentialProfile, self).__init__(start, stop, duration)
+        self._tau = duration / 3.0 if tau is None else float(tau)
+        if self._tau <= 0:
+            raise ValueError("Tau must be positive")
+
+    def values(self, times):
+        times = np.clip(np.asarray(times, dtype=np.float64), 0.0, self._duration)
+        fraction = -np.expm1(-times / self._tau) / -math.expm1(-self._duration / self._tau)
+        return self._start + (self._stop - self._start) * fraction
+
+
+class PiecewiseProfile(object):
+    """
+    Linear interpolation between points (time, setpoint), the first point at time 0.
+    """
+
+    def __init__(self, points):
+        points = sorted(points)
+        if len(points) < 2 or points[0][0] != 0:
+            raise ValueError("At least two points are needed, the first one at time 0")
+        self._times = np.array([t for t, _ in points], dtype=np.float64)
+        self._setpoints = np.array([v for _, v in points], dtype=np.float64)
+
+    def get_duration(self):
+        return float(self._times[-1])
+
+    def values(self, times):
+        return np.interp(times, self._times, self._setpoints)
+
+
+class RampEngine(object):
+    """
+    Ramps the setpoints of many channels (and the pressure setpoint) in step.
+
+    The raw setpoints of all ticks are computed and validated before the ramp starts. Each tick writes the
+    changed setpoints of all channels in one transaction (a single lock and pipelined writes). Ticks are
+    scheduled on the monotonic clock relative to the start, so timing does not drift. The burst is sent early by
+    the measured write latency, so that the values arrive at the device on time. If the engine falls behind,
+    late ticks are skipped and the newest due values are written instead. Failed writes are sent again with the
+    next tick unless it brings a newer value for the channel, those of the last tick once after the ramp.
+    """
+
+    def __init__(self, driver: MKS647CDriver, period=0.1, logger=None, clock=time.monotonic):
+        if period <= 0:
+            raise ValueError("Period must be positive")
+
+        if logger is None:
+            logger = logging.getLogger(__name__)
+            logger.addHandler(logging.NullHandler())
+
+        self._driver = driver
+        self._period = float(period)
+        self._logger = logger
+        self._clock = clock
+        self._profiles = {}
+        self._stop = threading.Event()
+        self._latency = 0.0
+
+    def add(self, channel, profile):
+        """
+        :param channel: channel 1..8 or PRESSURE
+        """
+        if channel != PRESSURE and channel not in range(MKS647CDriver.CHANNEL_MIN, MKS647CDriver.CHANNEL_MAX + 1):
+            raise RuntimeError("Given channel %s invalid." % str(channel))
+        self._profiles[channel] = profile
+
+    def get_latency(self):
+        # estimated duration of a burst, in seconds
+        return self._latency
+
+    def stop(self):
+        # stops a running ramp after the current tick
+        self._stop.set()
+
+    def schedule(self):
+        """
+        :return: (times, requests), the tick times since the start and per tick the list of write requests
+        (cmd, channel, raw setpoint) of the channels whose setpoint changed
+        """
+        if not self._profiles:
+            raise RuntimeError("No profiles added")
+
+        duration = max(profile.get_duration() for profile in self._profiles.values())
+        count = int(math.ceil(duration / self._period - 1e-9)) + 1
+        times = np.minimum(np.arange(count) * self._period, duration)
+
+        requests = [[] for _ in range(count)]
+        for channel, profile in sorted(self._profiles.items(), key=lambda item: str(item[0])):
+            raw = [MKS647CDriver._to_raw_setpoint(value) for value in profile.values(times)]
+            invalid = [value for value in raw if value not in range(MKS647CDriver.SETPOINT_MIN,
+                                                                     MKS647CDriver.SETPOINT_MAX + 1)]
+            if invalid:
+                raise RuntimeError("Given setpoint %s invalid." % str(invalid[0]))
+
+            if channel == PRESSURE:
+                cmd, target = MKS647CDriver.CMD_PRESSURE, None
+            else:
+                cmd, target = MKS647CDriver.CMD_SETPOINT, channel
+
+            previous = None
+            for tick, value in enumerate(raw):
+                if value != previous:
+                    requests[tick].append((cmd, target, value))
+                previous = value
+
+        return times, requests
+
+    def _write(self, requests):
+        start = self._clock()
+        result = self._driver.set_raw_many(requests)
+        elapsed = self._clock() - start
+        # moving average of the burst duration
+        self._latency = elapsed if self._latency == 0.0 else 0.8 * self._latency + 0.2 * elapsed
+        return result
+
+    def _write_pending(self, pending, report):
+        # returns the failed requests, by target
+        result = self._write(list(pending.values()))
+        errors = result.get_errors()
+        for request in pending.values():
+            if request in errors:
+                report['errors'][request] = errors[request]
+            else:
+                report['errors'].pop(request, None)
+        return {request[:2]: request for request in errors}
+
+    def run(self):
+        """
+        Runs the ramp, blocking until it is finished or stopped.
+        :return: dict with the number of written and skipped ticks, the maximal lag of a burst behind its tick
+        and the errors per request which was not written later on
+        """
+        times, requests = self.schedule()
+        self._stop.clear()
+        report = {'ticks': 0, 'skipped': 0, 'max_lag': 0.0, 'errors': {}}
+        pending = {}  # newest requests of skipped ticks and failed writes, by target
+
+        start = self._clock()
+        for tick in range(len(times)):
+            if self._stop.is_set():
+                break
+
+            for request in requests[tick]:
+                pending[request[:2]] = request
+
+            due = start + float(times[tick])
+            if tick + 1 < len(times) and self._clock() >= start + float(times[tick + 1]) - self._latency:
+                # already late for the next tick, its values supersede this one
+                report['skipped'] = report['skipped'] + 1
+                continue
+
+            wait = due - self._latency - self._clock()
+            if wait > 0 and self._stop.wait(wait):
+                break
+
+            if pending:
+                pending = self._write_pending(pending, report)
+            report['ticks'] = report['ticks'] + 1
+            report['max_lag'] = max(report['max_lag'], self._clock() - due)
+
+        if pending and not self._stop.is_set():
+            # the final setpoints are not written otherwise
+            self._write_pending(pending, report)
+
+        if report['errors']:
+            self._logger.warning("Ramp finished with %d failed writes", len(report['errors']))
+        return report
@@ -0,0 +1,82 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+
+class RetryPolicy(object):
+    """
+    Queries which failed transiently (no response, garbled response) are sent again, up to attempts times in
+    total and within deadline seconds since the call started. Before a query is sent again, the line has to be
+    quiet, so that a late response is not taken for the response of the retry. Writes are never retried: the
+    device might have applied a write whose response got lost.
+    """
+
+    # queries with side effects: zero adjust of a channel or the pressure
+    NON_IDEMPOTENT = ('AZ', 'PZ')
+
+    def __init__(self, attempts=3, deadline=1.0):
+        if attempts < 1:
+            raise ValueError("At least one attempt is needed")
+        self._attempts = attempts
+        self._deadline = deadline
+
+    def get_attempts(self):
+        return self._attempts
+
+    def get_deadline(self):
+        return self._deadline
+
+    def is_idempotent(self, command):
+        return command not in self.NON_IDEMPOTENT
+
+
+class CircuitBreaker(object):
+    """
+    Opens after failures consecutive timeouts: calls fail immediately instead of waiting for their timeout.
+    After reset_timeout seconds calls are let through again; the first timeout opens the breaker again, the
+    first response closes it.
+    """
+
+    def __init__(self, failures=5, reset_timeout=2.0, clock=time.monotonic):
+        self._threshold = failures
+        self._reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened = None  # time the breaker opened, None if it is closed
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        # open and not yet due for a trial call
+        opened = self._opened
+        return opened is not None and self._clock() - opened < self._reset_timeout
+
+    def get_failures(self):
+        return self._failures
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+
+    def failure(self):
+        with self._lock:
+            self._failures = self._failures + 1
+            if self._failures >= self._threshold:
+                self._opened = self._clock()
+
+    def reset(self):
+        self.success()
@@ -0,0 +1,503 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import os
+import re
+import select
+import threading
+import time
+import tty
+from collections import deque
+
+from mks647c.driver import MKS647CDriver as Driver
+
+
+class SimulatedChannel(object):
+    def __init__(self):
+        self.setpoint = 0
+        self.flow = 0.0
+        self.range = Driver.GAS_RANGE_100_SCCM
+        self.correction_factor = 100
+        self.mode = Driver.CHANNEL_MODE_INDEPENDENT
+        self.master = 0
+        self.high_limit = 1100
+        self.low_limit = 0
+        self.trip_limits_mode = Driver.TRIP_LIMIT_MODE_SLEEP
+        self.gas_sets = [0] * len(Driver.GAS_MENUS)
+        self.on = False
+
+
+class DeviceError(Exception):
+    def __init__(self, code):
+        super(DeviceError, self).__init__(code)
+        self.code = code
+
+
+class MKS647CSimulator(object):
+    """
+    Software model of the MKS 647C. It understands the frames generated by GrammarChannelMessage and answers with
+    the frames the controller sends: a value (or two), an empty line for writes or "E n" on errors.
+
+    Flows follow their setpoint with a first order lag of time constant tau while the valve is open, the pressure
+    follows the total flow.
+    """
+    ERROR_CHANNEL = 0
+    ERROR_UNKNOWN_COMMAND = 1
+    ERROR_SYNTAX = 2
+    ERROR_EXPRESSION = 3
+    ERROR_VALUE = 4
+    ERROR_AUTOZERO = 5
+
+    CHANNEL_COMMANDS = [Driver.CMD_SETPOINT, Driver.CMD_FLOW, Driver.CMD_RANGE, Driver.CMD_GAS_CORRECTION_FACTOR,
+                        Driver.CMD_MODE, Driver.CMD_HIGH_LIMIT, Driver.CMD_LOW_LIMIT, Driver.CMD_TRIPLE_LIMIT,
+                        Driver.CMD_GAS_SET, Driver.CMD_STATUS, Driver.CMD_OPEN, Driver.CMD_CLOSE,
+                        Driver.CMD_ZERO_ADJUST]
+
+    CMD_PRESSURE_READING = 'PR'
+
+    IDENTIFICATION = 'MKS 647C SIMULATOR'
+
+    FRAME = re.compile(r'\A([A-Z]{2})\s*(.*?)\s*\Z', re.DOTALL)
+
+    def __init__(self, channels=8, tau=0.5, clock=time.monotonic):
+        self._tau = float(tau)
+        self._clock = clock
+        self._last = clock()
+        self._lock = threading.Lock()
+        self._reset(channels)
+
+        self._handlers = {
+            Driver.CMD_SETPOINT: self._setpoint,
+            Driver.CMD_FLOW: self._flow,
+            self.CMD_PRESSURE_READING: self._pressure_reading,
+            Driver.CMD_PRESSURE: self._pressure,
+            Driver.CMD_PRESSURE_SIGNAL: self._pressure_signal,
+            Driver.CMD_PRESSURE_MODE: self._pressure_mode,
+            Driver.CMD_RANGE: self._range,
+            Driver.CMD_GAS_CORRECTION_FACTOR: self._correction_factor,
+            Driver.CMD_MODE: self._mode,
+            Driver.CMD_HIGH_LIMIT: self._high_limit,
+            Driver.CMD_LOW_LIMIT: self._low_limit,
+            Driver.CMD_TRIPLE_LIMIT: self._trip_limits_mode,
+            Driver.CMD_GAS_SET: self._gas_set,
+            Driver.CMD_GAS_MENU: self._gas_menu,
+            Driver.CMD_STATUS: self._status,
+            Driver.CMD_OPEN: self._open,
+            Driver.CMD_CLOSE: self._close,
+            Driver.CMD_ZERO_ADJUST: self._zero_adjust,
+            Driver.CMD_ZERO_ADJUST_PRESSURE: self._zero_adjust_pressure,
+            Driver.CMD_IDENTIFICATION: self._identification,
+            Driver.CMD_PRESSURE_COMTROLLER: self._pressure_controller,
+            Driver.CMD_PRESSURE_UNIT: self._pressure_unit,
+            Driver.CMD_KEYBOARD_DISABLE: self._keyboard_disable,
+            Driver.CMD_KEYBOARD_ENABLE: self._keyboard_enable,
+            Driver.CMD_ALL_DEFAULT: self._default,
+            Driver.CMD_HARDWARE_RESET: self._default,
+        }
+
+    def _reset(self, channels):
+        self._channels = [SimulatedChannel() for _ in range(channels)]
+        self.pressure = 0.0
+        self.pressure_setpoint = 0
+        self.pressure_mode = Driver.PRESSURE_MODE_OFF
+        self.pressure_controller = Driver.CONTROLLER_STD
+        self.pressure_unit = 0
+        self.gas_menu = Driver.GAS_MENU_DEFAULT
+        self.keyboard_enabled = True
+
+    def get_channel(self, channel) -> SimulatedChannel:
+        return self._channels[channel - 1]
+
+    def step(self):
+        # advances the flow model to the current time
+        now = self._clock()
+        dt, self._last = now - self._last, now
+        if dt <= 0:
+            return
+
+        decay = 1.0 - math.exp(-dt / self._tau) if self._tau > 0 else 1.0
+        total = 0.0
+        for channel in self._channels:
+            target = channel.setpoint if channel.on else 0.0
+            channel.flow = channel.flow + (target - channel.flow) * decay
+            total = total + channel.flow * channel.correction_factor / 100.0
+        self.pressure = self.pressure + (min(total / len(self._channels), 1100.0) - self.pressure) * decay
+
+    def handle(self, frame):
+        """
+        Processes one frame (str or bytes, with or without terminator) and returns the response frame as bytes.
+        """
+        if isinstance(frame, (bytes, bytearray)):
+            frame = frame.decode('ascii', errors='replace')
+
+        with self._lock:
+            self.step()
+            try:
+                response = self._dispatch(frame)
+            except DeviceError as e:
+                response = "E " + str(e.code)
+
+        return (response + "\r\n").encode('ascii')
+
+    def _dispatch(self, frame):
+        m = self.FRAME.match(frame)
+        if m is None:
+            raise DeviceError(self.ERROR_SYNTAX)
+
+        cmd, rest = m.group(1), m.group(2)
+        if cmd not in self._handlers:
+            raise DeviceError(self.ERROR_UNKNOWN_COMMAND)
+
+        channel = None
+        if cmd in self.CHANNEL_COMMANDS:
+            # the channel is separated from the parameters by a blank: "FS 1 500", not "FS 1500"
+            fields = rest.split(None, 1)
+            if not fields or not fields[0].isdigit():
+                raise DeviceError(self.ERROR_CHANNEL)
+            channel, rest = int(fields[0]), fields[1] if len(fields) > 1 else ''
+            all_allowed = cmd in (Driver.CMD_OPEN, Driver.CMD_CLOSE)
+            if not (Driver.CHANNEL_MIN <= channel <= len(self._channels) or (all_allowed and channel == 0)):
+                raise DeviceError(self.ERROR_CHANNEL)
+
+        # the R of a query follows the parameters, e.g. "GP c s R"
+        fields = rest.split()
+        query = fields[-1:] == ['R']
+        if query:
+            fields = fields[:-1]
+        params = []
+        if fields:
+            try:
+                params = [float(p.replace(',', '.')) for p in fields]
+            except ValueError:
+                raise DeviceError(self.ERROR_EXPRESSION)
+
+        result = self._handlers[cmd](channel, query, params)
+        if result is None:
+            return ""
+        if isinstance(result, tuple):
+            return " ".join(str(v) for v in result)
+        return str(result)
+
+    @staticmethod
+    def _value(params, index, low, high):
+        if len(params) <= index:
+            raise DeviceError(MKS647CSimulator.ERROR_SYNTAX)
+        value = int(round(params[index]))
+        if not low <= value <= high:
+            raise DeviceError(MKS647CSimulator.ERROR_VALUE)
+        return value
+
+    def _attribute(self, obj, name, query, params, low, high):
+        # common handling of "XX [c] R" queries and "XX [c] value" writes
+        if query:
+            return getattr(obj, name)
+        setattr(obj, name, self._value(params, 0, low, high))
+
+    def _setpoint(self, channel, query, params):
+        return self._attribute(self.get_channel(channel), 'setpoint', query, params, Driver.SETPOINT_MIN,
+                               Driver.SETPOINT_MAX)
+
+    def _flow(self, channel, query, params):
+        return int(round(self.get_channel(channel).flow))
+
+    def _pressure_reading(self, channel, query, params):
+        return int(round(self.pressure))
+
+    def _pressure(self, channel, query, params):
+        # without R and without parameter the actual pressure is read, as the driver does in get_pressure()
+        if not query and not params:
+            return self._pressure_reading(channel, query, params)
+        return self._attribute(self, 'pressure_setpoint', query, params, Driver.SETPOINT_MIN, Driver.SETPOINT_MAX)
+
+    def _pressure_signal(self, channel, query, params):
+        if self.pressure_mode == Driver.PRESSURE_MODE_OFF:
+            return 0
+        return int(round(max(0.0, min(1100.0, self.pressure_setpoint - self.pressure + 550.0))))
+
+    def _pressure_mode(self, channel, query, params):
+        return self._attribute(self, 'pressure_mode', query, params, Driver.PRESSURE_MODE_OFF,
+                               Driver.PRESSURE_MODE_AUTO)
+
+    def _range(self, channel, query, params):
+        return self._attribute(self.get_channel(channel), 'range', query, params, 0, Driver.MAX_GAS_RANGE_ID)
+
+    def _correction_factor(self, channel, query, params):
+        return self._attribute(self.get_channel(channel), 'correction_factor', query, params,
+                               Driver.COREECTION_FACTOR_MIN, Driver.COREECTION_FACTOR_MAX)
+
+    def _mode(self, channel, query, params):
+        ch = self.get_channel(channel)
+        if query:
+            return ch.mode, ch.master
+
+        mode = self._value(params, 0, 0, Driver.CHANNEL_MODE_TEST)
+        if mode == Driver.CHANNEL_MODE_SLAVE:
+            master = self._value(params, 1, Driver.CHANNEL_MIN, len(self._channels))
+            if master == channel:
+                raise DeviceError(self.ERROR_VALUE)
+        elif mode in (Driver.CHANNEL_MODE_INDEPENDENT, Driver.CHANNEL_MODE_EXTERN, Driver.CHANNEL_MODE_PCS,
+                      Driver.CHANNEL_MODE_TEST):
+            master = 0
+        else:
+            raise DeviceError(self.ERROR_VALUE)
+        ch.mode, ch.master = mode, master
+
+    def _high_limit(self, channel, query, params):
+        return self._attribute(self.get_channel(channel), 'high_limit', query, params, Driver.SETPOINT_MIN,
+                               Driver.SETPOINT_MAX)
+
+    def _low_limit(self, channel, query, params):
+        return self._attribute(self.get_channel(channel), 'low_limit', query, params, Driver.SETPOINT_MIN,
+                               Driver.SETPOINT_MAX)
+
+    def _trip_limits_mode(self, channel, query, params):
+        return self._attribute(self.get_channel(channel), 'trip_limits_mode', query, params,
+                               Driver.TRIP_LIMIT_MODE_SLEEP, Driver.TRIP_LIMIT_MODE_BAND)
+
+    def _gas_set(self, channel, query, params):
+        ch = self.get_channel(channel)
+        gas_set = self._value(params, 0, min(Driver.GAS_MENUS), max(Driver.GAS_MENUS))
+        if query or len(params) == 1:
+            return ch.gas_sets[gas_set]
+        ch.gas_sets[gas_set] = self._value(params, 1, Driver.SETPOINT_MIN, Driver.SETPOINT_MAX)
+
+    def _gas_menu(self, channel, query, params):
+        return self._attribute(self, 'gas_menu', query, params, min(Driver.GAS_MENUS), max(Driver.GAS_MENUS))
+
+    def _status(self, channel, query, params):
+        ch = self.get_channel(channel)
+        status = 0
+        if ch.on:
+            status = status | (1 << Driver.STATUS_BIT_ON_OFF)
+        if ch.trip_limits_mode != Driver.TRIP_LIMIT_MODE_SLEEP:
+            if ch.flow < ch.low_limit:
+                status = status | (1 << Driver.STATUS_BIT_TRIP_LIMIT_LOW)
+            if ch.flow > ch.high_limit:
+                status = status | (1 << Driver.STATUS_BIT_TRIP_LIMIT_HIGH)
+        if ch.flow >= Driver.SETPOINT_MAX:
+            status = status | (1 << Driver.STATUS_BIT_OVERFLOW_OUT)
+        return status
+
+    def _open(self, channel, query, params):
+        for ch in (self._channels if channel == Driver.CHANNEL_ALL else [self.get_channel(channel)]):
+            ch.on = True
+
+    def _close(self, channel, query, params):
+        for ch in (self._channels if channel == Driver.CHANNEL_ALL else [self.get_channel(channel)]):
+            ch.on = False
+
+    def _zero_adjust(self, channel, query, params):
+        ch = self.get_channel(channel)
+        if ch.on:
+            raise DeviceError(self.ERROR_AUTOZERO)
+        ch.flow = 0.0
+        return 0
+
+    def _zero_adjust_pressure(self, channel, query, params):
+        self.pressure = 0.0
+        return 0
+
+    def _identification(self, channel, query, params):
+        return self.IDENTIFICATION
+
+    def _pressure_controller(self, channel, query, params):
+        return self._attribute(self, 'pressure_controller', query, params, min(Driver.CONTROLLER_CODES),
+                               max(Driver.CONTROLLER_CODES))
+
+    def _pressure_unit(self, channel, query, params):
+        if query or not params:
+            return self.pressure_unit
+        raise DeviceError(self.ERROR_EXPRESSION)
+
+    def _keyboard_disable(self, channel, query, params):
+        self.keyboard_enabled = False
+
+    def _keyboard_enable(self, channel, query, params):
+        self.keyboard_enabled = True
+
+    def _default(self, channel, query, params):
+        self._reset(len(self._channels))
+
+
+class SimulatorTransport(object):
+    """
+    In-memory transport with the interface of the serial transport. Each written frame is answered by the
+    simulator immediately, unless realtime is set: then the response is delayed like on a real line.
+
+    Faults can be injected for the responses of the next written frames: a delay, after which the response
+    arrives while the next commands are written, a replaced (e.g. garbled) response, or a lost response. Reads
+    wait for delayed responses up to timeout seconds, if nothing is due they time out at once.
+    """
+
+    def __init__(self, simulator: MKS647CSimulator = None, latency=0.0, baudrate=9600, realtime=False, timeout=0.3):
+        if simulator is None:
+            simulator = MKS647CSimulator()
+
+        self._simulator = simulator
+        self._latency = latency
+        self._baudrate = baudrate
+        self._realtime = realtime
+        self._input = b''
+        self._buffer = b''
+        self._scheduled = deque()  # (time, response) of delayed responses, in order
+        self._faults = deque()
+        self.timeout = timeout
+
+    def get_simulator(self):
+        return self._simulator
+
+    def inject(self, delay=0.0, response=None, lost=False):
+        """
+        Applies a fault to the response of the next written frame, faults are applied in the order they were
+        injected. A delayed response also delays the responses after it, as on a serial line.
+        :param delay: seconds after the write at which the response arrives
+        :param response: bytes sent instead of the response of the simulator
+        :param lost: the response is not sent at all
+        """
+        self._faults.append((delay, response, lost))
+
+    def transmission_time(self, length):
+        # 8 data bits, parity, start and stop bit
+        return length * 11.0 / self._baudrate
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('ascii')
+
+        self._input = self._input + data
+        while b'\n' in self._input:
+            frame, self._input = self._input.split(b'\n', 1)
+            response = self._simulator.handle(frame)
+            if self._realtime:
+                time.sleep(self.transmission_time(len(frame) + len(response) + 1) + self._latency)
+
+            delay = 0.0
+            if self._faults:
+                delay, replacement, lost = self._faults.popleft()
+                if lost:
+                    continue
+                if replacement is not None:
+                    response = replacement
+            if delay > 0 or self._scheduled:
+                self._scheduled.append((time.perf_counter() + delay, response))
+            else:
+                self._buffer = self._buffer + response
+
+    def _deliver(self, wait=False):
+        # moves the due responses into the buffer, waits up to timeout for the next one if wait is set
+        if wait and not self._buffer and self._scheduled:
+            pause = self._scheduled[0][0] - time.perf_counter()
+            if pause > 0:
+                time.sleep(pause if self.timeout is None else min(pause, self.timeout))
+        now = time.perf_counter()
+        while self._scheduled and self._scheduled[0][0] <= now:
+            self._buffer = self._buffer + self._scheduled.popleft()[1]
+
+    @property
+    def in_waiting(self):
+        self._deliver()
+        return len(self._buffer)
+
+    def read_until(self, terminator=b'\n'):
+        self._deliver(wait=terminator not in self._buffer)
+        pos = self._buffer.find(terminator)
+        if pos < 0:
+            data, self._buffer = self._buffer, b''
+            return data
+        data, self._buffer = self._buffer[:pos], self._buffer[pos + len(terminator):]
+        return data
+
+    def read_bytes(self, count):
+        self._deliver(wait=True)
+        if not self._buffer:
+            raise TimeoutError("No data available")
+        data, self._buffer = self._buffer[:count], self._buffer[count:]
+        return data
+
+
+class PtySimulator(object):
+    """
+    Exposes a simulator on a pseudo terminal, so that MKS647CFactory.create_device(device=sim.get_port()) can
+    attach to it. Responses are delayed by the transmission time at the given baudrate plus latency.
+    """
+
+    def __init__(self, simulator: MKS647CSimulator = None, latency=0.005, baudrate=9600):
+        if simulator is None:
+            simulator = MKS647CSimulator()
+
+        self._simulator = simulator
+        self._latency = latency
+        self._baudrate = baudrate
+        self._master, self._slave = None, None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def get_simulator(self):
+        return self._simulator
+
+    def get_port(self):
+        if self._slave is None:
+            raise RuntimeError("Simulator is not started")
+        return os.ttyname(self._slave)
+
+    def start(self):
+        if self._thread is not None:
+            return self.get_port()
+
+        self._master, self._slave = os.openpty()
+        # no echo and no line discipline, the bytes have to pass unchanged
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='PtySimulator', daemon=True)
+        self._thread.start()
+        return self.get_port()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master, self._slave = None, None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _run(self):
+        data = b''
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._master], [], [], 0.05)
+            if not readable:
+                continue
+
+            try:
+                data = data + os.read(self._master, 1024)
+            except OSError:
+                return
+
+            while b'\n' in data:
+                frame, data = data.split(b'\n', 1)
+                response = self._simulator.handle(frame)
+                time.sleep((len(frame) + len(response) + 1) * 11.0 / self._baudrate + self._latency)
+                os.write(self._master, response)
@@ -0,0 +1,53 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Decoding of recorded raw status words, e.g. from the poller or a time series log, without Python loops.
+
+from collections import namedtuple
+
+import numpy as np
+
+from mks647c.driver import ChannelStatus
+
+FLAGS = (ChannelStatus.ON, ChannelStatus.TRIP_LIMIT_LOW, ChannelStatus.TRIP_LIMIT_HIGH, ChannelStatus.OVERFLOW_IN,
+         ChannelStatus.UNDERFLOW_IN, ChannelStatus.OVERFLOW_OUT, ChannelStatus.UNDERFLOW_OUT)
+
+StatusColumns = namedtuple('StatusColumns', ['on', 'trip_limit_low', 'trip_limit_high', 'overflow_in',
+                                             'underflow_in', 'overflow_out', 'underflow_out', 'valid'])
+
+# markers of status words which could not be read: poller.INVALID and storage.INVALID_STATUS
+INVALID_WORDS = (np.iinfo(np.int32).min, np.iinfo(np.uint16).max)
+
+
+def decode_matrix(words):
+    """
+    :param words: array of raw status words of any shape
+    :return: boolean array with an additional last axis, one entry per flag in the order of FLAGS
+    """
+    words = np.asarray(words, dtype=np.int64)
+    masks = np.array([int(flag) for flag in FLAGS], dtype=np.int64)
+    return (words[..., np.newaxis] & masks) != 0
+
+
+def decode(words):
+    """
+    Decodes raw status words into boolean columns. Words marked invalid are False in every flag column and in
+    the valid column.
+    :return: StatusColumns of boolean arrays with the shape of words
+    """
+    words = np.asarray(words, dtype=np.int64)
+    valid = ~np.isin(words, INVALID_WORDS)
+    matrix = decode_matrix(np.where(valid, words, 0))
+    return StatusColumns(*[matrix[..., i] for i in range(len(FLAGS))], valid=valid)
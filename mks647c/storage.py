@@ -0,0 +1,209 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Append-only time series log of raw samples. The file consists of a header and fixed width little endian records:
+#
+#   time     float64  seconds on the monotonic clock of the file, see TimeSeriesWriter
+#   value    int32    raw value (flow 0..1100, pressure), INVALID if it could not be read
+#   status   uint16   status bits of the channel, INVALID_STATUS if they could not be read
+#   channel  uint8    channel 1..8, PRESSURE_CHANNEL for pressure readings
+#   reserved uint8
+#
+# Readers map the file and return NumPy views of the columns, nothing is parsed.
+
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+MAGIC = b'MKS647TS'
+VERSION = 1
+
+# magic, version, record size, epoch (wall clock time at monotonic time 0 of the file)
+HEADER = struct.Struct('<8sHHxxxxd')
+HEADER_SIZE = 64
+
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('value', '<i4'), ('status', '<u2'), ('channel', 'u1'),
+                         ('reserved', 'u1')])
+
+PRESSURE_CHANNEL = 0
+INVALID = np.iinfo(np.int32).min
+INVALID_STATUS = np.iinfo(np.uint16).max
+
+
+class StorageError(RuntimeError):
+    pass
+
+
+def _read_header(f):
+    data = f.read(HEADER_SIZE)
+    if len(data) < HEADER_SIZE:
+        raise StorageError("File too short for a header")
+
+    magic, version, record_size, epoch = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise StorageError("Not a time series log")
+    if version != VERSION or record_size != RECORD_DTYPE.itemsize:
+        raise StorageError("Unsupported log version {} with record size {}".format(version, record_size))
+    return epoch
+
+
+class TimeSeriesWriter(object):
+    """
+    Appends records to a log, creating it if it does not exist.
+
+    Timestamps are taken from the monotonic clock, shifted such that they continue the time base of the file:
+    the header stores the wall clock time at monotonic time 0 of the process which created the file. Appending
+    after a reboot hence keeps the timestamps increasing, as long as the wall clock is right.
+
+    Records are buffered in memory and written when flush_size records are pending or flush() is called.
+    A record which was only partially written (e.g. on a crash) is cut off when the file is opened again.
+    """
+
+    def __init__(self, path, flush_size=1024, clock=time.monotonic):
+        self._path = path
+        self._flush_size = flush_size
+        self._clock = clock
+        self._pending = []
+        self._lock = threading.Lock()
+
+        epoch = time.time() - clock()
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                file_epoch = _read_header(f)
+            size = os.path.getsize(path)
+            complete = HEADER_SIZE + (size - HEADER_SIZE) // RECORD_DTYPE.itemsize * RECORD_DTYPE.itemsize
+            if complete != size:
+                os.truncate(path, complete)
+            self._offset = epoch - file_epoch
+        else:
+            with open(path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, RECORD_DTYPE.itemsize, epoch).ljust(HEADER_SIZE, b'\0'))
+            self._offset = 0.0
+
+        self._file = open(path, 'ab')
+
+    def get_path(self):
+        return self._path
+
+    def timestamp(self):
+        # current time in the time base of the file
+        return self._clock() + self._offset
+
+    def append(self, channel, value, status=0, timestamp=None):
+        if timestamp is None:
+            timestamp = self.timestamp()
+        with self._lock:
+            self._pending.append((timestamp, value, status, channel, 0))
+            if len(self._pending) >= self._flush_size:
+                self._flush()
+
+    def append_many(self, channels, values, statuses, timestamp=None):
+        """
+        Appends one record per channel, all with the same timestamp.
+        """
+        if timestamp is None:
+            timestamp = self.timestamp()
+        with self._lock:
+            for channel, value, status in zip(channels, values, statuses):
+                self._pending.append((timestamp, value, status, channel, 0))
+            if len(self._pending) >= self._flush_size:
+                self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self._file.write(np.array(self._pending, dtype=RECORD_DTYPE).tobytes())
+            self._pending = []
+        self._file.flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._flush()
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TimeSeriesReader(object):
+    """
+    Maps a log into memory. The columns are views of the mapped file, selections by channel or time return
+    copies. Call refresh() to see records which were appended after opening.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        with open(path, 'rb') as f:
+            self._epoch = _read_header(f)
+        self._records = None
+        self.refresh()
+
+    def get_epoch(self):
+        return self._epoch
+
+    def refresh(self):
+        count = (os.path.getsize(self._path) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+        if count == 0:
+            self._records = np.zeros(0, dtype=RECORD_DTYPE)
+        else:
+            self._records = np.memmap(self._path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))
+        return count
+
+    def __len__(self):
+        return len(self._records)
+
+    def records(self):
+        return self._records
+
+    def column(self, name):
+        # e.g. column('value'), a strided view without copy
+        return self._records[name]
+
+    def wall_time(self, timestamps):
+        # converts timestamps of the file into seconds since the epoch
+        return np.asarray(timestamps) + self._epoch
+
+    def channel(self, channel):
+        return self._records[self._records['channel'] == channel]
+
+    def between(self, start, stop):
+        """
+        Records with start <= time < stop, as view. The timestamps are increasing, the range is found by binary
+        search.
+        """
+        times = self._records['time']
+        first = int(np.searchsorted(times, start, side='left'))
+        last = int(np.searchsorted(times, stop, side='left'))
+        return self._records[first:last]
+
+    def close(self):
+        self._records = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
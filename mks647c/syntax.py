@@ -15,9 +15,14 @@
 
 from typing import List
 import re
+import sys
 
 DEBUG = True
 
+# Atomic groups are available since python 3.11. On older interpreters they are emulated with a lookahead
+# and a back-reference, which yields the same (non-backtracking) semantics.
+ATOMIC_GROUPS = sys.version_info >= (3, 11)
+
 
 class ArgumentNotSuppliedError(RuntimeError):
     pass
@@ -27,6 +32,10 @@ class ArgumentInvalidError(RuntimeError):
     pass
 
 
+class SyntaxNotCompilableError(RuntimeError):
+    pass
+
+
 class Result(object):
     def __init__(self, match, data):
         self._match = False
@@ -46,6 +55,8 @@ class Result(object):
 
 
 class IntermediateResult:
+    __slots__ = ('_data', '_len')
+
     def __init__(self, data, length):
         self._data = data
         self._len = length
@@ -61,13 +72,32 @@ class Syntax(object):
     def __init__(self, name):
         self._name = name
         self._default = {}
+        self._frozen = False
 
     def get_name(self):
         return self._name
 
     def set_default(self, value):
+        if self._frozen:
+            raise RuntimeError("Syntax '{}' is frozen and cannot be modified".format(self._name))
         self._default[self._name] = value
 
+    def get_children(self):
+        return ()
+
+    def freeze(self):
+        """
+        Makes the syntax tree immutable, so that it can be shared between messages and threads.
+        :return: Syntax
+        """
+        for child in self.get_children():
+            child.freeze()
+        self._frozen = True
+        return self
+
+    def is_frozen(self):
+        return self._frozen
+
     def get_parameter(self, name, *args, **kwargs):
         if kwargs is not None:
             if name in kwargs:
@@ -83,12 +113,94 @@ class Syntax(object):
     def generate(self, *args, **kwargs):
         raise NotImplementedError()
 
+    def compile(self):
+        """
+        Compiles the syntax tree into a single precompiled regular expression.
+
+        The returned syntax parses to the same result dictionaries as the tree itself. If the tree contains a
+        syntax which cannot be compiled, the tree is returned unchanged.
+        :return: Syntax
+        """
+        try:
+            return CompiledSyntax(self)
+        except SyntaxNotCompilableError:
+            return self
+
+    def _compile(self, compiler: 'SyntaxCompiler'):
+        """
+        Returns a tuple (pattern, extract). pattern is a regular expression which matches exactly what parse() would
+        consume and extract(match, data) writes the parsed values of the match into the dictionary data.
+        """
+        raise SyntaxNotCompilableError("Syntax '{}' cannot be compiled".format(self._name))
+
+
+class SyntaxCompiler(object):
+    def __init__(self):
+        self._groups = 0
+
+    def new_group(self):
+        self._groups = self._groups + 1
+        return "g" + str(self._groups)
+
+    def atomic(self, pattern):
+        # The grammar does not backtrack: once a syntax matched, the match is final. Hence every syntax is
+        # wrapped into an atomic group.
+        if ATOMIC_GROUPS:
+            return "(?>" + pattern + ")"
+
+        name = self.new_group()
+        return "(?=(?P<" + name + ">" + pattern + "))(?P=" + name + ")"
+
+
+class CompiledSyntax(Syntax):
+    def __init__(self, syntax: Syntax):
+        super(CompiledSyntax, self).__init__(syntax.get_name())
+        self._syntax = syntax
+        pattern, self._extract = syntax._compile(SyntaxCompiler())
+        self._regex = re.compile(pattern)
+
+    def get_syntax(self):
+        return self._syntax
+
+    def get_children(self):
+        return (self._syntax,)
+
+    def get_pattern(self):
+        return self._regex.pattern
+
+    def match(self, input, pos=0):
+        return self._regex.match(input, pos)
+
+    def extract(self, match):
+        data = {}
+        self._extract(match, data)
+        return data
+
+    def parse(self, input):
+        m = self._regex.match(input)
+
+        if m is None:
+            return None
+
+        data = {}
+        self._extract(m, data)
+        return IntermediateResult(data, m.end())
+
+    def generate(self, *args, **kwargs):
+        return self._syntax.generate(*args, **kwargs)
+
+    def compile(self):
+        return self
+
 
 class OptionalSyntax(Syntax):
     def __init__(self, name, sub_syntax):
         super(OptionalSyntax, self).__init__(name)
         self._syn = sub_syntax
 
+    def get_children(self):
+        return (self._syn,)
+
     def parse(self, input):
         try:
             res = self._syn.parse(input)
@@ -105,12 +217,33 @@ class OptionalSyntax(Syntax):
         else:
             return ""
 
+    def _compile(self, compiler: SyntaxCompiler):
+        group = compiler.new_group()
+        pattern, extract_sub = self._syn._compile(compiler)
+        name = self._name
+
+        def extract(m, data):
+            if m.group(group) is None:
+                data[name] = False
+            else:
+                extract_sub(m, data)
+                data[name] = True
+
+        return compiler.atomic("(?:(?P<" + group + ">" + pattern + "))?"), extract
+
 
 class OrSyntax(Syntax):
     def __init__(self, name, syntaxes: List[Syntax]):
         super(OrSyntax, self).__init__(name)
         self._or = syntaxes
 
+    def get_children(self):
+        return tuple(self._or)
+
+    def freeze(self):
+        self._or = tuple(self._or)
+        return super(OrSyntax, self).freeze()
+
     def parse(self, input):
         for syn in self._or:
             result = syn.parse(input)
@@ -125,37 +258,84 @@ class OrSyntax(Syntax):
                 ret = ret + syn.generate(*args, **kwargs)
         return ret
 
+    def _compile(self, compiler: SyntaxCompiler):
+        alternatives = []
+        patterns = []
+        for syn in self._or:
+            group = compiler.new_group()
+            pattern, extract_sub = syn._compile(compiler)
+            patterns.append("(?P<" + group + ">" + pattern + ")")
+            alternatives.append((group, syn.get_name(), extract_sub))
+        name = self._name
+
+        def extract(m, data):
+            for group, alternative, extract_sub in alternatives:
+                if m.group(group) is not None:
+                    extract_sub(m, data)
+                    data[name] = alternative
+                    return
+
+        return compiler.atomic("|".join(patterns)), extract
+
 
 class RepeatSyntax(Syntax):
     def __init__(self, name, syntax):
         super(RepeatSyntax, self).__init__(name)
         self._syn = syntax
 
+    def get_children(self):
+        return (self._syn,)
+
     def parse(self, input):
-        data = {self._name: (0, [])}
-        i = 0
+        items = []
         length = 0
         while True:
             try:
                 res = self._syn.parse(input)
-                data[self._name].append(res.get_data())
+                if res.get_length() == 0:
+                    break
+                items.append(res.get_data())
                 length = length + res.get_length()
                 input = input[res.get_length():]
             except:
                 break
-            i = i + 1
-        data[self._name][0] = i
-        return IntermediateResult(data, length)
+        return IntermediateResult({self._name: (len(items), items)}, length)
 
     def generate(self):
         raise NotImplementedError()
 
+    def _compile(self, compiler: SyntaxCompiler):
+        # python only keeps the last capture of a repeated group, hence the repetitions are extracted
+        # afterwards using a separately compiled matcher of the sub syntax.
+        group = compiler.new_group()
+        pattern, _ = self._syn._compile(compiler)
+        sub = CompiledSyntax(self._syn)
+        name = self._name
+
+        def extract(m, data):
+            items = []
+            pos, end = m.start(group), m.end(group)
+            while pos < end:
+                sub_match = sub.match(m.string, pos)
+                items.append(sub.extract(sub_match))
+                pos = sub_match.end()
+            data[name] = (len(items), items)
+
+        return compiler.atomic("(?P<" + group + ">(?:" + pattern + ")*)"), extract
+
 
 class ConcatSyntax(Syntax):
     def __init__(self, name, syntaxes: List[Syntax]):
         super(ConcatSyntax, self).__init__(name)
         self._syn = syntaxes
 
+    def get_children(self):
+        return tuple(self._syn)
+
+    def freeze(self):
+        self._syn = tuple(self._syn)
+        return super(ConcatSyntax, self).freeze()
+
     def parse(self, input):
         length = 0
         data = {}
@@ -175,11 +355,40 @@ class ConcatSyntax(Syntax):
             ret = ret + syn.generate(*args, **kwargs)
         return ret
 
+    def _compile(self, compiler: SyntaxCompiler):
+        patterns, extracts = [], []
+        for syn in self._syn:
+            pattern, extract_sub = syn._compile(compiler)
+            patterns.append(pattern)
+            extracts.append(extract_sub)
+
+        def extract(m, data):
+            for extract_sub in extracts:
+                extract_sub(m, data)
+
+        return "".join(patterns), extract
+
 
 class Token(Syntax):
     def __init__(self, name):
         super(Token, self).__init__(name)
 
+    def _pattern(self):
+        raise SyntaxNotCompilableError("Token '{}' cannot be compiled".format(self._name))
+
+    def _convert(self, value):
+        return value
+
+    def _compile(self, compiler: SyntaxCompiler):
+        group = compiler.new_group()
+        name = self._name
+        convert = self._convert
+
+        def extract(m, data):
+            data[name] = convert(m.group(group))
+
+        return compiler.atomic("(?P<" + group + ">" + self._pattern() + ")"), extract
+
 
 class UntilStringToken(Token):
     def __init__(self, name, separator):
@@ -198,6 +407,16 @@ class UntilStringToken(Token):
     def generate(self, *args, **kwargs):
         return self.get_parameter(self._name, *args, **kwargs) + self._sep
 
+    def _compile(self, compiler: SyntaxCompiler):
+        # the separator is consumed, but is not part of the value
+        group = compiler.new_group()
+        name = self._name
+
+        def extract(m, data):
+            data[name] = m.group(group)
+
+        return compiler.atomic("(?P<" + group + ">(?s:.*?))" + re.escape(self._sep)), extract
+
 
 class UntilToken(Token):
     def __init__(self, name, terminator):
@@ -207,17 +426,19 @@ class UntilToken(Token):
         self._term = terminator
 
     def parse(self, input):
-        for key, value in enumerate(input):
-            if value == self._term:
-                if key == 0:
-                    return None
-                return IntermediateResult({self._name: input[:key]}, key)
-
-        return None
+        key = input.find(self._term)
+        if key <= 0:
+            return None
+        return IntermediateResult({self._name: input[:key]}, key)
 
     def generate(self, *args, **kwargs):
         return self.get_parameter(self._name, *args, **kwargs) + self._term
 
+    def _pattern(self):
+        # the terminator itself is not consumed
+        term = re.escape(self._term)
+        return "[^" + term + "]+(?=" + term + ")"
+
 
 class FixedLengthToken(Token):
     def __init__(self, name, length):
@@ -237,15 +458,21 @@ class FixedLengthToken(Token):
 
         return tk
 
+    def _pattern(self):
+        return "(?s:.{" + str(self._len) + "})"
+
 
 class RegexToken(Token):
+    INLINE_FLAGS = {re.IGNORECASE: 'i', re.MULTILINE: 'm', re.DOTALL: 's', re.VERBOSE: 'x'}
+
     def __init__(self, name, regex, modifiers=0):
         super(RegexToken, self).__init__(name)
         self._regex = regex
         self._modifiers = modifiers
+        self._compiled = re.compile(regex, modifiers)
 
     def parse(self, input):
-        m = re.search(self._regex, input, self._modifiers)
+        m = self._compiled.search(input)
 
         if m is None:
             return None
@@ -263,6 +490,27 @@ class RegexToken(Token):
         self._validate(tk)
         return tk
 
+    def _pattern(self):
+        # Only anchored expressions can be embedded, since unanchored ones would search the whole input.
+        # Numbered back-references would point to the wrong group after embedding.
+        if not self._regex.startswith(r'\A') or re.search(r'\\[1-9]|\(\?P=', self._regex):
+            return super(RegexToken, self)._pattern()
+
+        flags = ""
+        for flag, inline in self.INLINE_FLAGS.items():
+            if self._modifiers & flag:
+                flags = flags + inline
+
+        if not self._modifiers == (self._modifiers & sum(self.INLINE_FLAGS)):
+            return super(RegexToken, self)._pattern()
+
+        if flags:
+            return "(?" + flags + ":" + self._regex[2:] + ")"
+        return "(?:" + self._regex[2:] + ")"
+
+    def _convert(self, value):
+        return self._compiled.search(value).groups()
+
 
 class IntegerToken(RegexToken):
     def __init__(self, name):
@@ -275,19 +523,25 @@ class IntegerToken(RegexToken):
 
         return IntermediateResult({self._name: int(result.get_data()[self._name][0])}, result.get_length())
 
+    def _convert(self, value):
+        return int(value)
+
 
 class FloatToken(RegexToken):
     def __init__(self, name):
         super(FloatToken, self).__init__(name, r'\A([-+]?(\d+([.,]\d*)?|[.,]\d+)([eE][-+]?\d+)?)')
 
     def parse(self, input):
-        m = re.search(self._regex, input)
+        m = self._compiled.search(input)
 
         if m is None:
             return None
 
         return IntermediateResult({self._name: float(m.group(1).replace(',', '.'))}, m.end())
 
+    def _convert(self, value):
+        return float(value.replace(',', '.'))
+
 
 class ConstantToken(RegexToken):
     def __init__(self, name, expect, case_sensitive=False, add_default=True):
@@ -310,6 +564,9 @@ class ConstantToken(RegexToken):
 
         return IntermediateResult({self._name: result.get_data()[self._name][0]}, result.get_length())
 
+    def _convert(self, value):
+        return value
+
 
 class WhitespaceToken(RegexToken):
     def __init__(self, name):
@@ -323,6 +580,9 @@ class WhitespaceToken(RegexToken):
 
         return IntermediateResult({self._name: result.get_data()[self._name][0]}, result.get_length())
 
+    def _convert(self, value):
+        return value
+
 
 class WordToken(RegexToken):
     def __init__(self, name):
@@ -335,3 +595,6 @@ class WordToken(RegexToken):
             return None
 
         return IntermediateResult({self._name: result.get_data()[self._name][0]}, result.get_length())
+
+    def _convert(self, value):
+        return value
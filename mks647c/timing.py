@@ -0,0 +1,145 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import deque
+
+
+class AdaptiveTiming(object):
+    """
+    Learns the response times of each command and derives its timeout from a high percentile:
+
+        timeout = min(max(ceiling, default of the command), max(floor, percentile * factor))
+
+    Until min_samples responses of a command were seen, its default timeout is used. A command whose default
+    exceeds the ceiling (e.g. RE) is clamped to its default instead. Overrides are used as given.
+
+    The gap between the response to a command and the next command starts at min_gap. Timeouts and errors
+    which hint at a garbled command double it (up to max_gap), every streak of successes reduces it by gap_step,
+    so that it converges to the smallest gap the controller handles.
+
+    The timeouts are applied by setting the timeout attribute of the transport before each read (as on a pyserial
+    port). Transports without it keep their own fixed timeout, the protocol warns about this when it first uses
+    the transport.
+    """
+
+    DEFAULT_TIMEOUT = 0.3
+
+    # commands which take longer than a plain read, in seconds
+    DEFAULT_TIMEOUTS = {
+        'AZ': 2.0,  # zero adjust
+        'PZ': 2.0,  # zero adjust pressure
+        'DF': 2.0,  # parameter default
+        'RE': 5.0,  # hardware reset
+    }
+
+    # error codes of the device which are answered to a garbled command: unknown command, syntax error
+    OVERRUN_ERRORS = (1, 2)
+
+    def __init__(self, default=DEFAULT_TIMEOUT, percentile=99.0, factor=1.5, floor=0.05, ceiling=2.0, min_samples=20,
+                 window=256, min_gap=0.0, max_gap=0.05, gap_step=0.0005, success_streak=50):
+        self._default = default
+        self._percentile = percentile
+        self._factor = factor
+        self._floor = floor
+        self._ceiling = ceiling
+        self._min_samples = min_samples
+        self._window = window
+        self._min_gap = min_gap
+        self._max_gap = max_gap
+        self._gap_step = gap_step
+        self._success_streak = success_streak
+
+        self._samples = {}  # command -> deque of response times
+        self._timeouts = {}  # command -> learned timeout, updated every window // 8 samples
+        self._pending = {}  # command -> samples since the last update
+        self._overrides = {}
+        self._defaults = dict(self.DEFAULT_TIMEOUTS)
+        self._gap = min_gap
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    def set_override(self, command, timeout):
+        # None removes the override
+        with self._lock:
+            if timeout is None:
+                self._overrides.pop(command, None)
+            else:
+                self._overrides[command] = timeout
+
+    def set_default(self, command, timeout):
+        with self._lock:
+            self._defaults[command] = timeout
+
+    def get_timeout(self, command):
+        timeout = self._overrides.get(command)
+        if timeout is None:
+            timeout = self._timeouts.get(command)
+        if timeout is None:
+            timeout = self._defaults.get(command, self._default)
+        return timeout
+
+    def get_gap(self):
+        return self._gap
+
+    def _learn(self, command, samples):
+        ordered = sorted(samples)
+        value = ordered[min(len(ordered) - 1, int(len(ordered) * self._percentile / 100.0))]
+        self._timeouts[command] = min(self._ceiling_of(command), max(self._floor, value * self._factor))
+
+    def _ceiling_of(self, command):
+        return max(self._ceiling, self._defaults.get(command, self._ceiling))
+
+    def observe(self, command, seconds):
+        # response time of a successful exchange, from the end of the write (or of the previous response of a
+        # batch) to the end of the response
+        with self._lock:
+            samples = self._samples.get(command)
+            if samples is None:
+                samples = self._samples[command] = deque(maxlen=self._window)
+            samples.append(seconds)
+
+            pending = self._pending.get(command, 0) + 1
+            if len(samples) >= self._min_samples and (command not in self._timeouts or
+                                                      pending >= max(1, self._window // 8)):
+                self._learn(command, samples)
+                pending = 0
+            self._pending[command] = pending
+
+            self._successes = self._successes + 1
+            if self._successes >= self._success_streak:
+                self._successes = 0
+                self._gap = max(self._min_gap, self._gap - self._gap_step)
+
+    def timeout(self, command):
+        # a response got lost: the learned timeout is too short or the controller was overrun
+        with self._lock:
+            if command in self._timeouts:
+                self._timeouts[command] = min(self._ceiling_of(command), self._timeouts[command] * 2)
+            self._overrun()
+
+    def error(self, command, code):
+        if code in self.OVERRUN_ERRORS:
+            with self._lock:
+                self._overrun()
+
+    def _overrun(self):
+        self._successes = 0
+        self._gap = min(self._max_gap, max(self._gap * 2, self._gap_step))
+
+    def get_info(self):
+        with self._lock:
+            commands = set(self._samples) | set(self._overrides) | set(self._defaults)
+        return {'gap': self._gap, 'timeouts': {command: self.get_timeout(command) for command in sorted(commands)}}
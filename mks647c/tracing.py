@@ -0,0 +1,180 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tracing of the stages of a call: the driver method, building the message, acquiring the transport lock,
+# generating the frame, writing, reading and parsing the response. Spans are kept in memory and exported as
+# Chrome trace events (chrome://tracing, Perfetto) or as OpenTelemetry OTLP/JSON.
+#
+# Tracing is off unless a tracer is set, the protocol then only checks for None per stage.
+
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque, namedtuple
+
+# times are perf_counter seconds
+SpanRecord = namedtuple('SpanRecord', ['name', 'start', 'end', 'span_id', 'parent_id', 'trace_id', 'thread_id',
+                                       'attributes'])
+
+
+class Span(object):
+    __slots__ = ('_tracer', '_name', '_attributes', '_start', '_span_id', '_parent_id', '_trace_id', '_token')
+
+    def __init__(self, tracer, name, attributes):
+        self._tracer = tracer
+        self._name = name
+        self._attributes = attributes
+
+    def set_attribute(self, key, value):
+        self._attributes[key] = value
+
+    def __enter__(self):
+        self._tracer._open(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end = time.perf_counter()
+        if exc_val is not None:
+            self._attributes['error'] = repr(exc_val)
+        self._tracer._close(self, end)
+
+
+class Tracer(object):
+    """
+    Collects nested spans. The current span is kept in a context variable, so spans nest per thread and per
+    asyncio task. The newest capacity spans are kept.
+    """
+
+    def __init__(self, capacity=100000, service='mks647c'):
+        self._spans = deque(maxlen=capacity)
+        self._service = service
+        self._ids = itertools.count(1)
+        self._current = contextvars.ContextVar('mks647c_span', default=None)
+        # converts perf_counter seconds into unix time
+        self._epoch = time.time() - time.perf_counter()
+
+    def _open(self, span: Span):
+        parent = self._current.get()
+        span._span_id = next(self._ids)
+        if parent is not None:
+            span._parent_id, span._trace_id = parent._span_id, parent._trace_id
+        else:
+            span._parent_id, span._trace_id = None, span._span_id
+        span._token = self._current.set(span)
+
+    def _close(self, span: Span, end):
+        self._current.reset(span._token)
+        self._spans.append(SpanRecord(span._name, span._start, end, span._span_id, span._parent_id, span._trace_id,
+                                      threading.get_ident(), span._attributes))
+
+    def span(self, name, **attributes):
+        # with tracer.span('name'): ...
+        return Span(self, name, attributes)
+
+    def record(self, name, start, end, **attributes):
+        # adds a finished span as child of the current span, start and end are perf_counter times
+        parent = self._current.get()
+        span_id = next(self._ids)
+        if parent is not None:
+            parent_id, trace_id = parent._span_id, parent._trace_id
+        else:
+            parent_id, trace_id = None, span_id
+        self._spans.append(SpanRecord(name, start, end, span_id, parent_id, trace_id, threading.get_ident(),
+                                      attributes))
+
+    def get_spans(self):
+        return list(self._spans)
+
+    def clear(self):
+        self._spans.clear()
+
+    def to_chrome(self):
+        pid = os.getpid()
+        events = []
+        for span in list(self._spans):
+            events.append({'name': span.name, 'cat': 'mks647c', 'ph': 'X', 'pid': pid, 'tid': span.thread_id,
+                           'ts': (span.start + self._epoch) * 1e6, 'dur': (span.end - span.start) * 1e6,
+                           'args': dict(span.attributes)})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    @staticmethod
+    def _otlp_value(value):
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, int):
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+
+    def to_otlp(self):
+        pid = os.getpid()
+        spans = []
+        for span in list(self._spans):
+            entry = {
+                # ids are unique within the process only, hence prefixed with the pid
+                'traceId': '{:016x}{:016x}'.format(pid, span.trace_id),
+                'spanId': '{:016x}'.format(span.span_id),
+                'name': span.name,
+                'kind': 1,  # internal
+                'startTimeUnixNano': str(int((span.start + self._epoch) * 1e9)),
+                'endTimeUnixNano': str(int((span.end + self._epoch) * 1e9)),
+                'attributes': [{'key': key, 'value': self._otlp_value(value)}
+                               for key, value in sorted(span.attributes.items())],
+                'status': {'code': 2 if 'error' in span.attributes else 1},
+            }
+            if span.parent_id is not None:
+                entry['parentSpanId'] = '{:016x}'.format(span.parent_id)
+            spans.append(entry)
+
+        resource = {'attributes': [{'key': 'service.name', 'value': {'stringValue': self._service}},
+                                   {'key': 'process.pid', 'value': {'intValue': str(pid)}}]}
+        return {'resourceSpans': [{'resource': resource,
+                                   'scopeSpans': [{'scope': {'name': 'mks647c'}, 'spans': spans}]}]}
+
+    def write_chrome(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome(), f)
+
+    def write_otlp(self, path):
+        # one OTLP/JSON export request, as written by the file exporter of the OpenTelemetry collector
+        with open(path, 'w') as f:
+            json.dump(self.to_otlp(), f)
+            f.write('\n')
+
+
+def traced(tracer: Tracer, name, fn):
+    """
+    Wraps a function or coroutine function in a span.
+    """
+    # imported here, inspect is expensive to import and only needed once tracing is enabled
+    import inspect
+
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return await fn(*args, **kwargs)
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return fn(*args, **kwargs)
+    return wrapper
@@ -3,13 +3,13 @@ import mks647c.message
 
 from mks647c.factory import MKS647CFactory
 
-f = MKS647CFactory()
-dr = f.create_device()
-
-#dr.test()
-
-
 
+def main():
+    f = MKS647CFactory()
+    dr = f.create_device()
 
+    #dr.test()
 
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+from mks647c.simulator import MKS647CSimulator, SimulatorTransport
+
+
+class FrameLog(SimulatorTransport):
+    # keeps the written frames as bytes
+    def __init__(self, *args, **kwargs):
+        super(FrameLog, self).__init__(*args, **kwargs)
+        self.frames = []
+
+    def write(self, data):
+        self.frames.append(data.encode('ascii') if isinstance(data, str) else bytes(data))
+        super(FrameLog, self).write(data)
+
+
+@pytest.fixture
+def simulator():
+    # flows follow their setpoint at once
+    return MKS647CSimulator(tau=0.0)
+
+
+@pytest.fixture
+def transport(simulator):
+    return FrameLog(simulator)
+
+
+@pytest.fixture
+def protocol():
+    # the protocol locks the transport with the inter process lock of e21_util
+    pytest.importorskip('e21_util')
+    from mks647c.protocol import MKS647CProtocol
+    return MKS647CProtocol()
+
+
+@pytest.fixture
+def driver(transport, protocol):
+    from mks647c.driver import MKS647CDriver
+    return MKS647CDriver(transport, protocol)
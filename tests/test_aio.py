@@ -0,0 +1,164 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The asyncio driver against the simulator behind a loopback socket.
+
+import asyncio
+
+import pytest
+
+from mks647c.simulator import MKS647CSimulator
+
+TIMEOUT = 0.05
+
+
+class Device(object):
+    # serves the simulator on a local port, responses are delayed by the given seconds in order
+    def __init__(self):
+        self.simulator = MKS647CSimulator(tau=0.0)
+        self.delays = []
+        self.frames = []
+        self._server = None
+
+    async def _serve(self, reader, writer):
+        while True:
+            try:
+                frame = await reader.readuntil(b'\n')
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            self.frames.append(frame)
+            if self.delays:
+                await asyncio.sleep(self.delays.pop(0))
+            writer.write(self.simulator.handle(frame))
+            await writer.drain()
+
+    async def connect(self, protocol=None):
+        from mks647c.aio import AsyncMKS647CDriver, AsyncMKS647CProtocol, AsyncStreamTransport
+
+        self._server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        port = self._server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        return AsyncMKS647CDriver(AsyncStreamTransport(reader, writer),
+                                  protocol or AsyncMKS647CProtocol(timeout=TIMEOUT))
+
+
+@pytest.fixture
+def device():
+    pytest.importorskip('e21_util')
+    return Device()
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 5.0))
+
+
+def test_calls(device):
+    async def main():
+        driver = await device.connect()
+        await driver.set_setpoint(1, 0.5)
+        return await driver.get_setpoint(1), await driver.get_setpoints([1, 2])
+
+    assert run(main()) == (0.5, {1: 0.5, 2: 0.0})
+
+
+def test_late_response_is_dropped(device):
+    from mks647c.protocol import ResponseTimeoutError
+
+    async def main():
+        driver = await device.connect()
+        device.delays = [2 * TIMEOUT]
+        with pytest.raises(ResponseTimeoutError):
+            await driver.get_range(1)
+        await driver.set_range(2, 7)
+        return await driver.get_range(2)
+
+    assert run(main()) == 7
+
+
+def test_cancelled_before_the_write(device):
+    async def main():
+        driver = await device.connect()
+        async with driver.session():
+            call = asyncio.ensure_future(driver.get_range(1))
+            await asyncio.sleep(0.01)
+            call.cancel()  # still waits for the lock
+        with pytest.raises(asyncio.CancelledError):
+            await call
+        assert driver._protocol._pending.get(driver._transport, 0) == 0
+        return await driver.get_setpoint(1)
+
+    assert run(main()) == 0.0
+    assert device.frames == [b'FS 1 R\r\n']
+
+
+def test_cancelled_after_the_write(device):
+    async def main():
+        driver = await device.connect()
+        device.delays = [TIMEOUT / 2]
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(driver.get_range(1), TIMEOUT / 10)
+        assert driver._protocol._pending[driver._transport] == 1
+        await driver.set_range(2, 7)
+        return await driver.get_range(2)
+
+    assert run(main()) == 7
+
+
+def test_cancelled_during_the_write(device):
+    async def main():
+        driver = await device.connect()
+        write = driver._transport.write
+
+        async def slow_write(data):
+            await asyncio.sleep(TIMEOUT / 5)
+            await write(data)
+
+        driver._transport.write = slow_write
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(driver.get_range(1), TIMEOUT / 10)
+        driver._transport.write = write
+        await driver.set_range(2, 7)
+        return await driver.get_range(2)
+
+    assert run(main()) == 7
+    # the frame was written completely although the call was cancelled
+    assert device.frames == [b'RA 1 R\r\n', b'RA 2 7\r\n', b'RA 2 R\r\n']
+
+
+def test_session_keeps_other_tasks_out(device):
+    async def main():
+        driver = await device.connect()
+        async with driver.session(max_hold=None):
+            other = asyncio.ensure_future(driver.set_setpoint(2, 0.2))
+            await driver.set_setpoint(1, 0.1)
+            async with driver.session():
+                await driver.get_setpoint(1)
+            await asyncio.sleep(0.01)
+            assert not other.done()
+        await other
+
+    run(main())
+    assert device.frames == [b'FS 1 100\r\n', b'FS 1 R\r\n', b'FS 2 200\r\n']
+
+
+def test_apply(device):
+    async def main():
+        driver = await device.connect()
+        report = await driver.apply({1: {'range': 7, 'setpoint': 0.5}})
+        return report, await driver.get_range(1)
+
+    report, range_code = run(main())
+    assert range_code == 7
+    assert set(report['changed']) == {(1, 'range'), (1, 'setpoint')}
@@ -0,0 +1,84 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Allocations per query (message generation and response parsing), measured with tracemalloc.
+
+import tracemalloc
+
+from mks647c.message import GrammarChannelMessage, DataChannelMessage, GrammarGeneralResponse, \
+    GrammarIntegerResponse, DataGeneralResponse
+from mks647c.syntax import IntermediateResult
+
+QUERIES = 1000
+
+
+def query(response):
+    msg = GrammarChannelMessage()
+    data = DataChannelMessage()
+    data.set_command('FL')
+    data.set_channel(1)
+    data.set_optional_query(False)
+    data.set_query()
+    msg.set_data(data)
+    msg.set_response_class(GrammarIntegerResponse)
+    msg.generate()
+    return msg.get_response_class()().parse(response)
+
+
+def allocations_per_query(response):
+    # warm up: builds the shared grammars and fills the frame cache
+    query(response)
+
+    tracemalloc.start()
+    try:
+        package = [tracemalloc.Filter(True, "*mks647c*")]
+        before = tracemalloc.take_snapshot().filter_traces(package)
+        results = [query(response) for _ in range(QUERIES)]
+        after = tracemalloc.take_snapshot().filter_traces(package)
+
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        query(response)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in stats) / len(results)
+    return blocks, peak - current
+
+
+def test_query_retains_only_the_response():
+    # the response object and its value, no syntax tree
+    blocks, _ = allocations_per_query("500\r\n")
+    assert blocks <= 3
+
+
+def test_query_transient_peak():
+    # building the two syntax trees of a query peaked at about 10 kB
+    _, peak = allocations_per_query("500\r\n")
+    assert peak < 4096
+
+
+def test_grammars_are_shared():
+    assert GrammarChannelMessage().get_syntax() is GrammarChannelMessage().get_syntax()
+    assert GrammarIntegerResponse().get_syntax() is GrammarIntegerResponse().get_syntax()
+    assert GrammarGeneralResponse().get_syntax() is not GrammarIntegerResponse().get_syntax()
+    assert GrammarChannelMessage().get_syntax().is_frozen()
+
+
+def test_data_objects_use_slots():
+    for obj in (DataChannelMessage(), DataGeneralResponse.create('1'), IntermediateResult({}, 0)):
+        assert not hasattr(obj, '__dict__')
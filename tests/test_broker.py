@@ -0,0 +1,97 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Calls through the broker socket.
+
+import os
+import stat
+
+import pytest
+
+from mks647c.broker import MKS647CBroker, MKS647CBrokerClient, BrokerError, READ_METHODS, WRITE_METHODS, \
+    encode_error, decode_error
+from mks647c.driver import MKS647CDriver
+from mks647c.protocol import ResponseError, ResponseTimeoutError, CircuitOpenError, ChannelError, \
+    InvalidValueError, AutozeroError
+
+
+@pytest.fixture
+def broker(driver, tmp_path):
+    broker = MKS647CBroker(driver, str(tmp_path / 'mks647c.sock'))
+    broker.start()
+    yield broker
+    broker.stop()
+
+
+@pytest.fixture
+def client(broker):
+    with MKS647CBrokerClient(broker.get_path(), timeout=5.0) as client:
+        yield client
+
+
+def test_remote_methods_exist():
+    for method in READ_METHODS + WRITE_METHODS:
+        assert callable(getattr(MKS647CDriver, method))
+
+
+def test_calls(client):
+    client.set_setpoint(1, 0.5)
+    assert client.get_setpoint(1) == 0.5
+    assert client.get_setpoints([1, 2]) == {1: 0.5, 2: 0.0}
+
+
+@pytest.mark.parametrize('method', ['get_transport', 'get_tracer', 'get_cache', 'session', '_check'])
+def test_local_methods_are_rejected(client, method):
+    with pytest.raises(BrokerError):
+        client.call(method)
+    with pytest.raises(AttributeError):
+        getattr(client, method)
+    # the connection is still usable
+    assert client.get_setpoint(1) == 0.0
+
+
+def test_socket_is_private(broker):
+    assert stat.S_IMODE(os.stat(broker.get_path()).st_mode) == 0o600
+
+
+@pytest.mark.parametrize('cls', [ChannelError, InvalidValueError, AutozeroError, ResponseTimeoutError,
+                                 CircuitOpenError])
+def test_protocol_errors_keep_their_class(cls):
+    error = decode_error(encode_error(cls('bad', 4)))
+    assert type(error) is cls
+    assert (str(error), error.code) == ('bad', 4)
+
+
+def test_unknown_errors_with_a_code_are_response_errors():
+    error = decode_error({'type': 'NewDeviceError', 'message': 'bad', 'code': 9})
+    assert isinstance(error, ResponseError) and error.code == 9
+    assert type(decode_error({'type': 'OSError', 'message': 'bad', 'code': None})) is RuntimeError
+
+
+def test_device_errors_reach_the_client(client, transport):
+    transport.inject(response=b'E 4\r\n')
+    with pytest.raises(InvalidValueError):
+        client.set_range(1, 7)
+
+
+def test_apply_with_a_rejected_field(client, transport):
+    for _ in range(3):
+        transport.inject()  # the reads and the write of the range
+    transport.inject(response=b'E 4\r\n')
+    report = client.apply({1: {'range': 7, 'setpoint': 0.5}})
+    assert list(report['changed']) == [(1, 'range')]
+    assert list(report['errors']) == [(1, 'setpoint')]
+    assert isinstance(report['errors'][(1, 'setpoint')], InvalidValueError)
+    assert client.get_range(1) == 7
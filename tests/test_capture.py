@@ -0,0 +1,73 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Recording a session of the driver.
+
+import pytest
+
+from mks647c.capture import Capture, RecordingTransport
+from mks647c.simulator import MKS647CSimulator, SimulatorTransport
+
+
+class SerialTransport(SimulatorTransport):
+    # has what the simulator transport lacks
+    port = '/dev/ttyUSB0'
+
+    def __init__(self, *args, **kwargs):
+        super(SerialTransport, self).__init__(*args, **kwargs)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def serial():
+    return SerialTransport(MKS647CSimulator(tau=0.0))
+
+
+@pytest.fixture
+def recording(serial, tmp_path):
+    return RecordingTransport(serial, str(tmp_path / 'session.gz'))
+
+
+def test_record(recording, protocol, tmp_path):
+    from mks647c.driver import MKS647CDriver
+
+    driver = MKS647CDriver(recording, protocol)
+    driver.set_setpoint(1, 0.5)
+    assert driver.get_setpoint(1) == 0.5
+    recording.close()
+
+    exchanges = list(Capture(str(tmp_path / 'session.gz')).exchanges())
+    assert len(exchanges) == 2
+
+
+def test_close_closes_the_wrapped_transport(recording, serial):
+    recording.close()
+    assert serial.closed
+
+
+def test_close_without_a_closable_transport(tmp_path):
+    RecordingTransport(SimulatorTransport(), str(tmp_path / 'session.gz')).close()
+
+
+def test_attributes_are_passed_through(recording, serial):
+    assert recording.port == '/dev/ttyUSB0'
+    assert recording.get_simulator() is serial.get_simulator()
+    recording.timeout = 0.1
+    assert serial.timeout == 0.1
+    with pytest.raises(AttributeError):
+        recording.baudrate
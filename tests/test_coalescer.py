@@ -0,0 +1,77 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Failed writes of the coalescer are kept and sent again with the next flush.
+
+import pytest
+
+from mks647c.coalescer import CoalescingWriter
+from mks647c.driver import MKS647CDriver
+
+
+@pytest.fixture
+def writer(driver):
+    return CoalescingWriter(driver)
+
+
+def test_failed_write_is_sent_again(writer, transport, simulator):
+    transport.inject(response=b'E 2\r\n')  # garbled on the line
+    writer.set_setpoint(1, 0.5)
+    assert writer.flush() == 1
+    assert 1 in [key[1] for key in writer.get_errors()]
+    assert writer.get_info()['pending'] == 1
+
+    assert writer.flush() == 1
+    assert writer.get_errors() == {}
+    assert writer.get_info()['pending'] == 0
+    assert transport.frames == [b'FS 1 500\r\n', b'FS 1 500\r\n']
+    assert writer.flush() == 0
+
+
+def test_newer_value_replaces_the_failed_write(writer, transport, driver):
+    transport.inject(response=b'E 2\r\n')
+    writer.set_setpoint(1, 0.5)
+    original = driver.set_raw_many
+
+    def set_raw_many(requests):
+        writer.set_setpoint(1, 0.7)  # put while the failing write is on the line
+        return original(requests)
+
+    driver.set_raw_many = set_raw_many
+    writer.flush()
+    driver.set_raw_many = original
+
+    writer.flush()
+    assert transport.frames == [b'FS 1 500\r\n', b'FS 1 700\r\n']
+
+
+def test_rejected_write_is_dropped(writer, transport):
+    from mks647c.protocol import InvalidValueError
+
+    transport.inject(response=b'E 4\r\n')
+    writer.set_setpoint(1, 0.5)
+    assert writer.flush() == 1
+    assert isinstance(writer.get_errors()[(MKS647CDriver.CMD_SETPOINT, 1)], InvalidValueError)
+    assert writer.get_info()['pending'] == 0
+    assert writer.flush() == 0
+    assert transport.frames == [b'FS 1 500\r\n']
+
+
+def test_invalid_values_are_rejected(writer):
+    with pytest.raises(RuntimeError):
+        writer.set_setpoint(1, 2.0)
+    with pytest.raises(RuntimeError):
+        writer.set_high_limit(9, 0.5)
+    assert writer.get_info()['pending'] == 0
@@ -0,0 +1,80 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The bytes written for each command. Command, channel and parameters are separated by one blank, queries of
+# parameters end with R, e.g. "FS c R" and "GP c s R" in the manual.
+
+import pytest
+
+FRAMES = [
+    ('get_setpoint', (1,), b'FS 1 R\r\n'),
+    ('set_setpoint', (1, 0.5), b'FS 1 500\r\n'),
+    ('get_flow', (2,), b'FL 2\r\n'),
+    ('get_range', (3,), b'RA 3 R\r\n'),
+    ('set_range', (3, 4), b'RA 3 4\r\n'),
+    ('get_gas_correction_factor', (1,), b'GC 1 R\r\n'),
+    ('set_gas_correction_factor', (1, 1.0), b'GC 1 100\r\n'),
+    ('get_mode', (1,), b'MO 1 R\r\n'),
+    ('set_mode', (2, 1, 1), b'MO 2 1 1\r\n'),
+    ('set_mode', (2, 0), b'MO 2 0\r\n'),
+    ('get_high_limit', (1,), b'HL 1 R\r\n'),
+    ('set_high_limit', (1, 1.0), b'HL 1 1000\r\n'),
+    ('get_low_limit', (1,), b'LL 1 R\r\n'),
+    ('set_low_limit', (1, 0.1), b'LL 1 100\r\n'),
+    ('get_trip_limits_mode', (1,), b'TM 1 R\r\n'),
+    ('set_trip_limits_mode', (1, 1), b'TM 1 1\r\n'),
+    ('set_gas_set', (1, 2, 0.3), b'GP 1 2 300\r\n'),
+    ('get_status_all', (1,), b'ST 1\r\n'),
+    ('zero_adjust', (1,), b'AZ 1\r\n'),
+    ('open', (1,), b'ON 1\r\n'),
+    ('close', (0,), b'OF 0\r\n'),
+    ('get_pressure', (), b'PS\r\n'),
+    ('get_pressure_setpoint', (), b'PS R\r\n'),
+    ('set_pressure', (0.5,), b'PS 500\r\n'),
+    ('get_pressure_control_signal', (), b'PC\r\n'),
+    ('get_pressure_mode', (), b'PM R\r\n'),
+    ('set_pressure_mode', (1,), b'PM 1\r\n'),
+    ('zero_adjust_pressure', (), b'PZ\r\n'),
+    ('get_gas_menu', (), b'GM R\r\n'),
+    ('set_gas_menu', (1,), b'GM 1\r\n'),
+    ('get_pressure_controller', (), b'GT R\r\n'),
+    ('set_pressure_controller', (1,), b'GT 1\r\n'),
+    ('get_pressure_unit', (), b'PU R\r\n'),
+    ('identification', (), b'ID\r\n'),
+    ('keyboard_disable', (), b'KD\r\n'),
+    ('keyboard_enable', (), b'KE\r\n'),
+    ('parameter_default', (), b'DF\r\n'),
+    ('hardware_reset', (), b'RE\r\n'),
+]
+
+
+@pytest.mark.parametrize('method,args,frame', FRAMES)
+def test_frame(driver, transport, method, args, frame):
+    getattr(driver, method)(*args)
+    assert transport.frames == [frame]
+
+
+def test_channel_is_not_joined_with_the_parameter(simulator):
+    # a frame without separator addresses channel 1500
+    assert simulator.handle(b'FS 1500\r\n') == b'E 0\r\n'
+    assert simulator.handle(b'FS 1 500\r\n') == b'\r\n'
+    assert simulator.handle(b'FS 1 R\r\n') == b'500\r\n'
+
+
+def test_batch_frames(driver, transport):
+    driver.get_flows([1, 2])
+    driver.set_raw_many([('FS', 1, 500), ('RA', 2, 4)])
+    assert transport.frames[:2] == [b'FL 1\r\n', b'FL 2\r\n']
+    assert transport.frames[2:] == [b'FS 1 500\r\n', b'RA 2 4\r\n']
@@ -0,0 +1,85 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from mks647c.framing import FrameReader
+
+
+def test_partial_frames_are_kept(transport):
+    reader = FrameReader(transport)
+    transport.inject(response=b'12')
+    transport.write(b'FL 1\r\n')
+    assert reader.read_frame(0.01) == b''
+    transport.inject(response=b'3\r\n')
+    transport.write(b'FL 1\r\n')
+    assert reader.read_frame(0.01) == b'123\r\n'
+
+
+def test_sync_drops_received_frames(transport):
+    reader = FrameReader(transport)
+    transport.write(b'FS 1 R\r\nFS 2 R\r\n')
+    assert reader.sync() == 2
+    assert reader.read_frame(0.01) == b''
+
+
+def test_sync_keeps_frames_in_flight(transport):
+    # the pre-write sync does not block, a late response arrives after it
+    reader = FrameReader(transport)
+    transport.inject(delay=0.05)
+    transport.write(b'RA 2 R\r\n')
+    assert reader.sync() == 0
+    transport.write(b'RA 3 R\r\n')
+    assert reader.read_frame(0.2) == b'6\r\n'
+    assert reader.read_frame(0.2) == b'6\r\n'
+
+
+def test_discard_until_quiet_drops_frames_in_flight(transport, simulator):
+    simulator.get_channel(3).range = 4
+    reader = FrameReader(transport)
+    transport.inject(delay=0.05)
+    transport.write(b'RA 2 R\r\n')
+    start = time.perf_counter()
+    assert reader.discard_until_quiet(0.1)
+    assert time.perf_counter() - start >= 0.15
+    assert reader.get_dropped() == 1
+
+    transport.write(b'RA 3 R\r\n')
+    assert reader.read_frame(0.1) == b'4\r\n'
+
+
+def test_discard_until_quiet_drops_partial_frames(transport, simulator):
+    reader = FrameReader(transport)
+    transport.inject(response=b'garb')
+    transport.write(b'FL 1\r\n')
+    assert reader.discard_until_quiet(0.02)
+    transport.write(b'FS 1 R\r\n')
+    assert reader.read_frame(0.1) == b'0\r\n'
+
+
+def test_discard_until_quiet_gives_up(transport):
+    reader = FrameReader(transport)
+    for i in range(20):
+        transport.inject(delay=0.01 * i)
+        transport.write(b'FL 1\r\n')
+    assert not reader.discard_until_quiet(0.05, limit=0.1)
+
+
+def test_protocol_clear_drops_late_response(driver, transport, simulator):
+    simulator.get_channel(3).range = 4
+    transport.inject(delay=0.05)
+    transport.write(b'RA 2 R\r\n')
+    assert driver._protocol.clear(transport)
+    assert driver.get_range(3) == 4
@@ -0,0 +1,65 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Startup cost: each module is imported in a fresh interpreter with -X importtime.
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+MODULES = ['mks647c', 'mks647c.message', 'mks647c.protocol', 'mks647c.driver', 'mks647c.factory']
+
+# cumulative import time per module in ms, the best of RUNS
+BUDGET = 40.0
+RUNS = 3
+
+# only needed once a device is opened, a server is started or samples are stored
+FORBIDDEN = ('e21_util', 'serial', 'http', 'numpy', 'asyncio')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(code):
+    # returns the modules of FORBIDDEN which were imported and the lines of -X importtime
+    check = code + "; import sys; print(' '.join(m for m in sys.modules if m.split('.')[0] in {!r}))".format(
+        FORBIDDEN)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', check], capture_output=True, text=True,
+                            check=True, cwd=ROOT)
+    return result.stdout.split(), result.stderr.splitlines()
+
+
+def import_time(module, lines):
+    for line in lines:
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1000.0
+    raise AssertionError("No import time reported for {}".format(module))
+
+
+@pytest.mark.parametrize('module', MODULES)
+def test_import_budget(module):
+    times = []
+    for _ in range(RUNS):
+        imported, lines = run('import ' + module)
+        assert imported == []
+        times.append(import_time(module, lines))
+    assert min(times) <= BUDGET
+
+
+def test_create_device_imports_nothing_heavy():
+    imported, _ = run("from mks647c.factory import MKS647CFactory; MKS647CFactory().create_device(device='/dev/null')")
+    assert imported == []
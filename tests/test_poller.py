@@ -0,0 +1,63 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The poller writes its samples to the log.
+
+import time
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from mks647c.poller import MKS647CPoller
+from mks647c.storage import TimeSeriesWriter, TimeSeriesReader, PRESSURE_CHANNEL
+
+
+@pytest.fixture
+def log(tmp_path):
+    # buffers more records than a short run produces
+    return TimeSeriesWriter(str(tmp_path / 'flows.log'), flush_size=4096)
+
+
+def wait_for(poller, count):
+    while poller.get_count() < count:
+        time.sleep(0.001)
+
+
+def test_stop_flushes_the_log(driver, log):
+    poller = MKS647CPoller(driver, channels=[1, 2], rate=100.0, log=log)
+    poller.start()
+    wait_for(poller, 3)
+    poller.stop()
+
+    with TimeSeriesReader(log.get_path()) as reader:
+        assert len(reader) == 3 * poller.get_count()
+        assert len(reader.channel(PRESSURE_CHANNEL)) == poller.get_count()
+
+
+def test_restart_appends_to_the_same_log(driver, log):
+    poller = MKS647CPoller(driver, channels=[1], rate=100.0, log=log)
+    poller.start()
+    wait_for(poller, 2)
+    poller.stop()
+    count = poller.get_count()
+
+    poller.start()
+    wait_for(poller, count + 2)
+    poller.stop()
+    log.close()
+
+    with TimeSeriesReader(log.get_path()) as reader:
+        assert len(reader) == 2 * poller.get_count()
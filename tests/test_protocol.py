@@ -0,0 +1,136 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Batches and retries against the simulator with delayed, garbled and lost responses. The timeouts are scaled
+# down to 50 ms.
+
+import logging
+
+import pytest
+
+from mks647c.timing import AdaptiveTiming
+
+TIMEOUT = 0.05
+LATE = 0.08
+DEVICE = 0.005
+
+RANGES = [('RA', channel, True) for channel in range(1, 9)]
+
+
+@pytest.fixture
+def protocol(protocol):
+    protocol.set_timing(AdaptiveTiming(default=TIMEOUT, floor=TIMEOUT))
+    return protocol
+
+
+@pytest.fixture
+def simulator(simulator):
+    # a distinct range per channel, so that misassigned responses show
+    for channel in range(1, 9):
+        simulator.get_channel(channel).range = channel
+    return simulator
+
+
+def respond(transport, count, delay=DEVICE):
+    for _ in range(count):
+        transport.inject(delay=delay)
+
+
+def test_batch(driver, transport):
+    respond(transport, 8)
+    assert driver.get_raw_many(RANGES) == {request: request[1] for request in RANGES}
+    assert len(transport.frames) == 8
+
+
+def test_batch_error_response_keeps_order(driver, transport):
+    from mks647c.protocol import UnknownCommandError
+
+    requests = RANGES[:2] + [('XX', 3, True)] + RANGES[3:]
+    respond(transport, 16)
+    result = driver.get_raw_many(requests)
+    assert result == {request: request[1] for request in requests if request[0] == 'RA'}
+    assert isinstance(result.get_errors()[('XX', 3, True)], UnknownCommandError)
+    assert driver.get_range(1) == 1
+
+
+@pytest.mark.parametrize('retry', [True, False])
+def test_batch_late_response(driver, transport, retry):
+    if not retry:
+        driver._protocol.set_retry_policy(None)
+    transport.inject(delay=DEVICE)
+    transport.inject(delay=LATE)
+    respond(transport, 30)
+
+    result = driver.get_raw_many(RANGES)
+    for request, value in result.items():
+        assert value == request[1]
+    if retry:
+        assert not result.has_errors()
+    else:
+        assert ('RA', 2, True) in result.get_errors()
+    assert driver.get_range(3) == 3
+    assert driver.get_raw_many(RANGES) == {request: request[1] for request in RANGES}
+
+
+def test_batch_lost_response(driver, transport):
+    transport.inject(delay=DEVICE)
+    transport.inject(lost=True)
+    respond(transport, 30)
+    assert driver.get_raw_many(RANGES) == {request: request[1] for request in RANGES}
+    assert driver.get_range(8) == 8
+
+
+def test_batch_garbled_response(driver, transport):
+    transport.inject(response=b'#\x00\r\n')
+    assert driver.get_raw_many(RANGES) == {request: request[1] for request in RANGES}
+
+
+def test_batch_writes_are_not_repeated(driver, transport, simulator):
+    writes = [('FS', channel, 100 * channel) for channel in range(1, 9)]
+    transport.inject(delay=DEVICE)
+    transport.inject(delay=LATE)
+    respond(transport, 10)
+
+    result = driver.set_raw_many(writes)
+    assert [frame for frame in transport.frames if frame.startswith(b'FS')] == \
+        [b'FS %d %d\r\n' % (channel, value) for _, channel, value in writes]
+    assert set(result) | set(result.get_errors()) == set(writes)
+    assert all(simulator.get_channel(channel).setpoint == value for _, channel, value in writes)
+    assert driver.get_range(1) == 1
+
+
+def test_batch_response_times_exclude_the_pipeline(driver, transport, protocol):
+    # the device answers one command after the other, every 5 ms
+    observed = []
+    timing = protocol.get_timing()
+    observe = timing.observe
+    timing.observe = lambda command, seconds: (observed.append(seconds), observe(command, seconds))
+    for k in range(8):
+        transport.inject(delay=DEVICE * (k + 1))
+
+    driver.get_raw_many(RANGES)
+    assert len(observed) == 8
+    assert max(observed) < 3 * DEVICE
+
+
+def test_transport_without_timeout_is_reported(protocol, transport, caplog):
+    class Port(object):
+        def write(self, data):
+            pass
+
+    with caplog.at_level(logging.WARNING):
+        protocol.get_reader(Port())
+        protocol.get_reader(transport)
+    assert len(caplog.records) == 1
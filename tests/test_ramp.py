@@ -0,0 +1,62 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Failed writes of a ramp are sent again.
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from mks647c.ramp import RampEngine, LinearProfile, PiecewiseProfile
+
+from conftest import FrameLog
+
+
+class FailingOnce(FrameLog):
+    # the device reports a garbled command for the first write of the given frame
+    def __init__(self, simulator, frame):
+        super(FailingOnce, self).__init__(simulator)
+        self._frame = frame
+
+    def write(self, data):
+        if (data.encode('ascii') if isinstance(data, str) else data) == self._frame:
+            self._frame = None
+            self.inject(response=b'E 2\r\n')
+        super(FailingOnce, self).write(data)
+
+
+@pytest.fixture
+def transport(simulator):
+    return FailingOnce(simulator, b'FS 1 500\r\n')
+
+
+def test_final_setpoint_is_sent_again(driver, transport):
+    engine = RampEngine(driver, period=0.01)
+    engine.add(1, LinearProfile(0.0, 0.5, 0.03))
+    report = engine.run()
+    assert report['errors'] == {}
+    assert transport.frames.count(b'FS 1 500\r\n') == 2
+    assert driver.get_setpoint(1) == 0.5
+
+
+def test_plateau_is_sent_again(driver, transport):
+    engine = RampEngine(driver, period=0.01)
+    engine.add(1, PiecewiseProfile([(0.0, 0.0), (0.02, 0.5), (0.05, 0.5)]))
+    engine.add(2, LinearProfile(0.0, 0.5, 0.05))
+    report = engine.run()
+    assert report['errors'] == {}
+    assert transport.frames.count(b'FS 1 500\r\n') == 2
+    assert transport.frames[-1] == b'FS 2 500\r\n'
+    assert driver.get_setpoint(1) == 0.5
@@ -0,0 +1,141 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Single queries with late, garbled and lost responses. The timeouts are scaled down to 50 ms.
+
+import time
+
+import pytest
+
+from mks647c.retry import RetryPolicy
+from mks647c.timing import AdaptiveTiming
+
+TIMEOUT = 0.05
+LATE = 0.08
+
+
+@pytest.fixture
+def protocol(protocol):
+    protocol.set_timing(AdaptiveTiming(default=TIMEOUT, floor=TIMEOUT))
+    protocol.set_retry_policy(RetryPolicy(attempts=3, deadline=1.0))
+    return protocol
+
+
+@pytest.fixture
+def simulator(simulator):
+    for channel in range(1, 9):
+        simulator.get_channel(channel).range = channel
+    return simulator
+
+
+def test_retry_does_not_take_the_late_response(driver, transport):
+    transport.inject(delay=LATE)
+    transport.inject(delay=0.005)
+    assert driver.get_range(2) == 2
+    assert [driver.get_range(channel) for channel in (3, 4, 5, 6)] == [3, 4, 5, 6]
+    assert len(transport.frames) == 6
+
+
+def test_late_response_without_retry(driver, transport, protocol):
+    from mks647c.protocol import ResponseTimeoutError
+
+    protocol.set_retry_policy(None)
+    transport.inject(delay=LATE)
+    with pytest.raises(ResponseTimeoutError):
+        driver.get_range(2)
+    assert driver.get_range(3) == 3
+    assert driver.get_raw_many([('RA', channel, True) for channel in (4, 5, 6)]) == {
+        ('RA', 4, True): 4, ('RA', 5, True): 5, ('RA', 6, True): 6}
+
+
+def test_retry_after_garbled_response(driver, transport):
+    transport.inject(response=b'\x13#\r\n')
+    assert driver.get_range(5) == 5
+    assert len(transport.frames) == 2
+
+
+def test_retry_after_lost_response(driver, transport):
+    transport.inject(lost=True)
+    transport.inject(lost=True)
+    assert driver.get_range(7) == 7
+    assert len(transport.frames) == 3
+
+
+def test_attempts_are_bounded(driver, transport):
+    from mks647c.protocol import ResponseTimeoutError
+
+    for _ in range(5):
+        transport.inject(lost=True)
+    with pytest.raises(ResponseTimeoutError):
+        driver.get_range(1)
+    assert len(transport.frames) == 3
+
+
+def test_writes_are_not_retried(driver, transport, simulator):
+    from mks647c.protocol import ResponseTimeoutError
+
+    transport.inject(lost=True)
+    with pytest.raises(ResponseTimeoutError):
+        driver.set_range(1, 9)
+    assert transport.frames == [b'RA 1 9\r\n']
+    assert simulator.get_channel(1).range == 9
+
+
+def test_zero_adjust_is_not_retried(driver, transport):
+    from mks647c.protocol import ResponseTimeoutError
+
+    transport.inject(lost=True)
+    with pytest.raises(ResponseTimeoutError):
+        driver.zero_adjust(1)
+    assert transport.frames == [b'AZ 1\r\n']
+
+
+def test_device_errors_are_not_retried(driver, transport):
+    from mks647c.protocol import InvalidValueError
+
+    transport.inject(response=b'E 4\r\n')
+    with pytest.raises(InvalidValueError):
+        driver.get_range(1)
+    assert len(transport.frames) == 1
+
+
+def test_no_retry_while_the_line_is_busy(driver, transport, protocol, monkeypatch):
+    from mks647c.protocol import ResponseTimeoutError
+
+    # unsolicited frames every 10 ms, starting after the timeout of the query
+    monkeypatch.setattr(protocol, 'RESYNC_LIMIT', 0.1)
+    for i in range(30):
+        transport.inject(delay=TIMEOUT + 0.01 * (i + 1))
+        transport.write(b'FL 1\r\n')
+    with pytest.raises(ResponseTimeoutError):
+        driver.get_range(1)
+    assert transport.frames.count(b'RA 1 R\r\n') == 1
+
+
+def test_circuit_breaker_fails_fast(driver, transport, protocol):
+    from mks647c.protocol import CircuitOpenError, ResponseTimeoutError
+
+    protocol.set_retry_policy(None)
+    protocol.set_circuit_breaker(failures=2, reset_timeout=10.0)
+    for _ in range(2):
+        transport.inject(lost=True)
+        with pytest.raises(ResponseTimeoutError):
+            driver.get_range(1)
+
+    start = time.perf_counter()
+    with pytest.raises(CircuitOpenError):
+        driver.get_range(1)
+    assert time.perf_counter() - start < TIMEOUT
+    assert len(transport.frames) == 2
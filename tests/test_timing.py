@@ -0,0 +1,52 @@
+# Copyright (C) 2018, see AUTHORS.md
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Learned timeouts of AdaptiveTiming.
+
+from mks647c.timing import AdaptiveTiming
+
+
+def observe(timing, command, seconds, count=20):
+    for _ in range(count):
+        timing.observe(command, seconds)
+
+
+def test_learned_timeouts_are_clamped():
+    timing = AdaptiveTiming(floor=0.05, ceiling=2.0)
+    observe(timing, 'FL', 0.001)
+    observe(timing, 'FS', 10.0)
+    assert timing.get_timeout('FL') == 0.05
+    assert timing.get_timeout('FS') == 2.0
+
+
+def test_commands_with_a_longer_default_keep_it_as_ceiling():
+    timing = AdaptiveTiming(ceiling=2.0)
+    assert timing.get_timeout('RE') == 5.0
+    observe(timing, 'RE', 10.0)
+    assert timing.get_timeout('RE') == 5.0
+
+    timing = AdaptiveTiming(ceiling=2.0)
+    observe(timing, 'RE', 1.0)
+    assert timing.get_timeout('RE') == 1.5
+    timing.timeout('RE')
+    timing.timeout('RE')
+    assert timing.get_timeout('RE') == 5.0
+
+
+def test_set_default_raises_the_ceiling():
+    timing = AdaptiveTiming(ceiling=2.0)
+    timing.set_default('GP', 3.0)
+    observe(timing, 'GP', 10.0)
+    assert timing.get_timeout('GP') == 3.0